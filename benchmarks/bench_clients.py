@@ -0,0 +1,51 @@
+"""Per-invocation cost of building the boto3 clients versus reusing the client registry.
+
+Runs offline: only the client construction is measured (botocore session, service
+model loading and endpoint resolution). The TLS handshake saved by keeping the
+connection pools warm comes on top of these numbers in a real Lambda.
+
+    python benchmarks/bench_clients.py [invocations]
+"""
+import os
+import sys
+import time
+import statistics
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from utils.clients import get_client, clear_clients
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+REGIONS = ('us-east-1', 'us-west-2')
+
+def per_invocation_clients():
+    """What lambda_handler used to do on every call."""
+    return [boto3.client('quicksight', region_name=region) for region in REGIONS] + [boto3.client('s3')]
+
+def registry_clients():
+    return [get_client('quicksight', region) for region in REGIONS] + [get_client('s3')]
+
+def measure(function, invocations: int) -> list[float]:
+    timings = []
+    for _ in range(invocations):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def report(name: str, timings: list[float]):
+    print(f"{name:<28} mean {statistics.mean(timings):9.3f} ms   p50 {statistics.median(timings):9.3f} ms   max {max(timings):9.3f} ms")
+
+if __name__ == '__main__':
+    invocations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    clear_clients()
+    cold = measure(registry_clients, 1)
+    warm = measure(registry_clients, invocations)
+    old = measure(per_invocation_clients, invocations)
+
+    report('boto3.client per call', old)
+    report('registry (cold start)', cold)
+    report('registry (warm)', warm)
+    print(f"\nSaved per warm invocation: {statistics.mean(old) - statistics.mean(warm):.3f} ms")
@@ -0,0 +1,397 @@
+"""Wall time, API calls and peak memory of the handlers against a stubbed QuickSight.
+
+Runs offline. The real boto3 clients of the registry are used (rate limiter, retries and
+metrics included), but every HTTP request is answered in process by a fake QuickSight
+backend through botocore's before-send event. Each call takes --latency seconds and an
+operation called more than --tps times per second answers with a ThrottlingException.
+
+The synthetic analysis has N datasets, each one behind --join-depth levels of joins
+sharing the base datasets, and --visuals visuals per sheet (5 sheets).
+
+    python benchmarks/bench_handlers.py [--datasets 5,20,50] [--join-depth 0,2] [--visuals 30]
+        [--latency 0.02] [--tps 0] [--rate-limits JSON] [--build-time 0] [--repeat 3]
+        [--save results.json] [--compare baseline.json] [--threshold 0.1]
+"""
+import os
+import sys
+import copy
+import json
+import hashlib
+import time
+import argparse
+import platform
+import threading
+import tracemalloc
+import subprocess
+from collections import Counter, deque
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, '..', 'src'))
+sys.path.insert(0, ROOT)
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench', 'LOG_FILE': '',
+    'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'CRITICAL'), 'METRICS_EMF': 'false',
+})
+
+from botocore.awsrequest import AWSResponse
+from urllib3._collections import HTTPHeaderDict
+from bench_snapshots import synthetic_snapshot
+import utils.ratelimit as ratelimit
+from utils.clients import get_client, clear_clients
+from utils.cache import request_cache
+from utils.metrics import request_metrics, metrics_summary
+from utils.handlers import migrate_analysis_handler, create_template_handler, update_template_handler, update_analysis_handler
+
+ACCOUNT = '123456789012'
+SOURCE, TARGET = 'us-east-1', 'us-west-2'
+USER_ARN = f'arn:aws:quicksight:{SOURCE}:{ACCOUNT}:user/default/bench@example.com'
+ANALYSIS_ID = 'bench'
+HANDLERS = ('migration', 'template_creation', 'template_update', 'analysis_update')
+
+class ServiceError(Exception):
+    def __init__(self, status: int, code: str) -> None:
+        super().__init__(code)
+        self.status = status
+        self.code = code
+
+class FakeQuickSight():
+    def __init__(self, region: str, tps: float = 0, build_time: float = 0) -> None:
+        """In memory QuickSight of a region. Analyses and template versions stay *_IN_PROGRESS for build_time seconds"""
+        self.region = region
+        self.tps = tps
+        self.build_time = build_time
+        self.datasets = {}
+        self.analyses = {}
+        self.templates = {}
+        self.calls = Counter()
+        self.throttled = 0
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def arn(self, kind: str, resource_id: str) -> str:
+        return f'arn:aws:quicksight:{self.region}:{ACCOUNT}:{kind}/{resource_id}'
+
+    def _status(self, started_at: float, prefix: str = 'CREATION') -> str:
+        return f'{prefix}_IN_PROGRESS' if time.monotonic() - started_at < self.build_time else f'{prefix}_SUCCESSFUL'
+
+    def handle(self, operation: str, params: dict) -> dict:
+        with self._lock:
+            self.calls[operation] += 1
+            if self.tps:
+                recent = self._recent.setdefault(operation, deque())
+                now = time.monotonic()
+                while recent and now - recent[0] >= 1:
+                    recent.popleft()
+                if len(recent) >= self.tps:
+                    self.throttled += 1
+                    raise ServiceError(429, 'ThrottlingException')
+                recent.append(now)
+            return getattr(self, operation)(**copy.deepcopy(params))
+
+    def _dataset(self, DataSetId: str) -> dict:
+        if DataSetId not in self.datasets:
+            raise ServiceError(404, 'ResourceNotFoundException')
+        return self.datasets[DataSetId]
+
+    def DescribeDataSet(self, AwsAccountId, DataSetId):
+        return {'DataSet': copy.deepcopy(self._dataset(DataSetId))}
+
+    def CreateDataSet(self, AwsAccountId, DataSetId, Name, PhysicalTableMap, ImportMode, LogicalTableMap=None, Permissions=None, **kwargs):
+        if DataSetId in self.datasets:
+            raise ServiceError(409, 'ResourceExistsException')
+        self.datasets[DataSetId] = {'Arn': self.arn('dataset', DataSetId), 'DataSetId': DataSetId, 'Name': Name, 'PhysicalTableMap': PhysicalTableMap, 'LogicalTableMap': LogicalTableMap or {}, 'ImportMode': ImportMode}
+        return {'Arn': self.arn('dataset', DataSetId), 'DataSetId': DataSetId}
+
+    def UpdateDataSet(self, AwsAccountId, DataSetId, Name, PhysicalTableMap, ImportMode, LogicalTableMap=None, **kwargs):
+        self._dataset(DataSetId).update(Name=Name, PhysicalTableMap=PhysicalTableMap, LogicalTableMap=LogicalTableMap or {}, ImportMode=ImportMode)
+        return {'Arn': self.arn('dataset', DataSetId), 'DataSetId': DataSetId}
+
+    def UpdateDataSetPermissions(self, AwsAccountId, DataSetId, **kwargs):
+        self._dataset(DataSetId)
+        return {'DataSetId': DataSetId, 'DataSetArn': self.arn('dataset', DataSetId)}
+
+    def _analysis(self, AnalysisId: str) -> dict:
+        if AnalysisId not in self.analyses:
+            raise ServiceError(404, 'ResourceNotFoundException')
+        return self.analyses[AnalysisId]
+
+    def _save_analysis(self, AnalysisId, Name, Definition, SourceEntity, prefix, ThemeArn=None):
+        if Definition is None:
+            # From a template: the definition of the analysis the template was made of
+            template = self._template(extract_id(SourceEntity['SourceTemplate']['Arn']))
+            Definition = copy.deepcopy(template['definition'])
+        self.analyses[AnalysisId] = {'Name': Name, 'Definition': Definition, 'ThemeArn': ThemeArn, 'started_at': time.monotonic(), 'prefix': prefix}
+
+    def DescribeAnalysis(self, AwsAccountId, AnalysisId):
+        analysis = self._analysis(AnalysisId)
+        return {'Analysis': {
+            'AnalysisId': AnalysisId, 'Arn': self.arn('analysis', AnalysisId), 'Name': analysis['Name'],
+            'Status': self._status(analysis['started_at'], analysis['prefix']),
+            'DataSetArns': [declaration['DataSetArn'] for declaration in analysis['Definition']['DataSetIdentifierDeclarations']],
+            **({'ThemeArn': analysis['ThemeArn']} if analysis['ThemeArn'] else {}),
+        }}
+
+    def DescribeAnalysisDefinition(self, AwsAccountId, AnalysisId):
+        analysis = self._analysis(AnalysisId)
+        return {'AnalysisId': AnalysisId, 'Name': analysis['Name'], 'Definition': analysis['Definition'], 'ResourceStatus': 'CREATION_SUCCESSFUL', **({'ThemeArn': analysis['ThemeArn']} if analysis['ThemeArn'] else {})}
+
+    def CreateAnalysis(self, AwsAccountId, AnalysisId, Name, Definition=None, SourceEntity=None, ThemeArn=None, **kwargs):
+        if AnalysisId in self.analyses:
+            raise ServiceError(409, 'ResourceExistsException')
+        self._save_analysis(AnalysisId, Name, Definition, SourceEntity, 'CREATION', ThemeArn)
+        return {'AnalysisId': AnalysisId, 'Arn': self.arn('analysis', AnalysisId), 'CreationStatus': 'CREATION_IN_PROGRESS'}
+
+    def UpdateAnalysis(self, AwsAccountId, AnalysisId, Name, Definition=None, SourceEntity=None, ThemeArn=None, **kwargs):
+        self._analysis(AnalysisId)
+        self._save_analysis(AnalysisId, Name, Definition, SourceEntity, 'UPDATE', ThemeArn)
+        return {'AnalysisId': AnalysisId, 'Arn': self.arn('analysis', AnalysisId), 'UpdateStatus': 'UPDATE_IN_PROGRESS'}
+
+    def UpdateAnalysisPermissions(self, AwsAccountId, AnalysisId, **kwargs):
+        self._analysis(AnalysisId)
+        return {'AnalysisId': AnalysisId, 'AnalysisArn': self.arn('analysis', AnalysisId), 'Permissions': []}
+
+    def _template(self, TemplateId: str) -> dict:
+        if TemplateId not in self.templates:
+            raise ServiceError(404, 'ResourceNotFoundException')
+        return self.templates[TemplateId]
+
+    def _add_template_version(self, TemplateId, Name, SourceEntity, VersionDescription):
+        template = self.templates.setdefault(TemplateId, {'versions': []})
+        template.update(Name=Name, definition=copy.deepcopy(self._analysis(extract_id(SourceEntity['SourceAnalysis']['Arn']))['Definition']))
+        template['versions'].append({'VersionNumber': len(template['versions']) + 1, 'Description': VersionDescription, 'started_at': time.monotonic()})
+        return {'TemplateId': TemplateId, 'Arn': self.arn('template', TemplateId), 'VersionArn': f"{self.arn('template', TemplateId)}/version/{len(template['versions'])}"}
+
+    def CreateTemplate(self, AwsAccountId, TemplateId, Name=None, SourceEntity=None, VersionDescription=None, **kwargs):
+        if TemplateId in self.templates:
+            raise ServiceError(409, 'ResourceExistsException')
+        return self._add_template_version(TemplateId, Name, SourceEntity, VersionDescription)
+
+    def UpdateTemplate(self, AwsAccountId, TemplateId, Name=None, SourceEntity=None, VersionDescription=None, **kwargs):
+        self._template(TemplateId)
+        return self._add_template_version(TemplateId, Name, SourceEntity, VersionDescription)
+
+    def DescribeTemplate(self, AwsAccountId, TemplateId, VersionNumber=None, **kwargs):
+        template = self._template(TemplateId)
+        version = template['versions'][(VersionNumber or len(template['versions'])) - 1]
+        return {'Template': {
+            'Arn': self.arn('template', TemplateId), 'TemplateId': TemplateId, 'Name': template['Name'],
+            'Version': {'VersionNumber': version['VersionNumber'], 'Description': version['Description'], 'Status': self._status(version['started_at']), 'Errors': []},
+        }}
+
+def extract_id(arn: str) -> str:
+    return arn.split('/', 1)[1]
+
+class _RawBody():
+    def __init__(self, body: bytes) -> None:
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+def attach_backend(client, backend: FakeQuickSight, latency: float):
+    """Answers every request of the client with the backend. The parameters of the call are
+    captured on before-parameter-build, since before-send only sees the serialized request"""
+    calls = threading.local()
+
+    def capture(params, model, **kwargs):
+        calls.current = (model.name, params)
+
+    def send(request, **kwargs):
+        operation, params = calls.current
+        time.sleep(latency)
+        headers = HTTPHeaderDict({'Content-Type': 'application/json'})
+        try:
+            status, body = 200, backend.handle(operation, params)
+        except ServiceError as e:
+            status, body = e.status, {'Message': e.code}
+            headers['x-amzn-ErrorType'] = e.code
+        return AWSResponse(request.url, status, headers, _RawBody(json.dumps(body, default=str).encode('UTF-8')))
+
+    client.meta.events.register('before-parameter-build.quicksight', capture, unique_id='bench-capture')
+    client.meta.events.register('before-send.quicksight', send, unique_id='bench-send')
+
+class MemoryS3():
+    """Fake S3 with the calls the handlers make"""
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.objects = {}
+        self.calls = Counter()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        time.sleep(self.latency)
+        self.calls['PutObject'] += 1
+        current = self.objects.get(Key)
+        if (kwargs.get('IfNoneMatch') == '*' and current) or ('IfMatch' in kwargs and (not current or _etag(current[0]) != kwargs['IfMatch'])):
+            error = Exception(f'PreconditionFailed: {Key}')
+            error.response = {'Error': {'Code': 'PreconditionFailed'}}
+            raise error
+        self.objects[Key] = (Body if isinstance(Body, bytes) else Body.encode('UTF-8'), kwargs.get('ContentEncoding'))
+
+    def get_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        self.calls['GetObject'] += 1
+        if Key not in self.objects:
+            error = Exception(f'NoSuchKey: {Key}')
+            error.response = {'Error': {'Code': 'NoSuchKey'}}
+            raise error
+        body, encoding = self.objects[Key]
+        return {'Body': _BytesBody(body), 'ETag': _etag(body), **({'ContentEncoding': encoding} if encoding else {})}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        self.calls['HeadObject'] += 1
+        if Key not in self.objects:
+            error = Exception(f'404: {Key}')
+            error.response = {'Error': {'Code': '404'}}
+            raise error
+        return {'ContentLength': len(self.objects[Key][0])}
+
+def _etag(body: bytes) -> str:
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+class _BytesBody():
+    def __init__(self, body: bytes) -> None:
+        self.body = body
+
+    def read(self) -> bytes:
+        return self.body
+
+def synthetic_source(backend: FakeQuickSight, datasets: int, join_depth: int, visuals: int):
+    """Seeds the source region with the analysis, its base datasets and join_depth levels of joins over them"""
+    snapshot = synthetic_snapshot(datasets, visuals)
+    datasource = backend.arn('datasource', 'source')
+    for index, dataset in enumerate(snapshot['dataset_definition']):
+        dataset_id = f'base_{index}'
+        backend.datasets[dataset_id] = {**dataset, 'DataSetId': dataset_id, 'Arn': backend.arn('dataset', dataset_id), 'Name': dataset_id}
+        backend.datasets[dataset_id]['PhysicalTableMap']['table']['CustomSql']['DataSourceArn'] = datasource
+
+    declarations = snapshot['analysis_definition']['Definition']['DataSetIdentifierDeclarations']
+    for index, declaration in enumerate(declarations):
+        dataset_id = f'base_{index}'
+        for level in range(1, join_depth + 1):
+            # Each join adds the next base dataset, so the bases are shared between the joins
+            join_id = f'join_{index}_{level}'
+            backend.datasets[join_id] = {
+                'DataSetId': join_id, 'Arn': backend.arn('dataset', join_id), 'Name': join_id, 'PhysicalTableMap': {}, 'ImportMode': 'DIRECT_QUERY',
+                'LogicalTableMap': {
+                    'left': {'Alias': 'left', 'Source': {'DataSetArn': backend.arn('dataset', dataset_id)}},
+                    'right': {'Alias': 'right', 'Source': {'DataSetArn': backend.arn('dataset', f'base_{(index + level) % datasets}')}},
+                    'join': {'Alias': 'Intermediate Table', 'Source': {'JoinInstruction': {'LeftOperand': 'left', 'RightOperand': 'right', 'Type': 'INNER', 'OnClause': 'column_0 = column_0'}}},
+                },
+            }
+            dataset_id = join_id
+        declaration['DataSetArn'] = backend.arn('dataset', dataset_id)
+
+    definition = snapshot['analysis_definition']['Definition']
+    backend.analyses[ANALYSIS_ID] = {'Name': ANALYSIS_ID, 'Definition': definition, 'ThemeArn': None, 'started_at': 0, 'prefix': 'CREATION'}
+
+def run_handler(handler: str, args, datasets: int, join_depth: int, trace: bool = False) -> dict:
+    """Runs the handler once on fresh backends and clients. Returns its outcome, wall time and calls.
+    With trace the peak memory of the handler is measured, the client creation left out"""
+    ratelimit._limiter = ratelimit.RateLimiter({**ratelimit.RATE_LIMITS, **json.loads(args.rate_limits)})
+    clear_clients()
+    backends = {region: FakeQuickSight(region, args.tps, args.build_time) for region in (SOURCE, TARGET)}
+    synthetic_source(backends[SOURCE], datasets, join_depth, args.visuals)
+    if handler in ('template_update', 'analysis_update'):
+        backends[SOURCE]._add_template_version(ANALYSIS_ID, f'{ANALYSIS_ID}_template', {'SourceAnalysis': {'Arn': backends[SOURCE].arn('analysis', ANALYSIS_ID)}}, 'baseline')
+    for region, backend in backends.items():
+        attach_backend(get_client('quicksight', region), backend, args.latency)
+    contexts = {region: {'client': get_client('quicksight', region), 'region': region, 'arn': backends[region].arn('datasource', 'source'), 'theme': None} for region in backends}
+    s3_client = MemoryS3(args.latency)
+    source = contexts[SOURCE]['client']
+
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with request_cache(), request_metrics():
+        if handler == 'migration':
+            result = migrate_analysis_handler(ACCOUNT, ANALYSIS_ID, USER_ARN, contexts[SOURCE], contexts[TARGET], s3_client, 'bench', 'bench')
+        elif handler == 'template_creation':
+            result = create_template_handler(source, ACCOUNT, ANALYSIS_ID, 'benchmark', 'bench@example.com', s3_client, 'bench', 'bench')
+        elif handler == 'template_update':
+            result = update_template_handler(source, ACCOUNT, ANALYSIS_ID, 'benchmark', 'bench@example.com', s3_client, 'bench', 'bench')
+        else:
+            result = update_analysis_handler(source, ACCOUNT, ANALYSIS_ID, '1', USER_ARN)
+        summary = metrics_summary()
+    wall = time.perf_counter() - started
+    peak = 0
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'ok': result == 1,
+        'wall_ms': round(wall * 1000, 1),
+        'quicksight_calls': sum(sum(backend.calls.values()) for backend in backends.values()),
+        's3_calls': sum(s3_client.calls.values()),
+        'throttled': sum(backend.throttled for backend in backends.values()),
+        'retries': sum(call['retries'] for call in summary.get('calls', {}).values()),
+        'datasets': len(backends[SOURCE].datasets),
+        'peak_mb': round(peak / 1024 / 1024, 2),
+    }
+
+def measure(handler: str, args, datasets: int, join_depth: int) -> dict:
+    """Best wall time of --repeat runs, then one more run under tracemalloc for the peak memory"""
+    runs = [run_handler(handler, args, datasets, join_depth) for _ in range(args.repeat)]
+    result = min(runs, key=lambda run: run['wall_ms'])
+    result['peak_mb'] = run_handler(handler, args, datasets, join_depth, trace=True)['peak_mb']
+    return result
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Scenarios that got slower or heavier than threshold, or make more calls, than the baseline"""
+    regressions = []
+    print(f"\n{'scenario':<44}{'wall':>10}{'calls':>10}{'peak':>10}")
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if not previous:
+            continue
+        wall = result['wall_ms'] / max(previous['wall_ms'], 0.1) - 1
+        peak = result['peak_mb'] / max(previous['peak_mb'], 0.01) - 1
+        calls = result['quicksight_calls'] - previous['quicksight_calls']
+        print(f'{name:<44}{wall:>+10.1%}{calls:>+10}{peak:>+10.1%}')
+        if wall > threshold or peak > threshold or calls > 0 or (previous['ok'] and not result['ok']):
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--handlers', default=','.join(HANDLERS), help='comma separated: ' + ', '.join(HANDLERS))
+    parser.add_argument('--datasets', default='5,20,50', help='comma separated dataset counts')
+    parser.add_argument('--join-depth', default='0,2', help='comma separated levels of joins in front of each dataset')
+    parser.add_argument('--visuals', type=int, default=30, help='visuals per sheet')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per api call')
+    parser.add_argument('--tps', type=float, default=0, help='calls per second of each operation before throttling, 0 never throttles')
+    parser.add_argument('--rate-limits', default='{}', help='json overriding the RATE_LIMITS of the client rate limiter, e.g. {"CreateDataSet": 10}')
+    parser.add_argument('--build-time', type=float, default=0, help='seconds analyses and templates stay in progress')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='saves the results to this file')
+    parser.add_argument('--compare', help='results file of a previous version')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as regression')
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'scenario':<44}{'ok':>4}{'wall ms':>10}{'qs calls':>10}{'s3 calls':>10}{'throttled':>10}{'peak MB':>10}")
+    for handler in args.handlers.split(','):
+        for datasets in map(int, args.datasets.split(',')):
+            # Only the migration follows the joins, the other handlers work on the analysis datasets
+            for join_depth in map(int, args.join_depth.split(',') if handler == 'migration' else ['0']):
+                name = f'{handler}/datasets={datasets}/depth={join_depth}'
+                result = results[name] = measure(handler, args, datasets, join_depth)
+                print(f"{name:<44}{'yes' if result['ok'] else 'NO':>4}{result['wall_ms']:>10.1f}{result['quicksight_calls']:>10}{result['s3_calls']:>10}{result['throttled']:>10}{result['peak_mb']:>10.2f}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='UTF-8') as file:
+            json.dump({'commit': git_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'config': vars(args), 'results': results}, file, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='UTF-8') as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print(f"\nRegressions: {', '.join(regressions)}")
+            sys.exit(1)
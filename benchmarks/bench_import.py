@@ -0,0 +1,73 @@
+"""Import time and cold start of the Lambda entry point.
+
+Every measurement runs in a fresh interpreter (like a Lambda cold start) from src/:
+  - `-X importtime` breakdown of `import lambda_function` per top level package, heaviest first
+  - import + first lambda_handler call (TESTE action, no AWS request is made)
+  - import of the web layer, for comparison
+
+    python benchmarks/bench_import.py [--runs N] [--top N] [--json results.json]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from collections import defaultdict
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+ENV = {
+    **os.environ,
+    'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench', 'AWS_ACCOUNT_ID': '123456789012',
+    'DEV_REGION': 'us-east-1', 'PROD_REGION': 'us-west-2', 'LOG_FILE': '',
+}
+COLD_START = '''
+import time
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+lambda_function.lambda_handler({"email": "bench@example.com", "action": "TESTE", "source_region": "us-east-1", "target_region": "us-west-2"}, None)
+print((imported - start) * 1000, (time.perf_counter() - start) * 1000)
+'''
+
+def run(code: str, *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *flags, '-c', code], cwd=SRC, env=ENV, capture_output=True, text=True, check=True)
+
+def importtime(module: str) -> dict[str, int]:
+    """Microseconds spent importing each top level package (sum of the self times of its modules)"""
+    packages = defaultdict(int)
+    for line in run(f'import {module}', '-X', 'importtime').stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, _, name = line.split(':', 1)[1].split('|')
+        packages[name.strip().split('.')[0]] += int(self_time)
+    return dict(packages)
+
+def cold_start(runs: int) -> dict[str, float]:
+    samples = [tuple(map(float, run(COLD_START).stdout.split()[-2:])) for _ in range(runs)]
+    return {
+        'import_ms': statistics.median(sample[0] for sample in samples),
+        'first_invocation_ms': statistics.median(sample[1] for sample in samples),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=12)
+    parser.add_argument('--json', help='saves the results to this file')
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0]}
+    for module in ('lambda_function', 'web'):
+        packages = importtime(module)
+        results[module] = {'total_us': sum(packages.values()), 'packages': packages}
+        print(f'import {module}: {sum(packages.values()) / 1000:.1f} ms')
+        for name, microseconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+            print(f'    {name:<28}{microseconds / 1000:>9.1f} ms')
+    results['cold_start'] = cold_start(args.runs)
+    print(f"\ncold start (median of {args.runs}): import {results['cold_start']['import_ms']:.1f} ms, "
+          f"import + first invocation {results['cold_start']['first_invocation_ms']:.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w', encoding='UTF-8') as file:
+            json.dump(results, file, indent=4)
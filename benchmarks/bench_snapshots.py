@@ -0,0 +1,101 @@
+"""Bytes stored and upload latency of a template snapshot: old temp file path versus
+in-memory put_object with each compression.
+
+Runs offline against a fake S3 that charges a configurable bandwidth per byte, so the
+upload latency is serialization time plus transfer time.
+
+    python benchmarks/bench_snapshots.py [datasets] [visuals] [MB/s]
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from utils.storage import put_snapshot, zstandard
+
+class BandwidthS3():
+    """Fake S3 client whose put_object/upload_file take len(body) / bandwidth seconds"""
+    def __init__(self, megabytes_per_second: float) -> None:
+        self.bytes_per_second = megabytes_per_second * 1024 * 1024
+        self.stored = {}
+
+    def _transfer(self, key: str, body: bytes):
+        time.sleep(len(body) / self.bytes_per_second)
+        self.stored[key] = len(body)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._transfer(Key, Body)
+
+    def upload_file(self, file_path, bucket_name, key):
+        with open(file_path, 'rb') as file:
+            self._transfer(key, file.read())
+
+def synthetic_snapshot(datasets: int, visuals: int) -> dict:
+    dataset_definition = [{
+        'Name': f'dataset_{index}',
+        'DataSetId': f'{index:08d}-0000-0000-0000-000000000000',
+        'PhysicalTableMap': {'table': {'CustomSql': {
+            'DataSourceArn': 'arn:aws:quicksight:us-east-1:123456789012:datasource/source',
+            'Name': f'query_{index}',
+            'SqlQuery': 'SELECT ' + ', '.join(f'column_{column}' for column in range(40)) + f' FROM schema.table_{index}',
+            'Columns': [{'Name': f'column_{column}', 'Type': 'STRING'} for column in range(40)]
+        }}},
+        'LogicalTableMap': {'logical': {'Alias': f'query_{index}', 'Source': {'PhysicalTableId': 'table'}}},
+        'ImportMode': 'DIRECT_QUERY',
+    } for index in range(datasets)]
+    sheets = [{
+        'SheetId': f'sheet_{sheet}',
+        'Name': f'Sheet {sheet}',
+        'Visuals': [{'BarChartVisual': {
+            'VisualId': f'visual_{sheet}_{visual}',
+            'Title': {'Visibility': 'VISIBLE', 'FormatText': {'PlainText': f'Visual {visual}'}},
+            'ChartConfiguration': {'FieldWells': {'BarChartAggregatedFieldWells': {
+                'Category': [{'CategoricalDimensionField': {'FieldId': f'field_{visual}', 'Column': {'DataSetIdentifier': f'dataset_{visual % max(datasets, 1)}', 'ColumnName': f'column_{visual % 40}'}}}],
+                'Values': [{'NumericalMeasureField': {'FieldId': f'value_{visual}', 'Column': {'DataSetIdentifier': f'dataset_{visual % max(datasets, 1)}', 'ColumnName': 'column_0'}, 'AggregationFunction': {'SimpleNumericalAggregation': 'SUM'}}}]
+            }}}
+        }} for visual in range(visuals)]
+    } for sheet in range(5)]
+    return {
+        'author': 'bench@example.com', 'source_region': 'us-east-1', 'template_id': 'bench', 'name': 'bench_template',
+        'date': '01-01-2026 00:00:00', 'version': 1, 'comment': 'benchmark',
+        'analysis_definition': {'Id': 'bench', 'Name': 'bench', 'Definition': {
+            'DataSetIdentifierDeclarations': [{'Identifier': f'dataset_{index}', 'DataSetArn': f'arn:aws:quicksight:us-east-1:123456789012:dataset/{index}'} for index in range(datasets)],
+            'Sheets': sheets
+        }},
+        'dataset_definition': dataset_definition,
+    }
+
+def old_path(s3_client, data: dict):
+    """Previous implementation: indent=4 json temp file, then upload_file"""
+    file_path = os.path.join(tempfile.gettempdir(), 's3_response.json')
+    with open(file_path, 'w', encoding='UTF-8') as file:
+        json.dump(data, file, indent=4, default=str, ensure_ascii=False)
+    s3_client.upload_file(file_path, 'bucket', 'old')
+    os.remove(file_path)
+
+def timed(function, repeat: int = 5) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+if __name__ == '__main__':
+    datasets = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    visuals = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    bandwidth = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    data = synthetic_snapshot(datasets, visuals)
+    s3_client = BandwidthS3(bandwidth)
+
+    print(f'{datasets} datasets, {visuals} visuals per sheet, {bandwidth} MB/s\n')
+    print(f"{'format':<24}{'bytes stored':>14}{'upload ms':>12}")
+    milliseconds = timed(lambda: old_path(s3_client, data))
+    print(f"{'temp file (indent=4)':<24}{s3_client.stored['old']:>14}{milliseconds:>12.1f}")
+    for compression in ('none', 'gzip') + (('zstd',) if zstandard else ()):
+        milliseconds = timed(lambda: put_snapshot(s3_client, 'bucket', compression, data, compression))
+        print(f"{'in memory ' + compression:<24}{s3_client.stored[compression]:>14}{milliseconds:>12.1f}")
+    if not zstandard:
+        print('\nzstd skipped: zstandard is not installed')
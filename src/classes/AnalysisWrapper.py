@@ -106,31 +106,32 @@ class AWSAnalysis(AWSClient):
             self._logger.info('Analysis Created With Success')
             return 1
 
-    def list_analysis(self, next_token=None, analyses=[]):
-        """Recursion to list all the analysis in a region"""
-        try:
-            if next_token:
-                response = self._client.list_analyses(AwsAccountId=self.acc_id, NextToken=next_token)
-            else:
-                response = self._client.list_analyses(AwsAccountId=self.acc_id)
-
-            for analysis in response['AnalysisSummaryList']:
-                analyses.append({
+    def iter_analyses(self, status: str = None):
+        """Streams the analysis summaries of the region page by page
+        Args:
+            status (str): when given, only the analyses with this Status are yielded
+        Yields:
+            dict: Id, Name, Arn, Status, CreatedTime
+        """
+        for page in self._client.get_paginator('list_analyses').paginate(AwsAccountId=self._acc_id):
+            for analysis in page['AnalysisSummaryList']:
+                if status and analysis['Status'] != status:
+                    continue
+                yield {
                     'Id': analysis['AnalysisId'],
                     'Name': analysis['Name'],
                     'Arn': analysis['Arn'],
                     'Status': analysis['Status'],
                     'CreatedTime': analysis['CreatedTime']
-                })
-
-            next_token = response.get('NextToken')
-            if next_token:
-                return self.list_analysis(next_token, analyses)
+                }
 
+    def list_analysis(self, status: str = None) -> list[dict[str]]:
+        """Lists all the analysis in the region"""
+        try:
+            return list(self.iter_analyses(status))
         except Exception as e:
             self._logger.error(f"An error occurred in the list_analysis function.\nError: {e}")
-            
-        return analyses
+            return []
 
     def list_deleted_analysis(self) -> list[dict[str]]:
         """Filter the Analysis whose status is equal to DELETED
@@ -138,9 +139,7 @@ class AWSAnalysis(AWSClient):
             list[dict[str]]: Id, Name, Arn, Status 
         """
         try:    
-            analysis_list = self.list_analysis(self.client, self.acc_id)
-            data = [analysis for analysis in analysis_list if analysis['Status'] == 'DELETED']
-            return data
+            return list(self.iter_analyses('DELETED'))
         except Exception as e:
             self._logger.error(f"An error ocurred in list_deleted_analysis function.\n Error: {e}")
 
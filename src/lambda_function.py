@@ -1,16 +1,25 @@
 import os
-import boto3
-from mangum import Mangum
-from typing import Optional
+import json
 from utils.handlers import *
-from fastapi.responses import HTMLResponse
-from fastapi import FastAPI, Form, HTTPException, Request
-from fastapi.staticfiles import StaticFiles
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.templating import Jinja2Templates
+from utils.clients import get_client
+from utils.cache import request_cache
+from utils.logs import request_logs
+from utils.metrics import request_metrics
+from utils.responses import offload_response
+from utils.idempotency import IDEMPOTENCY_ENABLED, run_once
+from utils.manifest import rebuild_manifests
+from utils.jobs import is_job_invocation, run_job
 
-from dotenv import load_dotenv
-load_dotenv("env/.env")
+# This module is the Lambda entry point and only imports boto3 and the actions. The web
+# interface (FastAPI, Jinja2, Mangum) lives in web.py and is imported on first use of
+# lambda_function.app / lambda_function.handler, so `uvicorn lambda_function:app` still works.
+def _load_env(path: str = "env/.env"):
+    """Loads the local .env file. python-dotenv is only imported when the file exists"""
+    if os.path.exists(path):
+        from dotenv import load_dotenv
+        load_dotenv(path)
+
+_load_env()
 
 AWS_ACCOUNT_ID = os.environ.get('AWS_ACCOUNT_ID')
 THEME_ARN_PROD = os.environ.get('THEME_ARN_PROD')
@@ -20,6 +29,60 @@ DEV_REGION = os.environ.get('DEV_REGION')
 PROD_ARN = os.environ.get('PROD_ARN')
 DEV_ARN = os.environ.get('DEV_ARN')
 BUCKET = os.environ.get('BUCKET')
+ALL_REGIONS = 'ALL'
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+EXTRA_REGIONS = [region.strip() for region in os.environ.get('EXTRA_REGIONS', '').split(',') if region.strip()]
+
+def _region_env(prefix: str, region: str):
+    return os.environ.get(f"{prefix}_{region.upper().replace('-', '_')}")
+
+def _region_config() -> dict:
+    """REGIONS_CONFIG: json, or the path of a json file, like {"sa-east-1": {"datasource": "arn:...", "theme": "arn:..."}}"""
+    config = os.environ.get('REGIONS_CONFIG', '').strip()
+    if config and not config.startswith('{'):
+        with open(config) as file:
+            config = file.read()
+    return {
+        region: {"arn": values.get('datasource', values.get('arn')), "theme": values.get('theme')}
+        for region, values in json.loads(config or '{}').items()
+    }
+
+# Static information of every region the lambda works with. Extra regions read their
+# datasource and theme ARNs from ARN_<REGION> and THEME_ARN_<REGION>, e.g. ARN_SA_EAST_1,
+# and REGIONS_CONFIG overrides any of them
+REGIONS = {region: {"arn": _region_env('ARN', region), "theme": _region_env('THEME_ARN', region)} for region in EXTRA_REGIONS}
+REGIONS.update({
+    DEV_REGION: {"arn": DEV_ARN, "theme": THEME_ARN_DEV},
+    PROD_REGION: {"arn": PROD_ARN, "theme": THEME_ARN_PROD},
+})
+REGIONS.update(_region_config())
+REGIONS.pop(None, None)
+
+def region_context(region: str) -> dict:
+    """Returns the client map entry of a region with its shared quicksight client."""
+    if region not in REGIONS:
+        raise KeyError(f"Region {region} is not configured")
+    return {"client": get_client('quicksight', region), "region": region, **REGIONS[region]}
+
+def parse_regions(value, source: str = None) -> list[str]:
+    """Target regions of an event: a region, a list or comma separated regions, or ALL for every configured region but the source"""
+    if value == ALL_REGIONS:
+        return [region for region in REGIONS if region != source]
+    regions = value if isinstance(value, list) else str(value or '').split(',')
+    return list(dict.fromkeys(region.strip() for region in regions if region and region.strip()))
+
+def parse_principals(value, level: str = None) -> dict[str, str]:
+    """Principals of PERMISSION_SYNC: a dict (or its json) of email/ARN -> level, or a list or comma separated
+    emails/ARNs that all get the same level (viewer by default)"""
+    if isinstance(value, str) and value.strip().startswith('{'):
+        value = json.loads(value)
+    if isinstance(value, dict):
+        return {principal.strip(): str(principal_level).lower() for principal, principal_level in value.items()}
+    return {principal: (level or 'viewer').lower() for principal in parse_analysis_ids(value)}
+
+def is_enabled(value) -> bool:
+    """Event flags may come as bool or as the text of a form field"""
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
 
 ACTIONS = {
     'TESTE': "Oi",
@@ -27,64 +90,62 @@ ACTIONS = {
     "TEMPLATE_CREATION": create_template_handler,
     "ANALYSIS_UPDATE": update_analysis_handler,
     "TEMPLATE_UPDATE": update_template_handler,
-    "MIGRATION": migrate_analysis_handler,
+    "MIGRATION": bulk_migrate_analysis_handler,
     "RESTORE_ANALYSIS": restore_analysis,
+    "REBUILD_MANIFESTS": rebuild_manifests,
+    "BACKUP_ALL": backup_all_handler,
+    "PERMISSION_SYNC": permission_sync_handler,
+    "DATASET_DEPENDENTS": dataset_dependents_handler,
 }
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
-handler = Mangum(app)
-templates = Jinja2Templates(directory="templates")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"], 
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-@app.get("/", response_class=HTMLResponse)
-async def show_form(request:Request):
-    try:
-        return templates.TemplateResponse(
-            'form.html', 
-            {"request":request, "ACTIONS": ACTIONS}
-        )
-    except Exception as e:
-        return templates.TemplateResponse('error.html', {"request":request,"error":e,"error_type":type(e).__name__})
-
-@app.post("/submit", response_class=HTMLResponse)
-async def submit_form(
-    request: Request,
-    email: str = Form(...), 
-    analysis_id: Optional[str] = Form(None),
-    stakeholder: Optional[str] = Form(None),
-    action: str = Form(...), 
-    source_region: str = Form(...),
-    target_region: str = Form(...),
-    version: Optional[str] = Form(None),
-    comment: Optional[str] = Form(None),
-):
-    try:
-        event = {
-            "email": email,
-            "analysis_id": analysis_id,
-            "stakeholder": stakeholder,
-            "action": action,
-            "target_region": target_region,
-            "source_region": source_region,
-            "version": version,
-            "comment": comment,
-        }
-        return templates.TemplateResponse(
-            'response.html', 
-            {"request": request, "response": json.dumps(lambda_handler(event, None), indent=4, ensure_ascii=False)}
-        )
-    except Exception as e:
-        return templates.TemplateResponse('error.html', {"request":request,"error":e,"error_type":type(e).__name__})
+# Only these actions use the user ARN, the others skip the user lookup
+USER_ARN_ACTIONS = {"ANALYSIS_UPDATE", "MIGRATION"}
+# Actions that change something: a repeated event (double click, API Gateway retry) joins the
+# execution still running or gets its response back instead of running again
+IDEMPOTENT_ACTIONS = {"MIGRATION", "TEMPLATE_CREATION", "TEMPLATE_UPDATE", "ANALYSIS_UPDATE", "RESTORE_ANALYSIS", "REBUILD_MANIFESTS", "BACKUP_ALL", "PERMISSION_SYNC"}
+
+def idempotency_key(event: dict) -> str:
+    """Key of a mutating event: the action and every parameter, with the analysis ids and regions in a canonical
+    order, so the same request always has the same key. An idempotency_key field in the event is used instead.
+    None for the actions that are not idempotent"""
+    action = str(event.get('action', '')).upper()
+    if not IDEMPOTENCY_ENABLED or action not in IDEMPOTENT_ACTIONS:
+        return None
+    if event.get('idempotency_key'):
+        return f"{action}:{event['idempotency_key']}"
+    request = {key: value for key, value in event.items() if value not in (None, '', False) and key != 'idempotency_key'}
+    request.update({
+        'action': action,
+        'email': str(event.get('email', '')).lower(),
+        'analysis_id': sorted(parse_analysis_ids(event.get('analysis_id'))),
+        'target_region': sorted(parse_regions(event.get('target_region'), event.get('source_region'))),
+        'version': str(event.get('version') or ''),
+    })
+    return f'{action}:{fingerprint(request)[:32]}'
+
+def run_idempotent(event: dict, function):
+    """Runs function() once per idempotency_key, see utils.idempotency.run_once. Only successful responses are replayed,
+    and a duplicate of a request running in another instance gets statusCode IN_PROGRESS"""
+    key = idempotency_key(event)
+    if key is None:
+        return function()
+    response, outcome = run_once(key, function, cacheable=lambda response: isinstance(response, dict) and response.get('status') == 'SUCCESS')
+    if outcome == 'IN_PROGRESS':
+        # Running in another instance: answered at once (409 on /api) instead of holding this request until it ends
+        response = {**return_json_message("An identical request is still running, try again later", event.get('email', "")), "statusCode": "IN_PROGRESS"}
+    if isinstance(response, dict):
+        response['idempotency'] = {'key': key, 'outcome': outcome}
+    return response
 
 def lambda_handler(event: dict[str,str], context):
+    """Lambda entry point. Repeated mutating events run only once (see run_idempotent), and responses bigger
+    than RESPONSE_MAX_BYTES are saved in the S3 and replaced by a presigned url, see handle_event"""
+    if is_job_invocation(event):
+        # Asynchronous invocation started by submit_job, runs the job event here and saves its result in the job store
+        return run_job(event['job_id'], lambda_handler, event['job_event'], context)
+    return offload_response(run_idempotent(event, lambda: handle_event(event, context)), get_client('s3'), BUCKET)
+
+def handle_event(event: dict[str,str], context):
     """Function that handles all the lambda api
 
     Args:
@@ -94,56 +155,126 @@ def lambda_handler(event: dict[str,str], context):
     Returns:
         dict: Dict with response field
     """
-    try:
-        required_params = ['email', 'source_region', 'action']
-        for param in required_params:
-            if not event.get(param):
-                logger.critical(f"Missing required event parameter: {param}.")
-                return return_json_message(f"Missing required event parameters: {', '.join(required_params)}", event.get('email',""))
-
-        action = event['action'].upper()
-        source = event['source_region']
-        target = event['target_region']
-        email = event['email']
-        analysis_id = event.get('analysis_id')
-        version = event.get('version')
-        comment = event.get('comment')
-        stakeholder = event.get('stakeholder')
-        bucket = BUCKET
-
-        prod_client = boto3.client('quicksight', region_name=PROD_REGION)
-        dev_client = boto3.client('quicksight', region_name=DEV_REGION)
-        s3_client = boto3.client('s3')
-
-        client_map = {
-            DEV_REGION: {"client": dev_client, "arn": DEV_ARN, "theme": THEME_ARN_DEV, "region": DEV_REGION},
-            PROD_REGION: {"client": prod_client, "arn": PROD_ARN, "theme": THEME_ARN_PROD, 'region': PROD_REGION}
-        }
-
-        source_client = client_map[source]
-        target_client = client_map[target]
-        user_arn = search_user(prod_client, AWS_ACCOUNT_ID, email)
-        print(action)
-        if action not in ACTIONS:
-            logger.critical(f"Invalid action: {action}.")
-            return return_json_message(f"Invalid action: {action}", email)
-
-        logger.info(f"Starting {action.replace('_', ' ').title()}")
+    with request_cache(), request_logs(), request_metrics({'Action': str(event.get('action', '')).upper()}):
+        try:
+            required_params = ['email', 'source_region', 'action']
+            for param in required_params:
+                if not event.get(param):
+                    logger.critical(f"Missing required event parameter: {param}.")
+                    return return_json_message(f"Missing required event parameters: {', '.join(required_params)}", event.get('email',""))
+
+            action = event['action'].upper()
+            source = event['source_region']
+            target = event.get('target_region')
+            email = event['email']
+            analysis_id = event.get('analysis_id')
+            version = event.get('version')
+            comment = event.get('comment')
+            stakeholder = event.get('stakeholder')
+            bucket = BUCKET
+
+            s3_client = get_client('s3')
+
+            # LIST_DELETED_ANALYSIS accepts ALL as source to scan every configured region
+            source_client = region_context(source) if source != ALL_REGIONS else None
+            targets = parse_regions(target, source)
+            target_client = region_context(targets[0]) if len(targets) == 1 else None
+            if action == "MIGRATION" and (not targets or source in targets):
+                # The source region is never used as a target, migrating into it would rewrite the source datasets
+                logger.critical(f"Invalid target_region for MIGRATION: {target}.")
+                return return_json_message("MIGRATION requires a target_region different from the source_region", email)
+            user_arn = search_user(get_client('quicksight', PROD_REGION), AWS_ACCOUNT_ID, email) if action in USER_ARN_ACTIONS else None
+            print(action)
+            if action not in ACTIONS:
+                logger.critical(f"Invalid action: {action}.")
+                return return_json_message(f"Invalid action: {action}", email)
+
+            logger.info(f"Starting {action.replace('_', ' ').title()}")
         
-        if action == "LIST_DELETED_ANALYSIS":
-            del_analysis_list = ACTIONS[action](source_client['client'], AWS_ACCOUNT_ID)
-            return del_analysis_list if del_analysis_list else return_log_message(action, email, source)
+            if action == "LIST_DELETED_ANALYSIS":
+                if event.get('page_size') or event.get('cursor'):
+                    # Paginated: a single page is read, next_cursor goes back in the next event
+                    regions = list(REGIONS) if source == ALL_REGIONS else [source]
+                    return page_analyses([region_context(region)['client'] for region in regions], AWS_ACCOUNT_ID, 'DELETED', int(event.get('page_size') or DEFAULT_PAGE_SIZE), event.get('cursor'))
+                if source == ALL_REGIONS:
+                    del_analysis_list = list_deleted_analysis_regions([region_context(region)['client'] for region in REGIONS], AWS_ACCOUNT_ID)
+                else:
+                    del_analysis_list = ACTIONS[action](source_client['client'], AWS_ACCOUNT_ID)
+                return del_analysis_list if del_analysis_list else return_log_message(action, email, source)
         
-        elif action == "MIGRATION":
-            result = ACTIONS[action](AWS_ACCOUNT_ID, analysis_id, user_arn, source_client, target_client, s3_client, bucket, stakeholder)
+            elif action == "MIGRATION" and len(targets) > 1:
+                # Several target regions: the source is read once and every region is migrated concurrently
+                reports = fan_out_migrate_analysis_handler(AWS_ACCOUNT_ID, parse_analysis_ids(analysis_id), user_arn, source_client, [region_context(region) for region in targets], s3_client, bucket, stakeholder)
+                result = 1 if reports and all(status['status'] == 'SUCCESS' for report in reports.values() for status in report.values()) else 0
+                return return_log_message(action, email, source, target, result, analysis_id, comment, reports)
+
+            elif action == "MIGRATION":
+                # analysis_id may carry several ids, the shared datasets are migrated only once
+                report = ACTIONS[action](AWS_ACCOUNT_ID, parse_analysis_ids(analysis_id), user_arn, source_client, target_client, s3_client, bucket, stakeholder)
+                result = 1 if report and all(status['status'] == 'SUCCESS' for status in report.values()) else 0
+                return return_log_message(action, email, source, target, result, analysis_id, comment, report)
+
+            elif action == "BACKUP_ALL":
+                # Stops starting new analyses before the Lambda times out, the next call resumes from the checkpoint
+                remaining_time = (lambda: context.get_remaining_time_in_millis() / 1000) if hasattr(context, 'get_remaining_time_in_millis') else None
+                report = ACTIONS[action](source_client['client'], AWS_ACCOUNT_ID, comment, email, s3_client, bucket, stakeholder, event.get('folder_id'), event.get('name_prefix'), remaining_time)
+                result = 1 if report['status'] == 'COMPLETE' and not report['failed'] else 0
+                return return_log_message(action, email, source, target, result, analysis_id, comment, report)
+
+            elif action == "PERMISSION_SYNC":
+                # Only the grants and revokes that differ from the current permissions are applied
+                report = ACTIONS[action](
+                    source_client['client'], AWS_ACCOUNT_ID, parse_principals(event.get('principals'), event.get('level')),
+                    parse_analysis_ids(analysis_id), parse_analysis_ids(event.get('dataset_id')), get_client('quicksight', PROD_REGION),
+                    is_enabled(event.get('include_datasets')), is_enabled(event.get('dry_run'))
+                )
+                result = 0 if report['failed'] else 1
+                return return_log_message(action, email, source, target, result, analysis_id, comment, report)
+
+            elif action == "DATASET_DEPENDENTS":
+                # Answered from the dependency index of the source region, refreshed incrementally when old
+                report = ACTIONS[action](source_client['client'], AWS_ACCOUNT_ID, parse_analysis_ids(event.get('dataset_id')), s3_client, bucket, is_enabled(event.get('refresh')))
+                return return_log_message(action, email, source, target, 1, analysis_id, comment, report)
 
-        elif action == 'TESTE':
-            result = ACTIONS.get(action)
-        else:
-            result = ACTIONS[action](source_client['client'], AWS_ACCOUNT_ID, analysis_id, comment, email, s3_client, bucket, stakeholder) if "TEMPLATE" in action else ACTIONS[action](source_client['client'], AWS_ACCOUNT_ID, analysis_id, version, user_arn)
+            elif action == "REBUILD_MANIFESTS":
+                result = 1 if ACTIONS[action](s3_client, bucket, stakeholder) is not None else 0
+
+            elif action == "ANALYSIS_UPDATE" and is_enabled(event.get('from_snapshot')):
+                # Fast path: rebuilds the analysis from the definition saved in the S3
+                result = update_analysis_from_snapshot_handler(source_client['client'], AWS_ACCOUNT_ID, analysis_id, version, user_arn, s3_client, bucket, stakeholder, event.get('as_of'))
+
+            elif action == 'TESTE':
+                result = ACTIONS.get(action)
+            else:
+                result = ACTIONS[action](source_client['client'], AWS_ACCOUNT_ID, analysis_id, comment, email, s3_client, bucket, stakeholder) if "TEMPLATE" in action else ACTIONS[action](source_client['client'], AWS_ACCOUNT_ID, analysis_id, version, user_arn)
+
+            return return_log_message(action, email, source, target, result, analysis_id, comment)
+
+        except Exception as e:
+            logger.error(f"Error occurred: {e}", exc_info=True)
+            from fastapi import HTTPException
+            raise HTTPException(status_code=404, detail={'Error': type(e).__name__, "Error Message": str(e)})
+
+def stream_event(emit, event: dict[str,str]):
+    """Streamed version of handle_event, run by utils.responses.stream_ndjson. LIST_DELETED_ANALYSIS emits each
+    analysis as its page is read; the other actions stream their log lines and end with the response"""
+    if str(event.get('action', '')).upper() == "LIST_DELETED_ANALYSIS" and event.get('email') and event.get('source_region'):
+        source = event['source_region']
+        with request_cache(), request_metrics({'Action': 'LIST_DELETED_ANALYSIS'}):
+            count = 0
+            for region in (list(REGIONS) if source == ALL_REGIONS else [source]):
+                for analysis in iter_analyses(region_context(region)['client'], AWS_ACCOUNT_ID, 'DELETED'):
+                    emit({**analysis, 'Region': region})
+                    count += 1
+            return {"statusCode": "SUCCESS", "count": count, "metrics": metrics_summary()}
 
-        return return_log_message(action, email, source, target, result, analysis_id, comment)
+    response = run_idempotent(event, lambda: handle_event(event, None))
+    if isinstance(response, dict) and response.get('idempotency', {}).get('outcome', 'EXECUTED') == 'EXECUTED':
+        response.pop('logs', None) # already streamed
+    return response
 
-    except Exception as e:
-        logger.error(f"Error occurred: {e}", exc_info=True)
-        raise HTTPException(status_code=404, detail={'Error': type(e).__name__, "Error Message": str(e)})
\ No newline at end of file
+def __getattr__(name: str):
+    if name in ('app', 'handler'):
+        import web
+        return getattr(web, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
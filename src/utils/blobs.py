@@ -0,0 +1,188 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.storage import compress, deserialize_snapshot, put_snapshot, read_snapshot, is_not_found
+from utils.manifest import SNAPSHOT_PREFIX, BLOB_FOLDER
+
+logger = logging.getLogger(__name__)
+
+# blobs | full. full keeps writing the whole snapshot in a single object, as before
+SNAPSHOT_FORMAT = os.environ.get('SNAPSHOT_FORMAT', 'blobs')
+SNAPSHOT_MAX_WORKERS = int(os.environ.get('SNAPSHOT_MAX_WORKERS', 8))
+
+# A blob snapshot keeps the metadata of the snapshot and replaces the analysis definition sections,
+# each sheet and each dataset by a reference to a content addressed blob, shared by every version
+# and analysis that has the same content:
+#   quicksight_templates/_blobs/<sha256[:2]>/<sha256>.json
+#   {"format": "blobs/1", "author", ..., "analysis_definition": {"Id", "Name", "ThemeArn",
+#    "Definition": {"Sheets": [{"$blob": <sha256>}, ...], <section>: {"$blob": <sha256>}}},
+#    "dataset_definition": [{"$blob": <sha256>}, ...]}
+# Blobs are never deleted, so a blob referenced by a stored snapshot is known to exist.
+BLOB_FORMAT = 'blobs/1'
+REF = '$blob'
+
+_known_blobs = set()
+_known_lock = threading.Lock()
+
+def canonical_json(value) -> bytes:
+    """Json with sorted keys, so the same content always has the same hash"""
+    return json.dumps(value, default=str, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('UTF-8')
+
+def blob_key(digest: str) -> str:
+    return f'{SNAPSHOT_PREFIX}/{BLOB_FOLDER}/{digest[:2]}/{digest}.json'
+
+def is_blob_snapshot(data: dict) -> bool:
+    return isinstance(data, dict) and data.get('format') == BLOB_FORMAT
+
+def split_snapshot(data: dict) -> tuple[dict, dict[str, bytes]]:
+    """Splits a snapshot made by create_metadata in its small manifest and the blobs it references
+
+    Returns:
+        tuple[dict, dict[str, bytes]]: snapshot with references and sha256 -> canonical json of each blob
+    """
+    blobs = {}
+
+    def reference(value) -> dict:
+        raw = canonical_json(value)
+        digest = hashlib.sha256(raw).hexdigest()
+        blobs[digest] = raw
+        return {REF: digest}
+
+    snapshot = {key: value for key, value in data.items() if key not in ('analysis_definition', 'dataset_definition')}
+    snapshot['format'] = BLOB_FORMAT
+
+    analysis_definition = dict(data.get('analysis_definition') or {})
+    if isinstance(analysis_definition.get('Definition'), dict):
+        analysis_definition['Definition'] = {
+            # Sheets change one at a time, so each one is a blob of its own
+            section: [reference(sheet) for sheet in value] if section == 'Sheets' and isinstance(value, list) else reference(value)
+            for section, value in analysis_definition['Definition'].items()
+        }
+    snapshot['analysis_definition'] = analysis_definition
+    snapshot['dataset_definition'] = [reference(dataset) if dataset is not None else None for dataset in data.get('dataset_definition') or []]
+    return snapshot, blobs
+
+def blob_refs(value) -> list[str]:
+    """Hashes of the blobs referenced anywhere inside value, in order and without repetitions"""
+    refs = []
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            if len(item) == 1 and REF in item:
+                refs.append(item[REF])
+            else:
+                stack.extend(reversed(list(item.values())))
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+    return list(dict.fromkeys(refs))
+
+def _resolve(value, blobs: dict):
+    if isinstance(value, dict):
+        if len(value) == 1 and REF in value:
+            return blobs[value[REF]]
+        return {key: _resolve(item, blobs) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve(item, blobs) for item in value]
+    return value
+
+def blob_exists(s3_client, bucket_name: str, digest: str) -> bool:
+    if (bucket_name, digest) in _known_blobs:
+        return True
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=blob_key(digest))
+    except Exception as e:
+        if not is_not_found(e):
+            raise
+        return False
+    with _known_lock:
+        _known_blobs.add((bucket_name, digest))
+    return True
+
+def put_blobs(s3_client, bucket_name: str, blobs: dict[str, bytes], known: set = None) -> dict:
+    """Uploads the blobs that are not stored yet. The ones in known (referenced by a stored snapshot)
+    or already seen by this process are skipped without a request, the others are checked with a HEAD
+
+    Returns:
+        dict: number of blobs uploaded and reused and the bytes uploaded
+    """
+    known = known or set()
+    stats = {'uploaded': 0, 'reused': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    def upload(digest: str):
+        if digest in known or blob_exists(s3_client, bucket_name, digest):
+            with lock:
+                stats['reused'] += 1
+            return
+        body, encoding = compress(blobs[digest])
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=blob_key(digest),
+            Body=body,
+            ContentType='application/json',
+            **({'ContentEncoding': encoding} if encoding else {})
+        )
+        with _known_lock:
+            _known_blobs.add((bucket_name, digest))
+        with lock:
+            stats['uploaded'] += 1
+            stats['bytes'] += len(body)
+
+    with ThreadPoolExecutor(max_workers=SNAPSHOT_MAX_WORKERS) as executor:
+        list(executor.map(upload, blobs))
+    return stats
+
+def put_blob_snapshot(s3_client, bucket_name: str, key: str, data: dict, metadata: dict = None, known: set = None) -> dict:
+    """Uploads the missing blobs of the snapshot and then its manifest at key. The manifest goes last,
+    so a stored manifest never references a blob that is not there
+
+    Returns:
+        dict: the put_snapshot result of the manifest plus the format and the blob upload stats
+    """
+    snapshot, blobs = split_snapshot(data)
+    stats = put_blobs(s3_client, bucket_name, blobs, known)
+    stored = put_snapshot(s3_client, bucket_name, key, snapshot, metadata=metadata)
+    logger.info(f"Snapshot {key}: {stats['uploaded']} blobs uploaded ({stats['bytes']} bytes), {stats['reused']} reused")
+    return {**stored, 'format': BLOB_FORMAT, 'blobs': stats}
+
+def read_blobs(s3_client, bucket_name: str, digests: list[str]) -> dict:
+    """Downloads the blobs in parallel, returning sha256 -> content"""
+    def read(digest: str):
+        response = s3_client.get_object(Bucket=bucket_name, Key=blob_key(digest))
+        return deserialize_snapshot(response['Body'].read(), response.get('ContentEncoding'))
+
+    with ThreadPoolExecutor(max_workers=SNAPSHOT_MAX_WORKERS) as executor:
+        return dict(zip(digests, executor.map(read, digests)))
+
+def assemble_snapshot(s3_client, bucket_name: str, data: dict, sections: tuple = None) -> dict:
+    """Replaces the blob references of a snapshot by their content. Old full snapshots are returned as they are
+
+    Args:
+        data (dict): snapshot read from the bucket
+        sections (tuple): only assemble these keys, e.g. ('analysis_definition',). None assembles everything
+    """
+    if not is_blob_snapshot(data):
+        return data
+    keys = [key for key in data if sections is None or key in sections]
+    blobs = read_blobs(s3_client, bucket_name, blob_refs([data[key] for key in keys]))
+    assembled = {key: _resolve(data[key], blobs) if key in keys else value for key, value in data.items()}
+    if sections is None:
+        assembled.pop('format')
+    return assembled
+
+def load_snapshot(s3_client, bucket_name: str, key: str, sections: tuple = None) -> dict:
+    """Reads a snapshot of any format and puts it back together, see assemble_snapshot"""
+    return assemble_snapshot(s3_client, bucket_name, read_snapshot(s3_client, bucket_name, key), sections)
+
+def stored_blobs(s3_client, bucket_name: str, key: str) -> set:
+    """Blobs referenced by a stored snapshot, empty when it is not a blob snapshot or can't be read"""
+    try:
+        data = read_snapshot(s3_client, bucket_name, key)
+    except Exception as e:
+        logger.warning(f'Could not read the previous snapshot {key}, its blobs will be checked one by one: {e}')
+        return set()
+    return set(blob_refs(data)) if is_blob_snapshot(data) else set()
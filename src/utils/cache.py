@@ -0,0 +1,127 @@
+import os
+import copy
+import time
+import inspect
+import threading
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Describe results live for the whole request by default. DESCRIBE_CACHE_TTL > 0 also
+# keeps them in the warm process between requests. Not found results (None or 0) are
+# only kept for DESCRIBE_NEGATIVE_TTL seconds. Other failures are never kept, see Uncached.
+DESCRIBE_CACHE_TTL = float(os.environ.get('DESCRIBE_CACHE_TTL', 0))
+DESCRIBE_NEGATIVE_TTL = float(os.environ.get('DESCRIBE_NEGATIVE_TTL', 30))
+
+class Uncached():
+    """Result a describe function returns when it failed for a reason other than the resource not existing
+    (throttling, open circuit, network). cached_describe returns its value without keeping it, so the
+    next call asks again instead of taking the resource as missing."""
+    def __init__(self, value=None) -> None:
+        self.value = value
+
+class DescribeCache():
+    def __init__(self, ttl: float = None) -> None:
+        """Thread safe store of describe results
+        Args:
+            ttl (float): seconds an entry is kept. None keeps it until the cache is dropped
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return False, None
+            return True, value
+
+    def set(self, key: tuple, value):
+        ttl = self.ttl
+        if not value:
+            ttl = DESCRIBE_NEGATIVE_TTL if ttl is None else min(ttl, DESCRIBE_NEGATIVE_TTL)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+
+    def invalidate(self, name: str, region: str = None, resource_id: str = None):
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == name and (region is None or key[1] == region) and (resource_id is None or resource_id in key[2]):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_request_cache: ContextVar[DescribeCache] = ContextVar('describe_request_cache', default=None)
+_process_cache = DescribeCache(DESCRIBE_CACHE_TTL) if DESCRIBE_CACHE_TTL > 0 else None
+
+@contextmanager
+def request_cache():
+    """Opens the describe cache of a request. Everything called inside it shares the results."""
+    token = _request_cache.set(DescribeCache())
+    try:
+        yield _request_cache.get()
+    finally:
+        _request_cache.reset(token)
+
+def cache_stats() -> dict:
+    """Hit and miss counts of the current request."""
+    cache = _request_cache.get()
+    if cache is None:
+        return {'hits': 0, 'misses': 0}
+    return {'hits': cache.hits, 'misses': cache.misses}
+
+def _caches() -> list[DescribeCache]:
+    return [cache for cache in (_request_cache.get(), _process_cache) if cache is not None]
+
+def invalidate(name: str, region: str = None, resource_id: str = None):
+    """Drops the cached results of a describe function, e.g. after the resource was changed
+
+    Args:
+        name (str): describe function name, e.g. describe_dataset
+        region (str): only drop the results of this region
+        resource_id (str): only drop the results of this resource
+    """
+    for cache in _caches():
+        cache.invalidate(name, region, resource_id)
+
+def cached_describe(function):
+    """Caches a describe function whose first argument is the quicksight client.
+    The results are deep copied, since the handlers change the dicts they receive."""
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(client, *args, **kwargs):
+        caches = _caches()
+        if not caches:
+            value = function(client, *args, **kwargs)
+            return value.value if isinstance(value, Uncached) else value
+
+        arguments = signature.bind(client, *args, **kwargs)
+        arguments.apply_defaults()
+        params = tuple(str(value) for name, value in arguments.arguments.items() if name != 'client')
+        key = (function.__name__, client.meta.region_name, params)
+
+        for cache in caches:
+            found, value = cache.get(key)
+            if found:
+                caches[0].hits += 1
+                return copy.deepcopy(value)
+
+        caches[0].misses += 1
+        value = function(client, *args, **kwargs)
+        if isinstance(value, Uncached):
+            return value.value
+        for cache in caches:
+            cache.set(key, copy.deepcopy(value))
+        return value
+
+    return wrapper
@@ -0,0 +1,77 @@
+import json
+import time
+import logging
+import threading
+from utils.storage import encode_json, is_not_found
+from utils.manifest import stakeholder_prefix
+
+logger = logging.getLogger(__name__)
+
+# Long runs (e.g. BACKUP_ALL) keep their progress in the bucket, so the next invocation continues
+# where the previous one stopped when the Lambda ran out of time:
+#   quicksight_templates/<STAKEHOLDER>/_checkpoints/<name>.json
+#   {"name", "status": RUNNING | COMPLETE, "items": [...], "results": {item: result}, "started_at", "updated_at", ...}
+
+def checkpoint_key(stakeholder: str, name: str) -> str:
+    return f'{stakeholder_prefix(stakeholder)}/_checkpoints/{name}.json'
+
+def read_checkpoint(s3_client, bucket_name: str, key: str) -> dict:
+    """Returns the saved checkpoint, None if there is none"""
+    try:
+        return json.loads(s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+    except Exception as e:
+        if not is_not_found(e):
+            raise
+        return None
+
+class Checkpoint():
+    def __init__(self, s3_client, bucket_name: str, key: str, state: dict) -> None:
+        """Progress of a run saved after every finished item. Thread safe, so the workers record their own results"""
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.state = state
+        self._lock = threading.Lock()
+
+    @classmethod
+    def resume(cls, s3_client, bucket_name: str, key: str, start) -> 'Checkpoint':
+        """Loads the unfinished run saved at key, or starts a new one from start() when there is none
+
+        Args:
+            start (callable): returns the fields of a new run, its items included
+        """
+        state = read_checkpoint(s3_client, bucket_name, key)
+        if state and state.get('status') != 'COMPLETE':
+            logger.info(f"Resuming {key}: {len(state['results'])} of {len(state['items'])} items already done")
+        else:
+            state = {**start(), 'status': 'RUNNING', 'results': {}, 'started_at': time.time()}
+        checkpoint = cls(s3_client, bucket_name, key, state)
+        checkpoint.save()
+        return checkpoint
+
+    @property
+    def pending(self) -> list:
+        with self._lock:
+            return [item for item in self.state['items'] if item not in self.state['results']]
+
+    def record(self, item: str, result):
+        with self._lock:
+            self.state['results'][item] = result
+            self._save()
+
+    def finish(self, complete: bool):
+        with self._lock:
+            self.state['status'] = 'COMPLETE' if complete else 'RUNNING'
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self.state['updated_at'] = time.time()
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=encode_json(self.state), ContentType='application/json')
+        except Exception as e:
+            # The run goes on, a resume only redoes the items finished since the last save
+            logger.warning(f'The checkpoint {self.key} could not be saved: {e}')
@@ -0,0 +1,65 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+from utils.ratelimit import RATE_LIMIT_ENABLED, attach_rate_limiter
+from utils.metrics import attach_metrics
+
+# Clients are kept for the whole life of the process, so warm Lambda invocations
+# (and every uvicorn request) reuse the same connection pools instead of paying
+# for a new botocore session, endpoint resolution and TLS handshake each time.
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS', 50))
+MAX_ATTEMPTS = int(os.environ.get('MAX_ATTEMPTS', 5))
+# Retry mode of the clients without the shared rate limiter. The QuickSight clients already wait on its
+# token buckets and circuit breaker, and adaptive mode would add a second client side limiter backing
+# off from the same throttles, so they always use standard
+RETRY_MODE = os.environ.get('RETRY_MODE', 'adaptive')
+
+_clients = {}
+_lock = threading.Lock()
+_session = None
+
+def client_config(retry_mode: str = RETRY_MODE) -> Config:
+    """Botocore config shared by every client of the registry."""
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={'mode': retry_mode, 'max_attempts': MAX_ATTEMPTS}
+    )
+
+def get_client(service: str, region: str = None):
+    """Returns the cached boto3 client for (service, region), creating it on first use.
+
+    Args:
+        service (str): boto3 service name, e.g. quicksight or s3
+        region (str): aws region. None uses the default region of the environment
+
+    Returns:
+        client: boto3 client. Clients are thread safe and can be shared between requests
+    """
+    key = (service, region)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    # boto3 sessions are not thread safe, so client creation is serialized
+    global _session
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if _session is None:
+                _session = boto3.session.Session()
+            rate_limited = service == 'quicksight' and RATE_LIMIT_ENABLED
+            client = _session.client(service, region_name=region, config=client_config('standard' if rate_limited else RETRY_MODE))
+            if rate_limited:
+                # QuickSight limits the calls per second of each API, so every client shares the same buckets
+                attach_rate_limiter(client)
+            attach_metrics(client)
+            _clients[key] = client
+    return client
+
+def clear_clients():
+    """Drops every cached client. Mostly useful for tests and benchmarks."""
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
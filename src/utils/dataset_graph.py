@@ -0,0 +1,110 @@
+import logging
+from utils.utils import describe_dataset, extract_id_from_arn, parallel_map
+
+logger = logging.getLogger(__name__)
+
+# Keys of the PhysicalTableMap entries that point to a datasource
+PHYSICAL_TABLE_TYPES = ('RelationalTable', 'CustomSql', 'S3Source')
+
+def switch_region(arn: str, region: str) -> str:
+    """Moves an ARN to another region, e.g. arn:aws:quicksight:us-east-1:123:dataset/x -> arn:aws:quicksight:us-west-2:123:dataset/x"""
+    parts = arn.split(':', 5)
+    parts[3] = region
+    return ':'.join(parts)
+
+def join_sources(dataset_info: dict) -> list[str]:
+    """Ids of the datasets joined by this dataset, read from the Source of its logical tables"""
+    return list(dict.fromkeys(
+        extract_id_from_arn(logical_table['Source']['DataSetArn'])
+        for logical_table in (dataset_info.get('LogicalTableMap') or {}).values()
+        if logical_table.get('Source', {}).get('DataSetArn')
+    ))
+
+def retarget_dataset(dataset_info: dict, region: str, datasource_arn: str) -> dict:
+    """Points the physical tables to the target datasource and the joined datasets to the target region"""
+    for physical_table in (dataset_info.get('PhysicalTableMap') or {}).values():
+        for table_type in PHYSICAL_TABLE_TYPES:
+            if 'DataSourceArn' in physical_table.get(table_type, {}):
+                physical_table[table_type]['DataSourceArn'] = datasource_arn
+    for logical_table in (dataset_info.get('LogicalTableMap') or {}).values():
+        source = logical_table.get('Source', {})
+        if source.get('DataSetArn'):
+            source['DataSetArn'] = switch_region(source['DataSetArn'], region)
+    return dataset_info
+
+def resolve_dataset_graph(client, acc_id: str, dataset_ids: list[str], max_workers: int = 8) -> tuple[dict, dict]:
+    """Describes the datasets and, to any depth, the datasets they join. Each dataset is described once,
+    even when it is shared by many joins; every level of the walk is described in parallel.
+
+    Returns:
+        tuple[dict, dict]: dataset id -> description (None when it could not be described) and
+        dataset id -> ids of the datasets it joins
+    """
+    datasets = {}
+    dependencies = {}
+    frontier = list(dict.fromkeys(dataset_ids))
+    while frontier:
+        for dataset_id, dataset_info in zip(frontier, parallel_map(lambda dataset_id: describe_dataset(client, acc_id, dataset_id), frontier, max_workers)):
+            if isinstance(dataset_info, Exception) or not dataset_info:
+                logger.error(f'The dataset {dataset_id} could not be described, it and the datasets joining it will not be migrated')
+                dataset_info = None
+            datasets[dataset_id] = dataset_info
+            dependencies[dataset_id] = join_sources(dataset_info) if dataset_info else []
+        frontier = list(dict.fromkeys(
+            source_id
+            for dataset_id in frontier
+            for source_id in dependencies[dataset_id]
+            if source_id not in datasets
+        ))
+    return datasets, dependencies
+
+def dataset_closure(dataset_ids: list[str], dependencies: dict[str, list[str]]) -> list[str]:
+    """The datasets and, to any depth, the datasets they join, each one once"""
+    closure = {}
+    frontier = list(dataset_ids)
+    while frontier:
+        dataset_id = frontier.pop()
+        if dataset_id not in closure:
+            closure[dataset_id] = True
+            frontier.extend(dependencies.get(dataset_id, []))
+    return list(closure)
+
+def find_cycle(dependencies: dict[str, list[str]]) -> list[str]:
+    """Returns one cycle of the graph as a path (first id repeated at the end), or [] when there is none"""
+    state = {}
+    for start in dependencies:
+        if start in state:
+            continue
+        path = [start]
+        iterators = [iter(dependencies.get(start, []))]
+        state[start] = 'visiting'
+        while iterators:
+            source_id = next(iterators[-1], None)
+            if source_id is None:
+                state[path.pop()] = 'done'
+                iterators.pop()
+            elif state.get(source_id) == 'visiting':
+                return path[path.index(source_id):] + [source_id]
+            elif source_id not in state:
+                state[source_id] = 'visiting'
+                path.append(source_id)
+                iterators.append(iter(dependencies.get(source_id, [])))
+    return []
+
+def topological_levels(dependencies: dict[str, list[str]]) -> list[list[str]]:
+    """Groups the datasets in levels: each level only joins datasets of the previous ones,
+    so the datasets of a level can be created in parallel
+
+    Raises:
+        ValueError: when the joins have a cycle
+    """
+    pending = {dataset_id: set(sources) for dataset_id, sources in dependencies.items()}
+    levels = []
+    while pending:
+        level = sorted(dataset_id for dataset_id, sources in pending.items() if not sources & pending.keys())
+        if not level:
+            raise ValueError(f"The joined datasets have a cycle: {' -> '.join(find_cycle(dependencies))}")
+        levels.append(level)
+        for dataset_id in level:
+            del pending[dataset_id]
+    return levels
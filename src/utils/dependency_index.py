@@ -0,0 +1,220 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from utils.utils import describe_analysis, describe_dataset, extract_id_from_arn, parallel_map
+from utils.dataset_graph import join_sources
+from utils.storage import is_not_found
+from utils.manifest import SNAPSHOT_PREFIX
+
+logger = logging.getLogger(__name__)
+
+DEPENDENCY_INDEX_PATH = os.environ.get('DEPENDENCY_INDEX_PATH', '/tmp/quicksight_dependencies.sqlite')
+DEPENDENCY_INDEX_MAX_WORKERS = int(os.environ.get('DEPENDENCY_INDEX_MAX_WORKERS', 8))
+# Seconds after which DATASET_DEPENDENTS refreshes the index of the region before answering
+DEPENDENCY_INDEX_MAX_AGE = float(os.environ.get('DEPENDENCY_INDEX_MAX_AGE', 300))
+# Copy of the index kept in the bucket, so a new Lambda instance does not build it from scratch
+DEPENDENCY_INDEX_KEY = f'{SNAPSHOT_PREFIX}/_index/dependencies.sqlite'
+
+# Which analyses use each dataset, which datasets each dataset joins (the Source of its logical tables)
+# and from which analysis each template was made, per region. Every row keeps the LastUpdatedTime of
+# the resource, so a refresh only describes what changed since the previous one.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS analyses (region TEXT, analysis_id TEXT, name TEXT, status TEXT, last_updated REAL, PRIMARY KEY (region, analysis_id));
+CREATE TABLE IF NOT EXISTS analysis_datasets (region TEXT, analysis_id TEXT, dataset_id TEXT, PRIMARY KEY (region, analysis_id, dataset_id));
+CREATE INDEX IF NOT EXISTS analysis_datasets_by_dataset ON analysis_datasets (region, dataset_id);
+CREATE TABLE IF NOT EXISTS datasets (region TEXT, dataset_id TEXT, name TEXT, status TEXT, last_updated REAL, PRIMARY KEY (region, dataset_id));
+CREATE TABLE IF NOT EXISTS dataset_joins (region TEXT, dataset_id TEXT, source_id TEXT, PRIMARY KEY (region, dataset_id, source_id));
+CREATE INDEX IF NOT EXISTS dataset_joins_by_source ON dataset_joins (region, source_id);
+CREATE TABLE IF NOT EXISTS templates (region TEXT, template_id TEXT, name TEXT, status TEXT, last_updated REAL, version INTEGER, analysis_id TEXT, PRIMARY KEY (region, template_id));
+CREATE INDEX IF NOT EXISTS templates_by_analysis ON templates (region, analysis_id);
+CREATE TABLE IF NOT EXISTS refreshes (region TEXT PRIMARY KEY, refreshed_at REAL);
+'''
+
+def _timestamp(value) -> float:
+    return value.timestamp() if hasattr(value, 'timestamp') else float(value or 0)
+
+def _placeholders(values: list) -> str:
+    return ','.join('?' * len(values))
+
+class DependencyIndex():
+    def __init__(self, path: str = DEPENDENCY_INDEX_PATH) -> None:
+        """SQLite index of the dependencies between analyses, datasets and templates. Thread safe"""
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def _query(self, sql: str, parameters: tuple = ()) -> list:
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def refreshed_at(self, region: str) -> float:
+        rows = self._query('SELECT refreshed_at FROM refreshes WHERE region = ?', (region,))
+        return rows[0][0] if rows else None
+
+    def _refresh_table(self, region: str, table: str, key: str, summaries: dict, describe, store, max_workers: int) -> dict:
+        """Describes the resources that are new or whose LastUpdatedTime changed, saves them with store and
+        drops the ones that are not listed anymore. A resource that fails to describe is tried again next time"""
+        stored = dict(self._query(f'SELECT {key}, last_updated FROM {table} WHERE region = ?', (region,)))
+        changed = [resource_id for resource_id, summary in summaries.items() if stored.get(resource_id) is None or summary['last_updated'] > stored[resource_id]]
+        removed = [resource_id for resource_id in stored if resource_id not in summaries]
+        descriptions = parallel_map(describe, changed, max_workers)
+
+        failed = 0
+        with self._lock, self._db:
+            for resource_id in removed:
+                self._delete(table, key, region, resource_id)
+            for resource_id, summary in summaries.items():
+                if resource_id in stored:
+                    self._db.execute(f'UPDATE {table} SET name = ?, status = ? WHERE region = ? AND {key} = ?', (summary['name'], summary['status'], region, resource_id))
+            for resource_id, description in zip(changed, descriptions):
+                if isinstance(description, Exception) or description is None:
+                    failed += 1
+                    continue
+                summary = summaries[resource_id]
+                self._delete(table, key, region, resource_id)
+                self._db.execute(f'INSERT INTO {table} (region, {key}, name, status, last_updated) VALUES (?, ?, ?, ?, ?)', (region, resource_id, summary['name'], summary['status'], summary['last_updated']))
+                store(region, resource_id, description)
+        return {'total': len(summaries), 'described': len(changed) - failed, 'failed': failed, 'removed': len(removed)}
+
+    def _delete(self, table: str, key: str, region: str, resource_id: str):
+        self._db.execute(f'DELETE FROM {table} WHERE region = ? AND {key} = ?', (region, resource_id))
+        if table == 'analyses':
+            self._db.execute('DELETE FROM analysis_datasets WHERE region = ? AND analysis_id = ?', (region, resource_id))
+        elif table == 'datasets':
+            self._db.execute('DELETE FROM dataset_joins WHERE region = ? AND dataset_id = ?', (region, resource_id))
+
+    def refresh(self, client, acc_id: str, max_workers: int = DEPENDENCY_INDEX_MAX_WORKERS) -> dict:
+        """Brings the index of the client region up to date: lists the analyses, datasets and templates
+        and describes, in parallel, only the ones created or updated since the previous refresh
+
+        Returns:
+            dict: for analyses, datasets and templates the number listed, described, failed and removed, and the seconds taken
+        """
+        region = client.meta.region_name
+        started = time.perf_counter()
+
+        def summaries(operation: str, list_key: str, id_key: str) -> dict:
+            return {
+                item[id_key]: {'name': item.get('Name'), 'status': item.get('Status'), 'last_updated': _timestamp(item.get('LastUpdatedTime'))}
+                for page in client.get_paginator(operation).paginate(AwsAccountId=acc_id)
+                for item in page[list_key]
+            }
+
+        def describe_template_source(template_id: str) -> dict:
+            try:
+                template = client.describe_template(AwsAccountId=acc_id, TemplateId=template_id)['Template']
+            except Exception as e:
+                logger.warning(f'The template {template_id} could not be described: {e}')
+                return None
+            source_arn = template['Version'].get('SourceEntityArn') or ''
+            return {'version': template['Version'].get('VersionNumber'), 'analysis_id': extract_id_from_arn(source_arn) if ':analysis/' in source_arn else None}
+
+        def store_analysis(region, analysis_id, analysis):
+            self._db.executemany('INSERT OR IGNORE INTO analysis_datasets VALUES (?, ?, ?)', [(region, analysis_id, extract_id_from_arn(arn)) for arn in analysis['DataSetArns']])
+
+        def store_dataset(region, dataset_id, dataset_info):
+            self._db.executemany('INSERT OR IGNORE INTO dataset_joins VALUES (?, ?, ?)', [(region, dataset_id, source_id) for source_id in join_sources(dataset_info)])
+
+        def store_template(region, template_id, template):
+            self._db.execute('UPDATE templates SET version = ?, analysis_id = ? WHERE region = ? AND template_id = ?', (template['version'], template['analysis_id'], region, template_id))
+
+        stats = {
+            'analyses': self._refresh_table(region, 'analyses', 'analysis_id', summaries('list_analyses', 'AnalysisSummaryList', 'AnalysisId'), lambda analysis_id: describe_analysis(client, acc_id, analysis_id), store_analysis, max_workers),
+            'datasets': self._refresh_table(region, 'datasets', 'dataset_id', summaries('list_data_sets', 'DataSetSummaries', 'DataSetId'), lambda dataset_id: describe_dataset(client, acc_id, dataset_id), store_dataset, max_workers),
+            'templates': self._refresh_table(region, 'templates', 'template_id', summaries('list_templates', 'TemplateSummaryList', 'TemplateId'), describe_template_source, store_template, max_workers),
+        }
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?)', (region, time.time()))
+        stats['seconds'] = round(time.perf_counter() - started, 3)
+        logger.info(f"Dependency index of {region} refreshed in {stats['seconds']}s: {', '.join(f"{kind} {stats[kind]['described']} described" for kind in ('analyses', 'datasets', 'templates'))}")
+        return stats
+
+    def dependents(self, region: str, dataset_id: str) -> dict:
+        """What depends on the dataset: the datasets that join it (to any depth), the analyses that use
+        it or any of them and the templates made from those analyses"""
+        joiners = '''
+            WITH RECURSIVE joiners(dataset_id) AS (
+                SELECT ? UNION SELECT j.dataset_id FROM dataset_joins j JOIN joiners ON j.source_id = joiners.dataset_id WHERE j.region = ?
+            )'''
+        datasets = [row[0] for row in self._query(f'{joiners} SELECT dataset_id FROM joiners', (dataset_id, region))]
+        analyses = self._query(f'''{joiners}
+            SELECT a.analysis_id, a.name, a.status, GROUP_CONCAT(d.dataset_id) FROM analysis_datasets d
+            JOIN analyses a ON a.region = d.region AND a.analysis_id = d.analysis_id
+            WHERE d.region = ? AND d.dataset_id IN (SELECT dataset_id FROM joiners)
+            GROUP BY a.analysis_id ORDER BY a.analysis_id''', (dataset_id, region, region))
+        templates = self._query(f'''
+            SELECT template_id, name, version, analysis_id FROM templates
+            WHERE region = ? AND analysis_id IN ({_placeholders(analyses)}) ORDER BY template_id''', (region, *[row[0] for row in analyses]))
+        return {
+            'datasets': [joiner for joiner in datasets if joiner != dataset_id],
+            'analyses': [{'Id': analysis_id, 'Name': name, 'Status': status, 'DataSetIds': sorted(used.split(','))} for analysis_id, name, status, used in analyses],
+            'templates': [{'Id': template_id, 'Name': name, 'Version': version, 'AnalysisId': analysis_id} for template_id, name, version, analysis_id in templates],
+        }
+
+    def analysis_datasets(self, region: str, analysis_ids: list[str]) -> list[str]:
+        """Datasets used by the analyses and, to any depth, the datasets they join. None when an analysis is not indexed"""
+        known = self._query(f'SELECT COUNT(*) FROM analyses WHERE region = ? AND analysis_id IN ({_placeholders(analysis_ids)})', (region, *analysis_ids))
+        if known[0][0] < len(set(analysis_ids)):
+            return None
+        return [row[0] for row in self._query(f'''
+            WITH RECURSIVE used(dataset_id) AS (
+                SELECT dataset_id FROM analysis_datasets WHERE region = ? AND analysis_id IN ({_placeholders(analysis_ids)})
+                UNION SELECT j.source_id FROM dataset_joins j JOIN used ON j.dataset_id = used.dataset_id WHERE j.region = ?
+            ) SELECT dataset_id FROM used''', (region, *analysis_ids, region))]
+
+    def load(self, s3_client, bucket_name: str) -> bool:
+        """Replaces the local index by the copy in the bucket. False when there is none"""
+        try:
+            body = s3_client.get_object(Bucket=bucket_name, Key=DEPENDENCY_INDEX_KEY)['Body'].read()
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            return False
+        with self._lock:
+            source = sqlite3.connect(':memory:')
+            source.deserialize(body)
+            source.backup(self._db)
+            source.close()
+        return True
+
+    def save(self, s3_client, bucket_name: str):
+        """Uploads the index to the bucket"""
+        with self._lock:
+            body = self._db.serialize()
+        s3_client.put_object(Bucket=bucket_name, Key=DEPENDENCY_INDEX_KEY, Body=body, ContentType='application/vnd.sqlite3')
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_dependency_index(path: str = DEPENDENCY_INDEX_PATH, s3_client=None, bucket_name: str = None) -> DependencyIndex:
+    """Index kept open for the life of the process. A new local index starts from the copy in the bucket, when given"""
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None:
+            is_new = not os.path.exists(path)
+            index = DependencyIndex(path)
+            if is_new and s3_client is not None and bucket_name:
+                try:
+                    if index.load(s3_client, bucket_name):
+                        logger.info(f'Dependency index loaded from {bucket_name}/{DEPENDENCY_INDEX_KEY}')
+                except Exception as e:
+                    logger.warning(f'The dependency index could not be loaded from the bucket, it will be built again: {e}')
+            _indexes[path] = index
+        return index
+
+def indexed_datasets(region: str, analysis_ids: list[str]) -> list[str]:
+    """Datasets the analyses used at the last refresh of the index, [] when the region was never indexed.
+    Only a hint: the index may be behind the analyses"""
+    try:
+        if not os.path.exists(DEPENDENCY_INDEX_PATH):
+            return []
+        index = get_dependency_index()
+        if index.refreshed_at(region) is None:
+            return []
+        return index.analysis_datasets(region, analysis_ids) or []
+    except Exception as e:
+        logger.warning(f'The dependency index could not be read: {e}')
+        return []
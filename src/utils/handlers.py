@@ -1,12 +1,33 @@
-import json
+import os
+import re
+import copy
+import time
 import datetime
+import itertools
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
 from utils.utils import *
+from utils.cache import cache_stats
+from utils.logs import request_log_lines
+from utils.metrics import metrics_summary, step
+from utils.jobs import report_progress
+from utils.waiters import SUCCESS_STATES, wait_for, wait_for_resource
+from utils.checkpoints import Checkpoint, checkpoint_key
+from utils.permissions import PERMISSION_MAX_WORKERS, sync_permissions
+from utils.dependency_index import DEPENDENCY_INDEX_MAX_AGE, get_dependency_index, indexed_datasets
+from utils.dataset_graph import resolve_dataset_graph, topological_levels, find_cycle, retarget_dataset, switch_region, dataset_closure
+from utils.storage import put_snapshot, read_snapshot
+from utils.blobs import SNAPSHOT_FORMAT, BLOB_FORMAT, put_blob_snapshot, load_snapshot, stored_blobs
+from utils.manifest import DATE_FORMAT, snapshot_version, stakeholder_prefix, definition_key, update_manifest, update_migration_fingerprints, read_manifest, read_manifest_version, find_version
+
+# Worker pool size used to create and describe the datasets of a migration
+MIGRATION_MAX_WORKERS = int(os.environ.get('MIGRATION_MAX_WORKERS', 8))
+# Analyses backed up at the same time by BACKUP_ALL, and seconds left to the Lambda under which it stops starting new ones
+BACKUP_MAX_WORKERS = int(os.environ.get('BACKUP_MAX_WORKERS', 4))
+BACKUP_TIME_MARGIN = float(os.environ.get('BACKUP_TIME_MARGIN', 360))
 
 # Handlers
-def return_log_message(action, email, source, target = None, result = None, analysis_id = None, comment = None) -> dict:
-    with open("logs/logs.log", "r") as log: log = log.read().splitlines()
-    with open("logs/logs.log", "w"): pass # Limpando o arquivo de log
-
+def return_log_message(action, email, source, target = None, result = None, analysis_id = None, comment = None, report = None) -> dict:
     return {
         "date":datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S'),
         "action":action,
@@ -16,7 +37,10 @@ def return_log_message(action, email, source, target = None, result = None, anal
         "status":'SUCCESS' if result == 1 else 'FAIL',
         "analysis_id":analysis_id,
         "comment":comment if comment else "Nenhuma Observação",
-        "logs": log
+        **({"report": report} if report else {}),
+        "cache": cache_stats(),
+        "metrics": metrics_summary(),
+        "logs": request_log_lines()
     }
 
 def return_json_message(body:str, email:str) -> dict:
@@ -27,26 +51,45 @@ def return_json_message(body:str, email:str) -> dict:
         "user": email
     }
 
-def s3_save_json(data: dict) -> str:
-    """Constructs a dict to send to the S3 Bucket and saves it in a temp JSON file."""
-    try:
-        file_path = 's3_response.json'
-        with open(file_path, 'w', encoding='UTF-8') as file:
-            json.dump(data, file, indent=4, default=str, ensure_ascii=False)
-        return file_path
-    except Exception as e:
-        logger.error(f'An error occurred in s3_save_json function\nError: {e}')
+def snapshot_key(data: dict, stakeholder: str) -> str:
+    """S3 key of a template/migration snapshot"""
+    object_name = f"{data['name']}_{snapshot_version(data)}.json"
+    return f"{stakeholder_prefix(stakeholder)}/{data['name'].replace('_template', '').lower()}/{object_name}"
 
-def s3_upload_file(s3_client, data: dict[str,str], file_path: str, bucket_name: str, stakeholder: str):
+def s3_upload_file(s3_client, data: dict[str,str], bucket_name: str, stakeholder: str):
     """Uploads the data to an S3 bucket in AWS."""
-    object_name = f"{data['name']}_{data['version'] if data['version'] != 0 else 'migration'}.json"
     try:
-        path = f"quicksight_templates/{stakeholder.upper() if stakeholder else "OMOTOR"}/{data['name'].replace('_template', '').lower()}/{object_name}"
-        s3_client.upload_file(file_path, bucket_name, path)
-        logger.debug(f'File {data} uploaded to {bucket_name} on the path: {path}')
+        path = snapshot_key(data, stakeholder)
+        metadata = {
+            'author': data['author'],
+            'template-id': data['template_id'],
+            'version': data['version'],
+        }
+        try:
+            current = read_manifest_version(s3_client, bucket_name, stakeholder, data['template_id'])
+        except Exception as e:
+            logger.warning(f'The manifest of {data['template_id']} could not be read.\nError: {e}')
+            current = None
+        manifest = current and current[0]
+
+        if SNAPSHOT_FORMAT == 'blobs':
+            # The blobs of the previous snapshot are known to be stored, so only the new ones are checked
+            previous = manifest and (find_version(manifest, snapshot_version(data)) or find_version(manifest))
+            known = stored_blobs(s3_client, bucket_name, previous['key']) if previous and previous.get('format') == BLOB_FORMAT else set()
+            stored = put_blob_snapshot(s3_client, bucket_name, path, data, metadata, known)
+        else:
+            stored = put_snapshot(s3_client, bucket_name, path, data, metadata=metadata)
+            # The definition is also saved alone, so restores don't download the datasets with it
+            stored['definition_key'] = definition_key(path)
+            put_snapshot(s3_client, bucket_name, stored['definition_key'], data['analysis_definition'], metadata=metadata)
+        logger.debug(f'File {data['name']} uploaded to {bucket_name} on the path: {path} ({stored['size']} bytes, {stored['encoding'] or 'uncompressed'})')
         logger.info(f"Data uploaded successfully to {bucket_name} on the path: {path}")
-    except FileNotFoundError:
-        logger.error('The file was not found')
+        try:
+            # Conditional on the manifest read above, a change made meanwhile by another writer is kept
+            update_manifest(s3_client, bucket_name, stakeholder, data, stored, current)
+        except Exception as e:
+            logger.error(f'The manifest of {data['template_id']} could not be updated, run REBUILD_MANIFESTS.\nError: {e}')
+        return stored
     except Exception as e:
         logger.error(f'An error occurred in s3_upload_file function.\nError Message: {e}')
 
@@ -64,47 +107,328 @@ def create_metadata(email: str, template_info: dict, analysis_definition: dict,
         'comment': comment or template_info.get('Description', '')
     }
 
-def save_metadata(info: dict, s3_client, file_path: str, bucket_name: str, stakeholder: str):
+def save_metadata(info: dict, s3_client, bucket_name: str, stakeholder: str):
     """Save metadata to S3."""
-    s3_upload_file(s3_client, info, file_path, bucket_name, stakeholder)
+    return s3_upload_file(s3_client, info, bucket_name, stakeholder)
 
 def handle_s3_upload(info: dict, s3_client, bucket_name: str, stakeholder: str):
-    """Create JSON and upload it to S3."""
-    file_path = s3_save_json(info)
-    save_metadata(info, s3_client, file_path, bucket_name, stakeholder)
-
-def migrate_analysis_handler(acc_id: str, analysis_id: str, user_arn: str, source_client: dict, target_client: dict, s3_client, bucket_name: str, stakeholder: str) -> int:
-    """Handles the migration function and saves the .qs file into the S3."""
+    """Serialize the snapshot in memory and upload it to S3."""
+    return save_metadata(info, s3_client, bucket_name, stakeholder)
+
+def parse_analysis_ids(analysis_id) -> list[str]:
+    """Accepts a single id, a list of ids or ids separated by commas/spaces and returns the distinct ids in order."""
+    if not analysis_id:
+        return []
+    if isinstance(analysis_id, str):
+        analysis_id = re.split(r'[\s,;]+', analysis_id)
+    return list(dict.fromkeys(id.strip() for id in analysis_id if id and id.strip()))
+
+def dataset_migration_plan(acc_id: str, dataset_ids: list[str], source_client: dict) -> tuple[dict, dict, list]:
+    """Describes the datasets, and the datasets they join to any depth, in the source region and
+    groups them in levels of joins. The datasets of a cycle fail, and with them every dataset joining them.
+
+    Returns:
+        tuple[dict, dict, list]: descriptions, joined datasets of each dataset and levels, see topological_levels
+    """
+    datasets, dependencies = resolve_dataset_graph(source_client['client'], acc_id, dataset_ids, MIGRATION_MAX_WORKERS)
+    while True:
+        try:
+            levels = topological_levels(dependencies)
+            break
+        except ValueError as e:
+            logger.error(f'{e}. These datasets will not be migrated')
+            for dataset_id in find_cycle(dependencies)[:-1]:
+                datasets[dataset_id] = None
+                dependencies[dataset_id] = []
+    return datasets, dependencies, levels
+
+def migrate_datasets(acc_id: str, dataset_ids: list[str], user_arn: str, source_client: dict, target_client: dict, previous_fingerprints: dict = None, fingerprints: dict = None, plan: tuple = None) -> dict[str,str]:
+    """Creates every dataset, and the datasets they join to any depth, once in the target region.
+    The datasets are created level by level, each level in parallel, so a join always comes after its sources.
+
+    With previous_fingerprints (dataset id -> hash of the last migration to the target region) the
+    unchanged datasets are skipped and the changed ones updated. The hashes of the datasets this
+    migration owns are written into fingerprints, see migrate_dataset. plan, returned by dataset_migration_plan, skips describing the source
+    again when the same datasets go to many regions.
+
+    Returns:
+        dict[str,str]: new Arn of each dataset id, 0 if it failed
+    """
+    previous_fingerprints = previous_fingerprints or {}
+    fingerprints = fingerprints if fingerprints is not None else {}
+
+    datasets, dependencies, levels = plan or dataset_migration_plan(acc_id, dataset_ids, source_client)
+    logger.info(f'Migrating {len(datasets)} datasets in {len(levels)} levels of joins to {target_client['region']}')
+
+    arn_map = {}
+    def migrate(dataset_id):
+        failed_sources = [source_id for source_id in dependencies[dataset_id] if not arn_map.get(source_id)]
+        if datasets[dataset_id] is None:
+            return 0
+        if failed_sources:
+            logger.error(f'The dataset {dataset_id} was not migrated because its joined datasets failed: {failed_sources}')
+            return 0
+        # The description is shared by every target region, so each one retargets its own copy
+        dataset_info = retarget_dataset(copy.deepcopy(datasets[dataset_id]), target_client['region'], target_client['arn'])
+        return migrate_dataset(acc_id, dataset_info, user_arn, target_client, previous_fingerprints, fingerprints)
+
+    for level in levels:
+        for dataset_id, new_arn in zip(level, parallel_map(migrate, level, MIGRATION_MAX_WORKERS)):
+            if isinstance(new_arn, Exception) or not new_arn:
+                logger.error(f"An error occurred while creating the dataset {dataset_id}.\nError: {new_arn}")
+                new_arn = 0
+            arn_map[dataset_id] = new_arn
+    return arn_map
+
+def create_migrated_analysis(acc_id: str, analysis_definition: dict, arn_map: dict[str,str], user_arn: str, source_client: dict, target_client: dict, s3_client, bucket_name: str, stakeholder: str, previous_fingerprint: str = None, fingerprints: dict = None, datasets_changed: bool = True) -> dict:
+    """Creates the analysis in the target region with the migrated datasets. Once it is built,
+    finish_migrated_analysis grants the permissions and saves its snapshot into the S3.
+    When its definition has the previous_fingerprint of the last migration nothing is sent.
+    fingerprints are the hashes of the datasets of this analysis, saved in its manifest."""
     try:
-        analysis_definition = describe_analysis_definition(source_client['client'], acc_id, analysis_id)
         arn_list_dict = analysis_definition['Definition']['DataSetIdentifierDeclarations']
-
-        for index, dataset_identifier in enumerate(arn_list_dict):
-            # Creating each dataset of the analysis in the new region
-            try:
-                new_arn = create_dataset_handler(acc_id, extract_id_from_arn(dataset_identifier['DataSetArn']), user_arn, source_client, target_client)
-            except Exception as e:
-                logger.error(f'An error occurred while creating {dataset_identifier['Identifier']} function.\nError: {e}\nType:{type(e)}')
-
-            finally:
-                analysis_definition['Definition']['DataSetIdentifierDeclarations'][index]['DataSetArn'] = new_arn
-            
+        failed_datasets = []
+        for dataset_identifier in arn_list_dict:
+            dataset_identifier['DataSetArn'] = arn_map.get(extract_id_from_arn(dataset_identifier['DataSetArn']), 0)
+            if not dataset_identifier['DataSetArn']:
+                failed_datasets.append(dataset_identifier['Identifier'])
 
         #analysis_definition['Definition']['DataSetIdentifierDeclarations'] = list(filter(lambda d: d["DataSetArn"] != 0, analysis_definition['Definition']["DataSetIdentifierDeclarations"]))
 
         if analysis_definition.get('ThemeArn'):
-            analysis_definition['ThemeArn'] = source_client['theme']
-                
-        datasets_definition = [describe_dataset(target_client['client'], acc_id, extract_id_from_arn(arn['DataSetArn'])) for arn in arn_list_dict]
+            # The theme of the source region does not exist in the target one
+            analysis_definition['ThemeArn'] = target_client.get('theme')
+
+        current_fingerprint = analysis_fingerprint(analysis_definition)
+        migration_fingerprints = {
+            'target_region': target_client['region'],
+            'analysis': current_fingerprint,
+            'datasets': dict(fingerprints or {}),
+        }
+        # The manifest only says the analysis was migrated, it may have been deleted from the target since then
+        if not failed_datasets and current_fingerprint == previous_fingerprint and describe_analysis(target_client['client'], acc_id, analysis_definition['Id']):
+            logger.info(f'Analysis {analysis_definition['Name']} is unchanged since the last migration, skipping it')
+            if datasets_changed:
+                update_migration_fingerprints(s3_client, bucket_name, stakeholder, analysis_definition['Id'], migration_fingerprints)
+            return {"status": 'SUCCESS', "analysis": 'UNCHANGED', "failed_datasets": []}
+
+        datasets_definition = parallel_map(
+            lambda dataset_identifier: describe_dataset(target_client['client'], acc_id, extract_id_from_arn(dataset_identifier['DataSetArn'])),
+            arn_list_dict,
+            MIGRATION_MAX_WORKERS
+        )
+
+        # Migrated before: it most likely exists, so the update is tried first
+        updated = update_analysis_by_definition(target_client['client'], acc_id, analysis_definition) if previous_fingerprint else 2
+        created = 3 if updated == 1 else create_analysis_by_definition(target_client['client'], acc_id, analysis_definition) if updated == 2 else 0
+        if created == 2:
+            created = 3 if update_analysis_by_definition(target_client['client'], acc_id, analysis_definition) == 1 else 0
+
+        result = {
+            "status": 'SUCCESS' if created else 'FAIL',
+            "analysis": {1: 'CREATED', 3: 'UPDATED'}.get(created, 'FAIL'),
+            "failed_datasets": failed_datasets
+        }
+        if created:
+            # Kept for finish_migrated_analysis, once the analysis left the IN_PROGRESS state
+            result['pending'] = {
+                "definition": analysis_definition,
+                "datasets_definition": datasets_definition,
+                "fingerprints": migration_fingerprints if not failed_datasets else None
+            }
+        return result
+
+    except Exception as e:
+        logger.error(f'An error occurred in create_migrated_analysis function.\nError: {e}')
+        return {"status": 'FAIL', "error": str(e)}
+
+def finish_migrated_analysis(acc_id: str, result: dict, wait: dict, user_arn: str, source_client: dict, target_client: dict, s3_client, bucket_name: str, stakeholder: str) -> dict:
+    """Grants the user access to the migrated analysis and saves its snapshot into the S3, once it was built
+
+    Args:
+        result (dict): report returned by create_migrated_analysis
+        wait (dict): terminal state of the analysis, returned by wait_for
+    """
+    try:
+        pending = result.pop('pending')
+        result['wait'] = {"status": wait['status'], "seconds": wait['seconds']}
+        if not wait['ready']:
+            result.update(status='FAIL', error=wait['errors'] or f"Analysis finished as {wait['status']}")
+            return result
+
+        analysis_definition = pending['definition']
+        grant_auth(target_client['client'], acc_id, analysis_definition['Id'], user_arn)
 
-        create_analysis_by_definition(target_client['client'], acc_id, analysis_definition)
-        grant_auth(target_client['client'], acc_id, analysis_id, user_arn)
-        
         analysis_definition['region'] = source_client['region']
-        info = create_metadata(user_arn.split("/")[2], analysis_definition, analysis_definition, datasets_definition, "Migração")
+        info = create_metadata(user_arn.split("/")[2], analysis_definition, analysis_definition, pending['datasets_definition'], "Migração")
+        info['target_region'] = target_client['region']
+        if pending['fingerprints']:
+            info['fingerprints'] = pending['fingerprints']
         handle_s3_upload(info, s3_client, bucket_name, stakeholder)
+        return result
 
-        return 1
+    except Exception as e:
+        logger.error(f'An error occurred in finish_migrated_analysis function.\nError: {e}')
+        return {"status": 'FAIL', "error": str(e)}
+
+def previous_migration(s3_client, bucket_name: str, stakeholder: str, analysis_ids: list[str], target_region: str) -> dict:
+    """Fingerprints saved by the last migrations of the analyses to the target region
+
+    Returns:
+        dict: analyses (analysis id -> hash) and datasets (dataset id -> hash)
+    """
+    def read(analysis_id):
+        return read_manifest(s3_client, bucket_name, stakeholder, analysis_id).get('migrations', {}).get(target_region)
+
+    previous = {'analyses': {}, 'datasets': {}}
+    if not bucket_name:
+        return previous
+    migrations = []
+    for analysis_id, migration in zip(analysis_ids, parallel_map(read, analysis_ids, MIGRATION_MAX_WORKERS)):
+        if isinstance(migration, Exception):
+            logger.warning(f'The last migration of {analysis_id} could not be read, it will be fully migrated: {migration}')
+        elif migration:
+            previous['analyses'][analysis_id] = migration['analysis']
+            migrations.append(migration)
+    # A dataset shared by many analyses takes the hash of the latest migration that included it
+    for migration in sorted(migrations, key=lambda migration: datetime.datetime.strptime(migration['date'], DATE_FORMAT)):
+        previous['datasets'].update(migration['datasets'])
+    return previous
+
+def describe_migration_source(acc_id: str, analysis_ids: list[str], source_client: dict) -> dict:
+    """Reads everything a migration needs from the source region: the analysis definitions and the plan of their datasets
+
+    Returns:
+        dict: definitions found, report of the analyses not found, dataset ids and dataset plan
+    """
+    # The datasets the dependency index knows for these analyses are described while the definitions
+    # are, so the plan below finds them in the describe cache instead of walking the joins level by level
+    predicted = indexed_datasets(source_client['client'].meta.region_name, analysis_ids)
+    with step('migration.describe_analyses'):
+        definitions, _ = parallel_map(lambda describe: describe(), [
+            lambda: parallel_map(lambda analysis_id: describe_analysis_definition(source_client['client'], acc_id, analysis_id), analysis_ids, MIGRATION_MAX_WORKERS),
+            lambda: parallel_map(lambda dataset_id: describe_dataset(source_client['client'], acc_id, dataset_id), predicted, MIGRATION_MAX_WORKERS),
+        ], 2)
+    if predicted:
+        logger.info(f'{len(predicted)} datasets described ahead from the dependency index')
+
+    failed = {}
+    valid_definitions = []
+    for analysis_id, analysis_definition in zip(analysis_ids, definitions):
+        if isinstance(analysis_definition, Exception) or not analysis_definition:
+            failed[analysis_id] = {"status": 'FAIL', "error": 'Analysis definition not found'}
+        else:
+            valid_definitions.append(analysis_definition)
+
+    dataset_ids = list(dict.fromkeys(
+        extract_id_from_arn(dataset_identifier['DataSetArn'])
+        for analysis_definition in valid_definitions
+        for dataset_identifier in analysis_definition['Definition']['DataSetIdentifierDeclarations']
+    ))
+    logger.info(f'Migrating {len(dataset_ids)} distinct datasets used by {len(valid_definitions)} analyses')
+    with step('migration.describe_datasets'):
+        plan = dataset_migration_plan(acc_id, dataset_ids, source_client)
+    return {'definitions': valid_definitions, 'failed': failed, 'dataset_ids': dataset_ids, 'plan': plan}
+
+def migrate_to_region(acc_id: str, source: dict, user_arn: str, source_client: dict, target_client: dict, s3_client, bucket_name: str, stakeholder: str, done=None) -> dict[str,dict]:
+    """Migrates the analyses read by describe_migration_source to one target region
+
+    Args:
+        done (iterator): shared counter of the analyses finished, for the job progress
+
+    Returns:
+        dict[str,dict]: status report of each analysis id
+    """
+    done = done or itertools.count(1)
+    region = target_client['region']
+    if region == source_client['region']:
+        # Migrating to the source region would rewrite the source datasets themselves
+        logger.error(f'The target region {region} is the source region, nothing was migrated')
+        return {analysis_id: {"status": 'FAIL', "error": 'The target region is the source region'} for analysis_id in [analysis_definition['Id'] for analysis_definition in source['definitions']] + list(source['failed'])}
+    # The definitions are shared by every target region and create_migrated_analysis changes them
+    valid_definitions = copy.deepcopy(source['definitions'])
+    report = dict(source['failed'])
+
+    with step('migration.previous_migration'):
+        previous = previous_migration(s3_client, bucket_name, stakeholder, [analysis_definition['Id'] for analysis_definition in valid_definitions], region)
+    fingerprints = {}
+    with step('migration.datasets'):
+        arn_map = migrate_datasets(acc_id, source['dataset_ids'], user_arn, source_client, target_client, previous['datasets'], fingerprints, source['plan'])
+
+    report_progress(f'{len(source['dataset_ids'])} datasets migrated to {region}')
+
+    def create(analysis_definition):
+        # Each manifest only keeps the datasets its analysis uses, directly or through joins, that were migrated
+        own = dataset_closure([extract_id_from_arn(dataset_identifier['DataSetArn']) for dataset_identifier in analysis_definition['Definition']['DataSetIdentifierDeclarations']], source['plan'][1])
+        analysis_fingerprints = {dataset_id: fingerprints[dataset_id] for dataset_id in own if arn_map.get(dataset_id) and dataset_id in fingerprints}
+        datasets_changed = any(previous['datasets'].get(dataset_id) != value for dataset_id, value in analysis_fingerprints.items())
+        result = create_migrated_analysis(acc_id, analysis_definition, arn_map, user_arn, source_client, target_client, s3_client, bucket_name, stakeholder, previous['analyses'].get(analysis_definition['Id']), analysis_fingerprints, datasets_changed)
+        if 'pending' not in result:
+            report_progress(f"Analysis {analysis_definition['Id']} migrated to {region}", done=next(done))
+        return result
+
+    with step('migration.analyses'):
+        results = parallel_map(create, valid_definitions, MIGRATION_MAX_WORKERS)
+    sent = []
+    for analysis_definition, result in zip(valid_definitions, results):
+        report[analysis_definition['Id']] = result if not isinstance(result, Exception) else {"status": 'FAIL', "error": str(result)}
+        if 'pending' in report[analysis_definition['Id']]:
+            sent.append(analysis_definition['Id'])
+
+    # The analyses are built asynchronously, the permissions can only be granted once they settle
+    with step('migration.wait'):
+        waits = wait_for([{'client': target_client['client'], 'acc_id': acc_id, 'kind': 'analysis', 'id': analysis_id} for analysis_id in sent])
+
+    def finish(analysis_wait):
+        analysis_id, wait = analysis_wait
+        result = finish_migrated_analysis(acc_id, report[analysis_id], wait, user_arn, source_client, target_client, s3_client, bucket_name, stakeholder)
+        report_progress(f"Analysis {analysis_id} migrated to {region}", done=next(done))
+        return result
+
+    with step('migration.permissions_and_snapshots'):
+        finished = parallel_map(finish, list(zip(sent, waits)), MIGRATION_MAX_WORKERS)
+    for analysis_id, result in zip(sent, finished):
+        report[analysis_id] = result if not isinstance(result, Exception) else {"status": 'FAIL', "error": str(result)}
+    return report
+
+def bulk_migrate_analysis_handler(acc_id: str, analysis_ids: list[str], user_arn: str, source_client: dict, target_client: dict, s3_client, bucket_name: str, stakeholder: str) -> dict[str,dict]:
+    """Migrates many analyses at once. The datasets shared between them are migrated only once.
+
+    Returns:
+        dict[str,dict]: status report of each analysis id
+    """
+    source = describe_migration_source(acc_id, analysis_ids, source_client)
+    report_progress(done=0, total=len(source['definitions']))
+    report = migrate_to_region(acc_id, source, user_arn, source_client, target_client, s3_client, bucket_name, stakeholder)
+    return {analysis_id: report[analysis_id] for analysis_id in analysis_ids if analysis_id in report}
+
+def fan_out_migrate_analysis_handler(acc_id: str, analysis_ids: list[str], user_arn: str, source_client: dict, target_clients: list[dict], s3_client, bucket_name: str, stakeholder: str) -> dict[str,dict]:
+    """Migrates the analyses to many regions at once. The source is read a single time and every
+    target region is migrated concurrently, each one throttled by its own rate limits.
+
+    Returns:
+        dict[str,dict]: report of each target region, with the status report of each analysis id
+    """
+    source = describe_migration_source(acc_id, analysis_ids, source_client)
+    report_progress(done=0, total=len(source['definitions']) * len(target_clients))
+    done = itertools.count(1)
+
+    def migrate(target_client):
+        return migrate_to_region(acc_id, source, user_arn, source_client, target_client, s3_client, bucket_name, stakeholder, done)
+
+    reports = {}
+    for target_client, report in zip(target_clients, parallel_map(migrate, target_clients, len(target_clients) or 1)):
+        if isinstance(report, Exception):
+            logger.error(f"The migration to {target_client['region']} failed.\nError: {report}")
+            report = {analysis_id: {"status": 'FAIL', "error": str(report)} for analysis_id in analysis_ids}
+        reports[target_client['region']] = {analysis_id: report[analysis_id] for analysis_id in analysis_ids if analysis_id in report}
+    return reports
+
+def migrate_analysis_handler(acc_id: str, analysis_id: str, user_arn: str, source_client: dict, target_client: dict, s3_client, bucket_name: str, stakeholder: str) -> int:
+    """Handles the migration function and saves the .qs file into the S3."""
+    try:
+        report = bulk_migrate_analysis_handler(acc_id, [analysis_id], user_arn, source_client, target_client, s3_client, bucket_name, stakeholder)
+        return 1 if report[analysis_id]['status'] == 'SUCCESS' else 0
 
     except Exception as e:
         logger.error(f'An error occurred in migrate_analysis_handler function.\nError: {e}')
@@ -117,13 +441,16 @@ def update_template_handler(client, acc_id: str, analysis_id: str, comment: str,
         dataset_references = create_dataset_references(client, acc_id, analysis_info['DataSetArns'])
 
         update_template(client, acc_id, analysis_info, comment, dataset_references)
+        wait = wait_for_resource(client, acc_id, 'template', analysis_id)
+        if not wait['ready']:
+            logger.error(f"Template {analysis_id} finished as {wait['status']} after {wait['seconds']}s.\nErrors: {wait['errors']}")
+            return 0
         template_info = describe_template(client, acc_id, analysis_id)
         analysis_definition = describe_analysis_definition(client, acc_id, analysis_id)
         datasets_definition = [describe_dataset(client, acc_id, extract_id_from_arn(arn)) for arn in analysis_info['DataSetArns']]
 
         for dataset in datasets_definition:
-            print(type(dataset), 'LogicalTableMap' in dataset)
-            print(dataset)
+            logger.debug(f'Dataset {dataset.get('DataSetId')} has a LogicalTableMap: {'LogicalTableMap' in dataset}')
             if 'LogicalTableMap' in dataset:
                 if dataset['LogicalTableMap'] and not dataset['PhysicalTableMap']:
                     logical_table = dataset['LogicalTableMap']
@@ -144,42 +471,53 @@ def update_template_handler(client, acc_id: str, analysis_id: str, comment: str,
         logger.error(f'An error occurred in update_template_handler function.\nError: {e}')
         return 0
 
-def create_dataset_handler(acc_id: str, database_id: str, user_arn: str, source_client: dict, target_client: dict) -> int:
-    """Handles the dataset creation."""
+def migrate_dataset(acc_id: str, dataset_info: dict, user_arn: str, target_client: dict, previous_fingerprints: dict, fingerprints: dict) -> str:
+    """Creates, updates or skips an already retargeted dataset in the target region. Returns its target Arn, 0 if it failed.
 
-    def switch_datasource_arn(dataset_info: dict) -> dict:
-        """Switches the datasource Arn of the source analysis to the target one to enable migration."""
+    Its hash is written into fingerprints only once the target is known to match it. A dataset tracked
+    before that failed keeps its previous hash, so it is still ours and is updated again on the next run.
+    Datasets that are not ours are never written, so they are never taken as migrated."""
+    target_arn = switch_region(dataset_info['Arn'], target_client['region'])
+    dataset_id = dataset_info['DataSetId']
+    current = dataset_fingerprint(dataset_info)
+    previous = previous_fingerprints.get(dataset_id)
 
-        if dataset_info['PhysicalTableMap']:
-            PhysicalTableMap_id = next(iter(dataset_info['PhysicalTableMap']))
-            dataset_info['PhysicalTableMap'][PhysicalTableMap_id]['CustomSql']['DataSourceArn'] = target_client['arn']
+    def migrated(arn):
+        fingerprints[dataset_id] = current
+        return arn
 
-        return dataset_info
+    def failed():
+        if previous is not None:
+            fingerprints[dataset_id] = previous
+        return 0
 
+    if previous is not None:
+        # The manifest only says the dataset was migrated, it may have been deleted from the target since then
+        if previous == current and describe_dataset(target_client['client'], acc_id, dataset_id):
+            logger.info(f'Dataset {dataset_info['Name']} is unchanged since the last migration, skipping it')
+            return migrated(target_arn)
+        if previous != current:
+            response = update_dataset(target_client['client'], acc_id, dataset_info, user_arn)
+            if response:
+                return migrated(response['Arn'])
+            if describe_dataset(target_client['client'], acc_id, dataset_id):
+                return failed()
+        logger.warning(f'Dataset {dataset_id} was migrated before but is not in {target_client['region']} anymore, creating it again')
+
+    response = create_dataset(client=target_client['client'], acc_id=acc_id, user_arn=user_arn, dataset_info=dataset_info)
+    if response == 2 and previous is not None:
+        # The describe failed for another reason than a missing dataset, it is there after all
+        return migrated(target_arn) if previous == current else failed()
+    if response == 2:
+        # Not created by a migration tracked in the manifest, so it is not ours to overwrite
+        logger.warning(f'Dataset {dataset_id} already exists in {target_client['region']} and was not migrated by this tool, leaving it as it is')
+        return target_arn
+    return migrated(response['Arn']) if response else failed()
+
+def create_dataset_handler(acc_id: str, database_id: str, user_arn: str, source_client: dict, target_client: dict, previous_fingerprints: dict = None, fingerprints: dict = None) -> int:
+    """Handles the dataset creation, creating first the datasets it joins. Returns its target Arn, 0 if it failed"""
     try:
-        dataset_info = describe_dataset(client=source_client['client'], acc_id=acc_id, database_id=database_id)
-        
-        #Verificando se é um Dataset de JOIN
-        if dataset_info['LogicalTableMap'] and not dataset_info['PhysicalTableMap']:
-            logical_table = dataset_info['LogicalTableMap']
-
-            for id, logical_table_info in logical_table.items():
-                # Intermediate Table is the table were the JOIN happens
-                if logical_table_info['Alias'] != 'Intermediate Table':
-                    join_dataset_info = describe_dataset(source_client['client'], acc_id, extract_id_from_arn(logical_table_info['Source']['DataSetArn']))
-                    join_dataset_info = switch_arn(join_dataset_info)
-
-                    create_dataset(client=target_client['client'], acc_id=acc_id, user_arn=user_arn, dataset_info=join_dataset_info)
-                    dataset_info['LogicalTableMap'][id]['Source']['DataSetArn'] = logical_table_info['Source']['DataSetArn'].replace(source_client['region'], target_client['region'])
-        
-        else:
-            dataset_info = switch_datasource_arn(dataset_info)
-
-        response = create_dataset(client=target_client['client'], acc_id=acc_id, user_arn=user_arn, dataset_info=dataset_info)
-        
-        if response == 2:
-            return dataset_info['Arn'].replace(source_client['region'], target_client['region'])
-        return response['Arn']
+        return migrate_datasets(acc_id, [database_id], user_arn, source_client, target_client, previous_fingerprints, fingerprints).get(database_id, 0)
     except Exception as e:
         logger.error(f'An error occurred in create_dataset_handler function.\nError Message: {e}')
         return 0
@@ -192,8 +530,16 @@ def create_template_handler(client, acc_id: str, analysis_id: str, comment: str,
         dataset_references = create_dataset_references(client, acc_id, analysis_info['DataSetArns'])
 
         # Attempt to create the template, return 2 if it fails
-        if not create_template(client, acc_id, analysis_info, comment, dataset_references):
-            return 2
+        with step('template.create'):
+            if not create_template(client, acc_id, analysis_info, comment, dataset_references):
+                return 2
+
+        # The template version is built asynchronously, it can only be described once it settles
+        with step('template.wait'):
+            wait = wait_for_resource(client, acc_id, 'template', analysis_id)
+        if not wait['ready']:
+            logger.error(f"Template {analysis_id} finished as {wait['status']} after {wait['seconds']}s.\nErrors: {wait['errors']}")
+            return 0
 
         # Gather additional data to build the template metadata
         template_info = describe_template(client, acc_id, analysis_id)
@@ -205,7 +551,8 @@ def create_template_handler(client, acc_id: str, analysis_id: str, comment: str,
 
         # Create metadata and upload to S3
         info = create_metadata(email, template_info, analysis_definition, datasets_definition, comment)
-        handle_s3_upload(info, s3_client, bucket_name, stakeholder)
+        with step('template.snapshot'):
+            handle_s3_upload(info, s3_client, bucket_name, stakeholder)
 
         logger.info('Template created successfully')
         return 1
@@ -214,6 +561,212 @@ def create_template_handler(client, acc_id: str, analysis_id: str, comment: str,
         logger.error(f'An error occurred in create_template_handler function.\nError: {e}')
         return 0
     
+def backup_analysis(client, acc_id: str, analysis_id: str, comment: str, email: str, s3_client, bucket_name: str, stakeholder: str) -> str:
+    """Creates the template of the analysis, or a new version when it already exists, and saves its snapshot
+
+    Returns:
+        str: CREATED, UPDATED or FAIL
+    """
+    result = create_template_handler(client, acc_id, analysis_id, comment, email, s3_client, bucket_name, stakeholder)
+    if result == 2:
+        return 'UPDATED' if update_template_handler(client, acc_id, analysis_id, comment, email, s3_client, bucket_name, stakeholder) == 1 else 'FAIL'
+    return 'CREATED' if result == 1 else 'FAIL'
+
+def list_backup_analyses(client, acc_id: str, folder_id: str = None, name_prefix: str = None) -> list[str]:
+    """Ids of the analyses of the region to back up: the built ones, optionally only the members of a folder or the names starting with name_prefix"""
+    members = set(iter_folder_members(client, acc_id, folder_id)) if folder_id else None
+    return [
+        analysis['Id'] for analysis in iter_analyses(client, acc_id)
+        if analysis['Status'] in SUCCESS_STATES
+        and (members is None or analysis['Id'] in members)
+        and (not name_prefix or analysis['Name'].lower().startswith(name_prefix.lower()))
+    ]
+
+def backup_all_handler(client, acc_id: str, comment: str, email: str, s3_client, bucket_name: str, stakeholder: str, folder_id: str = None, name_prefix: str = None, remaining_time=None) -> dict:
+    """Backs up every analysis of the region (TEMPLATE_CREATION or TEMPLATE_UPDATE of each one) on a bounded worker pool.
+
+    The progress is checkpointed in the bucket after each analysis. When remaining_time gets below
+    the margin no analysis is started anymore, and the next run with the same region and filters
+    resumes from the checkpoint instead of starting over. The margin is BACKUP_TIME_MARGIN, capped to
+    a fifth of the time left at the start, and the first analysis is always started, so a short
+    Lambda timeout still makes progress on every run.
+
+    Args:
+        folder_id (str): only back up the analyses of this QuickSight folder
+        name_prefix (str): only back up the analyses whose name starts with it
+        remaining_time (callable): seconds left to run, e.g. from the Lambda context. None never stops
+
+    Returns:
+        dict: status (COMPLETE or INCOMPLETE), counts, result of each analysis and the checkpoint key
+    """
+    margin = min(BACKUP_TIME_MARGIN, 0.2 * remaining_time()) if remaining_time is not None else None
+    region = client.meta.region_name
+    run = fingerprint({'region': region, 'folder_id': folder_id, 'name_prefix': name_prefix})[:16]
+    checkpoint = Checkpoint.resume(
+        s3_client, bucket_name, checkpoint_key(stakeholder, f'backup_{run}'),
+        lambda: {'name': 'BACKUP_ALL', 'region': region, 'folder_id': folder_id, 'name_prefix': name_prefix, 'items': list_backup_analyses(client, acc_id, folder_id, name_prefix)}
+    )
+    pending = checkpoint.pending
+    total = len(checkpoint.state['items'])
+    done = itertools.count(total - len(pending) + 1)
+    report_progress(f'{len(pending)} of {total} analyses to back up', done=total - len(pending), total=total)
+
+    def out_of_time() -> bool:
+        return remaining_time is not None and remaining_time() < margin
+
+    def backup(analysis_id):
+        try:
+            result = backup_analysis(client, acc_id, analysis_id, comment, email, s3_client, bucket_name, stakeholder)
+        except Exception as e:
+            logger.error(f'The backup of {analysis_id} failed.\nError: {e}')
+            result = 'FAIL'
+        checkpoint.record(analysis_id, result)
+        report_progress(f'Analysis {analysis_id} backed up: {result}', done=next(done))
+
+    with step('backup.analyses'), ThreadPoolExecutor(max_workers=BACKUP_MAX_WORKERS) as executor:
+        queue = iter(pending)
+        running = set()
+        started = 0
+        while True:
+            # Analyses are started one by one, so the pool stops taking new ones as soon as time runs short
+            while len(running) < BACKUP_MAX_WORKERS and (not started or not out_of_time()):
+                analysis_id = next(queue, None)
+                if analysis_id is None:
+                    break
+                running.add(executor.submit(copy_context().run, backup, analysis_id))
+                started += 1
+            if not running:
+                break
+            _, running = wait_futures(running, return_when=FIRST_COMPLETED)
+
+    remaining = checkpoint.pending
+    checkpoint.finish(complete=not remaining)
+    results = checkpoint.state['results']
+    if remaining:
+        logger.warning(f'Stopped with {len(remaining)} analyses left, run BACKUP_ALL again to resume from {checkpoint.key}')
+    return {
+        'status': 'INCOMPLETE' if remaining else 'COMPLETE',
+        'total': total,
+        'done': len(results),
+        'failed': sorted(analysis_id for analysis_id, result in results.items() if result == 'FAIL'),
+        'pending': len(remaining),
+        'results': results,
+        'checkpoint': checkpoint.key,
+    }
+
+def resolve_principals(client, acc_id: str, principals: dict[str, str]) -> dict[str, str]:
+    """Replaces the emails of principals -> level by the ARNs of their users. ARNs (users or groups) are kept as they are"""
+    resolved = {}
+    unknown = []
+    for principal, level in principals.items():
+        arn = principal if principal.startswith('arn:') else search_user(client, acc_id, principal)
+        if arn:
+            resolved[arn] = level
+        else:
+            unknown.append(principal)
+    if unknown:
+        raise ValueError(f"Unknown principals: {', '.join(unknown)}")
+    return resolved
+
+def permission_sync_handler(client, acc_id: str, principals: dict[str, str], analysis_ids: list[str], dataset_ids: list[str] = None, user_client=None, include_datasets: bool = False, dry_run: bool = False) -> dict:
+    """Gives each principal exactly its level (owner, viewer or none) on the analyses and datasets, see sync_permissions.
+
+    Args:
+        principals (dict[str, str]): email or ARN -> level
+        user_client: client of the identity region used to find the users by email. None uses client
+        include_datasets (bool): also give the principals their level on the datasets used by the analyses.
+            Nothing is revoked from those datasets, as other analyses may need them
+        dry_run (bool): only report what would change
+
+    Returns:
+        dict: report of each analysis and dataset, the total of grants and revokes and the resources that failed
+    """
+    principals = resolve_principals(user_client or client, acc_id, principals)
+    resources = [('analysis', analysis_id) for analysis_id in analysis_ids]
+    resources += [('dataset', dataset_id) for dataset_id in dataset_ids or []]
+    reports = sync_permissions(client, acc_id, resources, principals, dry_run)
+
+    if include_datasets:
+        with step('permissions.describe_analyses'):
+            analyses = parallel_map(lambda analysis_id: describe_analysis(client, acc_id, analysis_id), analysis_ids, PERMISSION_MAX_WORKERS)
+        used_datasets = list(dict.fromkeys(
+            extract_id_from_arn(arn)
+            for analysis in analyses if isinstance(analysis, dict)
+            for arn in analysis['DataSetArns']
+            if extract_id_from_arn(arn) not in (dataset_ids or [])
+        ))
+        granted = {principal: level for principal, level in principals.items() if level != 'none'}
+        if used_datasets and granted:
+            logger.info(f'Syncing the permissions of {len(used_datasets)} datasets used by the analyses')
+            reports += sync_permissions(client, acc_id, [('dataset', dataset_id) for dataset_id in used_datasets], granted, dry_run, grant_only=True)
+
+    return {
+        'dry_run': dry_run,
+        'analyses': {report['id']: report for report in reports if report['kind'] == 'analysis'},
+        'datasets': {report['id']: report for report in reports if report['kind'] == 'dataset'},
+        'grants': sum(len(report['grant']) for report in reports),
+        'revokes': sum(len(report['revoke']) for report in reports),
+        'failed': [f"{report['kind']}/{report['id']}" for report in reports if report['status'] == 'FAIL'],
+    }
+
+def dataset_dependents_handler(client, acc_id: str, dataset_ids: list[str], s3_client, bucket_name: str, refresh: bool = False) -> dict:
+    """Answers what depends on each dataset (the datasets joining it, the analyses and the templates) from the
+    dependency index of the region. The index is refreshed first when it is older than DEPENDENCY_INDEX_MAX_AGE
+    or refresh is set, describing only what changed, and then saved in the bucket
+
+    Returns:
+        dict: region, when the index was refreshed, the refresh stats (None when it was not) and the dependents of each dataset
+    """
+    region = client.meta.region_name
+    index = get_dependency_index(s3_client=s3_client, bucket_name=bucket_name)
+    refreshed_at = index.refreshed_at(region)
+    stats = None
+    if refresh or refreshed_at is None or time.time() - refreshed_at > DEPENDENCY_INDEX_MAX_AGE:
+        with step('dependencies.refresh'):
+            stats = index.refresh(client, acc_id)
+        try:
+            index.save(s3_client, bucket_name)
+        except Exception as e:
+            logger.warning(f'The dependency index could not be saved in the bucket: {e}')
+    return {
+        'region': region,
+        'refreshed_at': datetime.datetime.fromtimestamp(index.refreshed_at(region)).strftime('%d-%m-%Y %H:%M:%S'),
+        'refresh': stats,
+        'dependents': {dataset_id: index.dependents(region, dataset_id) for dataset_id in dataset_ids},
+    }
+
+def update_analysis_from_snapshot_handler(client, acc_id: str, analysis_id: str, version: str, user_arn: str, s3_client, bucket_name: str, stakeholder: str, as_of: str = None) -> int:
+    """Rebuilds the analysis from the definition saved in the S3, without describing the template or its datasets.
+    Works even when the template version was deleted. Without version, as_of (dd-mm-YYYY HH:MM:SS) restores the
+    latest version saved until then."""
+    try:
+        entry = find_version(read_manifest(s3_client, bucket_name, stakeholder, analysis_id), version, as_of)
+        if not entry:
+            logger.error(f'No snapshot of the version {version or "latest"}{f" as of {as_of}" if as_of and not version else ""} was found for {analysis_id}, run REBUILD_MANIFESTS if it was saved before the manifests')
+            return 0
+
+        if entry.get('definition_key'):
+            analysis_definition = read_snapshot(s3_client, bucket_name, entry['definition_key'])
+        else:
+            # Blob snapshots only download the blobs of the analysis, not the ones of the datasets
+            analysis_definition = load_snapshot(s3_client, bucket_name, entry['key'], ('analysis_definition',))['analysis_definition']
+        analysis_definition['Id'] = analysis_id
+        logger.info(f"Restoring {analysis_id} from the snapshot version {entry['version']} of {entry['date']}")
+
+        result = update_analysis_by_definition(client, acc_id, analysis_definition)
+        if result == 2:
+            logger.info("Starting to recreate the analysis based on the snapshot")
+            result = create_analysis_by_definition(client, acc_id, analysis_definition)
+            if result and wait_for_resource(client, acc_id, 'analysis', analysis_id)['ready']:
+                grant_auth(client, acc_id, analysis_id, user_arn)
+            else:
+                result = 0
+
+        return 1 if result else 0
+    except Exception as e:
+        logger.error(f'An error occurred in update_analysis_from_snapshot_handler function.\nError Message: {e}')
+        return 0
+
 def update_analysis_handler(client, acc_id: str, analysis_id: str, version: str, user_arn: str) -> int:
     """Handles the update of the analysis."""
     try:
@@ -223,7 +776,10 @@ def update_analysis_handler(client, acc_id: str, analysis_id: str, version: str,
         
         if update_analysis(client, acc_id, analysis_info, template_info, dataset_references) == 2:
             logger.info("Starting to recreate the analysis based on the template")
-            create_analysis(client, acc_id, analysis_info, template_info, dataset_references)
+            if not create_analysis(client, acc_id, analysis_info, template_info, dataset_references) == 1:
+                return 0
+            if not wait_for_resource(client, acc_id, 'analysis', analysis_info['Id'])['ready']:
+                return 0
             grant_auth(client, acc_id, analysis_info['Id'], user_arn)
         
         return 1
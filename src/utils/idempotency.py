@@ -0,0 +1,279 @@
+import os
+import copy
+import json
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+from utils.clients import get_client
+from utils.storage import encode_json, is_conflict, is_not_found
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_ENABLED = os.environ.get('IDEMPOTENCY_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# s3 shares the records between Lambda instances, at the cost of two S3 calls per mutating request
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'memory') # memory | file | s3
+IDEMPOTENCY_STORE_BUCKET = os.environ.get('IDEMPOTENCY_STORE_BUCKET') or os.environ.get('BUCKET')
+IDEMPOTENCY_STORE_PATH = os.environ.get('IDEMPOTENCY_STORE_PATH', '/tmp/idempotency')
+IDEMPOTENCY_STORE_PREFIX = os.environ.get('IDEMPOTENCY_STORE_PREFIX', 'idempotency')
+# Seconds a successful result is replayed to repeated requests. 0 only joins the requests that are still running
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 300))
+# Seconds after which a RUNNING record is taken as abandoned (its process died), the Lambda maximum timeout by default
+IDEMPOTENCY_LOCK_TTL = float(os.environ.get('IDEMPOTENCY_LOCK_TTL', 900))
+
+# A record is {"status": RUNNING | DONE, "response": ..., "expires_at": <epoch>}. Expired records are ignored.
+
+class IdempotencyStore(ABC):
+    """Interface of the idempotency stores"""
+    @abstractmethod
+    def claim(self, key: str, record: dict) -> dict:
+        """Saves the record only when the key has no live record. Returns None when it was saved, the live record otherwise"""
+
+    @abstractmethod
+    def get(self, key: str) -> dict:
+        ...
+
+    @abstractmethod
+    def save(self, key: str, record: dict):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+def _is_live(record: dict) -> bool:
+    return record is not None and record['expires_at'] > time.time()
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    def __init__(self) -> None:
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key: str, record: dict) -> dict:
+        with self._lock:
+            current = self._records.get(key)
+            if _is_live(current):
+                return copy.deepcopy(current)
+            self._records[key] = copy.deepcopy(record)
+            return None
+
+    def get(self, key: str) -> dict:
+        with self._lock:
+            record = self._records.get(key)
+            return copy.deepcopy(record) if _is_live(record) else None
+
+    def save(self, key: str, record: dict):
+        with self._lock:
+            self._records[key] = copy.deepcopy(record)
+            # Expired records are dropped on write, so the store does not grow with every request
+            for expired in [key for key, record in self._records.items() if not _is_live(record)]:
+                del self._records[expired]
+
+    def delete(self, key: str):
+        with self._lock:
+            self._records.pop(key, None)
+
+class FileIdempotencyStore(IdempotencyStore):
+    def __init__(self, directory: str = IDEMPOTENCY_STORE_PATH) -> None:
+        """Keeps one json file per key inside the directory, shared by every process that uses it (e.g. uvicorn workers).
+        The claim creates the file exclusively, so only one process runs each key"""
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{os.path.basename(key).replace(':', '_')}.json")
+
+    def _read(self, key: str) -> dict:
+        try:
+            with open(self._path(key), 'r', encoding='UTF-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def claim(self, key: str, record: dict) -> dict:
+        for _ in range(2):
+            try:
+                descriptor = os.open(self._path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                current = self._read(key)
+                if _is_live(current):
+                    return current
+                # Expired (or being written): removed and claimed again
+                if current is not None:
+                    self.delete(key)
+                continue
+            with os.fdopen(descriptor, 'w', encoding='UTF-8') as file:
+                json.dump(record, file, default=str, ensure_ascii=False)
+            return None
+        return self._read(key) or record
+
+    def get(self, key: str) -> dict:
+        record = self._read(key)
+        return record if _is_live(record) else None
+
+    def save(self, key: str, record: dict):
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as file:
+            json.dump(record, file, default=str, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+class S3IdempotencyStore(IdempotencyStore):
+    def __init__(self, bucket_name: str = IDEMPOTENCY_STORE_BUCKET, prefix: str = IDEMPOTENCY_STORE_PREFIX, s3_client=None) -> None:
+        """Keeps one json object per key in the bucket, shared by every Lambda instance.
+        The claim is a conditional put, so only one instance runs each key"""
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = s3_client or get_client('s3')
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key.replace('/', '_')}.json"
+
+    def _read(self, key: str) -> tuple[dict, str]:
+        """Record and ETag of the key, (None, None) when it does not exist"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self._key(key))
+            return json.loads(response['Body'].read()), response.get('ETag')
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            return None, None
+
+    def _put(self, key: str, record: dict, **condition):
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self._key(key), Body=encode_json(record), ContentType='application/json', **condition)
+
+    def claim(self, key: str, record: dict) -> dict:
+        for _ in range(2):
+            try:
+                self._put(key, record, IfNoneMatch='*')
+                return None
+            except Exception as e:
+                if not is_conflict(e):
+                    raise
+            current, etag = self._read(key)
+            if _is_live(current):
+                return current
+            if current is None:
+                continue
+            # Expired: replaced only if nobody replaced it since it was read
+            try:
+                self._put(key, record, IfMatch=etag)
+                return None
+            except Exception as e:
+                if not (is_conflict(e) or is_not_found(e)):
+                    raise
+        return self._read(key)[0] or record
+
+    def get(self, key: str) -> dict:
+        record, _ = self._read(key)
+        return record if _is_live(record) else None
+
+    def save(self, key: str, record: dict):
+        self._put(key, record)
+
+    def delete(self, key: str):
+        self.s3_client.delete_object(Bucket=self.bucket_name, Key=self._key(key))
+
+def create_store(kind: str = IDEMPOTENCY_STORE) -> IdempotencyStore:
+    """Builds the idempotency store configured by IDEMPOTENCY_STORE"""
+    if kind == 's3':
+        if not IDEMPOTENCY_STORE_BUCKET:
+            raise ValueError('IDEMPOTENCY_STORE=s3 requires IDEMPOTENCY_STORE_BUCKET or BUCKET')
+        return S3IdempotencyStore(IDEMPOTENCY_STORE_BUCKET, IDEMPOTENCY_STORE_PREFIX)
+    if kind == 'file':
+        return FileIdempotencyStore(IDEMPOTENCY_STORE_PATH)
+    if kind == 'memory':
+        return InMemoryIdempotencyStore()
+    raise ValueError(f'Unknown idempotency store: {kind}')
+
+_store = None
+_lock = threading.Lock()
+
+def get_store() -> IdempotencyStore:
+    global _store
+    with _lock:
+        if _store is None:
+            _store = create_store()
+        return _store
+
+def set_store(store: IdempotencyStore):
+    """Replaces the idempotency store, e.g. by one shared by every Lambda instance"""
+    global _store
+    with _lock:
+        _store = store
+
+class _Execution():
+    """Request running in this process, joined by its concurrent duplicates"""
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        self.outcome = 'COALESCED'
+
+_in_flight: dict[str, _Execution] = {}
+_in_flight_lock = threading.Lock()
+
+def run_once(key: str, function, ttl: float = IDEMPOTENCY_TTL, cacheable=None) -> tuple:
+    """Runs function() once per key. A duplicate that arrives while it runs in this process waits for it and
+    gets the same response (or error); one that arrives up to ttl seconds after it finished gets the saved
+    response. A duplicate of a request still running in another process is not run, it gets IN_PROGRESS at once.
+
+    Args:
+        key (str): identifies the request, see lambda_function.idempotency_key
+        function (callable): work to run, its response must be json serializable for the file and s3 stores
+        ttl (float): seconds the response is replayed
+        cacheable (callable): tells if a response may be replayed. Failures are never replayed, the next request runs again
+
+    Returns:
+        tuple: the response (None when IN_PROGRESS) and how it was obtained: EXECUTED, COALESCED, REPLAYED or IN_PROGRESS
+    """
+    with _in_flight_lock:
+        execution = _in_flight.get(key)
+        owner = execution is None
+        if owner:
+            execution = _in_flight[key] = _Execution()
+    if not owner:
+        # Running in this process: waits for it and shares its outcome
+        execution.done.wait()
+        if execution.error is not None:
+            raise execution.error
+        logger.info(f'Request {key} joined the execution already running')
+        return copy.deepcopy(execution.response), execution.outcome
+
+    # The store is only called by the owner of the key, out of the lock, so the keys do not wait on each other
+    store = get_store()
+    claimed = False
+    try:
+        record = store.claim(key, {'status': 'RUNNING', 'expires_at': time.time() + IDEMPOTENCY_LOCK_TTL})
+        claimed = record is None
+        if claimed:
+            execution.response = function()
+            execution.outcome = 'EXECUTED'
+        elif record['status'] == 'DONE':
+            logger.info(f'Request {key} already done, replaying its response')
+            execution.response, execution.outcome = record['response'], 'REPLAYED'
+        else:
+            logger.info(f'Request {key} is running in another process')
+            execution.outcome = 'IN_PROGRESS'
+    except Exception as e:
+        execution.error = e
+        raise
+    finally:
+        if claimed:
+            try:
+                if execution.error is None and ttl > 0 and (cacheable is None or cacheable(execution.response)):
+                    store.save(key, {'status': 'DONE', 'response': execution.response, 'expires_at': time.time() + ttl})
+                else:
+                    store.delete(key)
+            except Exception as e:
+                logger.warning(f'Could not save the idempotency record {key}: {e}')
+        with _in_flight_lock:
+            del _in_flight[key]
+        execution.done.set()
+    return copy.deepcopy(execution.response), execution.outcome
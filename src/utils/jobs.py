@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from utils.clients import get_client
+from utils.storage import encode_json, is_not_found
+
+logger = logging.getLogger(__name__)
+
+# Inside Lambda the thread of an invocation is frozen once its response is returned, and the next
+# request may reach another instance. So there each job runs in an asynchronous invocation of the
+# function itself and its state is kept in the bucket, which every instance reads.
+JOB_FUNCTION_NAME = os.environ.get('JOB_FUNCTION_NAME') or os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+JOB_STORE_BUCKET = os.environ.get('JOB_STORE_BUCKET') or os.environ.get('BUCKET')
+JOB_STORE = os.environ.get('JOB_STORE') or ('s3' if JOB_FUNCTION_NAME and JOB_STORE_BUCKET else 'memory') # memory | file | s3
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', '/tmp/jobs')
+JOB_STORE_PREFIX = os.environ.get('JOB_STORE_PREFIX', 'jobs')
+JOB_MAX_WORKERS = int(os.environ.get('JOB_MAX_WORKERS', 4))
+
+class JobStore(ABC):
+    """Interface of the job stores. A job is a json serializable dict identified by its id."""
+    @abstractmethod
+    def save(self, job: dict):
+        ...
+
+    @abstractmethod
+    def get(self, job_id: str) -> dict:
+        ...
+
+    @abstractmethod
+    def update(self, job_id: str, **fields) -> dict:
+        ...
+
+class InMemoryJobStore(JobStore):
+    def __init__(self) -> None:
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def save(self, job: dict):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+
+    def get(self, job_id: str) -> dict:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id: str, **fields) -> dict:
+        with self._lock:
+            self._jobs[job_id].update(fields, updated_at=time.time())
+            return dict(self._jobs[job_id])
+
+class FileJobStore(JobStore):
+    def __init__(self, directory: str = JOB_STORE_PATH) -> None:
+        """Keeps one json file per job inside the directory"""
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f'{os.path.basename(job_id)}.json')
+
+    def save(self, job: dict):
+        path = self._path(job['id'])
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as file:
+            json.dump(job, file, default=str, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def get(self, job_id: str) -> dict:
+        try:
+            with open(self._path(job_id), 'r', encoding='UTF-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def update(self, job_id: str, **fields) -> dict:
+        with self._lock:
+            job = self.get(job_id)
+            job.update(fields, updated_at=time.time())
+            self.save(job)
+            return job
+
+class S3JobStore(JobStore):
+    def __init__(self, bucket_name: str = JOB_STORE_BUCKET, prefix: str = JOB_STORE_PREFIX, s3_client=None) -> None:
+        """Keeps one json object per job in the bucket, shared by every Lambda instance"""
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = s3_client or get_client('s3')
+        self._lock = threading.Lock()
+
+    def _key(self, job_id: str) -> str:
+        return f'{self.prefix}/{os.path.basename(job_id)}.json'
+
+    def save(self, job: dict):
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self._key(job['id']), Body=encode_json(job), ContentType='application/json')
+
+    def get(self, job_id: str) -> dict:
+        try:
+            return json.loads(self.s3_client.get_object(Bucket=self.bucket_name, Key=self._key(job_id))['Body'].read())
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            return None
+
+    def update(self, job_id: str, **fields) -> dict:
+        # A job is only written by the invocation running it, the lock orders its own threads
+        with self._lock:
+            job = self.get(job_id)
+            job.update(fields, updated_at=time.time())
+            self.save(job)
+            return job
+
+def create_store(kind: str = JOB_STORE) -> JobStore:
+    """Builds the job store configured by JOB_STORE"""
+    if kind == 's3':
+        if not JOB_STORE_BUCKET:
+            raise ValueError('JOB_STORE=s3 requires JOB_STORE_BUCKET or BUCKET')
+        return S3JobStore(JOB_STORE_BUCKET, JOB_STORE_PREFIX)
+    if kind == 'file':
+        return FileJobStore(JOB_STORE_PATH)
+    if kind == 'memory':
+        return InMemoryJobStore()
+    raise ValueError(f'Unknown job store: {kind}')
+
+_store = None
+_executor = None
+_lock = threading.Lock()
+_current_job: ContextVar[str] = ContextVar('current_job', default=None)
+
+def get_store() -> JobStore:
+    global _store
+    with _lock:
+        if _store is None:
+            _store = create_store()
+        return _store
+
+def set_store(store: JobStore):
+    """Replaces the job store, e.g. by an InMemoryJobStore on tests"""
+    global _store
+    with _lock:
+        _store = store
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix='job')
+        return _executor
+
+def run_job(job_id: str, function, *args, **kwargs):
+    """Runs a submitted job in this invocation, saving its status and result"""
+    _run(job_id, function, args, kwargs)
+    return get_job(job_id)
+
+def is_job_invocation(event) -> bool:
+    """True for the asynchronous invocations made by submit_job"""
+    return isinstance(event, dict) and 'job_id' in event and 'job_event' in event
+
+def _run(job_id: str, function, args: tuple, kwargs: dict):
+    store = get_store()
+    # Reset afterwards, a warm Lambda or a pool thread runs other requests in the same context later
+    token = _current_job.set(job_id)
+    try:
+        store.update(job_id, status='RUNNING', started_at=time.time())
+        try:
+            result = function(*args, **kwargs)
+            store.update(job_id, status='SUCCEEDED', result=result, finished_at=time.time())
+        except Exception as e:
+            logger.error(f'Job {job_id} failed.\nError: {e}')
+            store.update(job_id, status='FAILED', error={'Error': type(e).__name__, 'Error Message': str(getattr(e, 'detail', e))}, finished_at=time.time())
+    finally:
+        _current_job.reset(token)
+
+def submit_job(function, *args, description: str = None, event: dict = None, **kwargs) -> str:
+    """Runs the function in background and returns the job id used to follow it
+
+    Args:
+        function (callable): work to run
+        description (str): text shown in the job status
+        event (dict): lambda event of the job. Inside Lambda the job runs in an asynchronous invocation
+            of the function with {"job_id", "job_event": event} instead of a thread of this one
+
+    Returns:
+        str: job id
+    """
+    job_id = uuid.uuid4().hex
+    get_store().save({
+        'id': job_id,
+        'description': description,
+        'status': 'QUEUED',
+        'progress': {'done': 0, 'total': None, 'message': None},
+        'result': None,
+        'error': None,
+        'created_at': time.time(),
+        'updated_at': time.time(),
+    })
+    if JOB_FUNCTION_NAME and event is not None:
+        try:
+            get_client('lambda').invoke(FunctionName=JOB_FUNCTION_NAME, InvocationType='Event', Payload=encode_json({'job_id': job_id, 'job_event': event}))
+        except Exception as e:
+            logger.error(f'Job {job_id} could not be started.\nError: {e}')
+            get_store().update(job_id, status='FAILED', error={'Error': type(e).__name__, 'Error Message': str(e)}, finished_at=time.time())
+        return job_id
+    _get_executor().submit(_run, job_id, function, args, kwargs)
+    return job_id
+
+def get_job(job_id: str) -> dict:
+    """Returns the job status, progress and result. None if the job does not exist"""
+    return get_store().get(job_id)
+
+def report_progress(message: str = None, done: int = None, total: int = None):
+    """Updates the progress of the job running in the current context. Does nothing outside of a job"""
+    job_id = _current_job.get()
+    if job_id is None:
+        return
+    try:
+        store = get_store()
+        progress = dict(store.get(job_id)['progress'])
+        progress.update({key: value for key, value in (('message', message), ('done', done), ('total', total)) if value is not None})
+        store.update(job_id, progress=progress)
+    except Exception as e:
+        logger.warning(f'Could not update the progress of the job {job_id}: {e}')
@@ -0,0 +1,90 @@
+import os
+import queue
+import atexit
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_FILE = os.environ.get('LOG_FILE', 'logs/logs.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Maximum log lines kept for the response of a single request
+LOG_BUFFER_SIZE = int(os.environ.get('LOG_BUFFER_SIZE', 1000))
+
+_request_buffer: ContextVar[deque] = ContextVar('request_log_buffer', default=None)
+_log_sink: ContextVar = ContextVar('log_sink', default=None)
+_listener = None
+_lock = threading.Lock()
+
+class RequestBufferHandler(logging.Handler):
+    """Appends each record to the ring buffer of the request running in the current context,
+    and hands it to the log sink of the context, when there is one"""
+    def emit(self, record: logging.LogRecord):
+        buffer = _request_buffer.get()
+        sink = _log_sink.get()
+        if buffer is None and sink is None:
+            return
+        try:
+            line = self.format(record)
+            if buffer is not None:
+                buffer.append(line)
+            if sink is not None:
+                sink(line)
+        except Exception:
+            self.handleError(record)
+
+def setup_logging():
+    """Configures the root logger once: the request buffer is written synchronously and the
+    file/console output goes through a queue, so logging never waits on I/O"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        formatter = logging.Formatter(LOG_FORMAT)
+        handlers = [logging.StreamHandler()]
+        if LOG_FILE:
+            try:
+                os.makedirs(os.path.dirname(LOG_FILE) or '.', exist_ok=True)
+                handlers.append(logging.FileHandler(LOG_FILE, encoding='UTF-8'))
+            except OSError:
+                pass # read-only file system, console only
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue = queue.SimpleQueue()
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        buffer_handler = RequestBufferHandler()
+        buffer_handler.setFormatter(formatter)
+        root = logging.getLogger()
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(QueueHandler(log_queue))
+        root.addHandler(buffer_handler)
+
+@contextmanager
+def request_logs(size: int = LOG_BUFFER_SIZE):
+    """Collects the log lines of everything called inside it, threads of parallel_map included"""
+    token = _request_buffer.set(deque(maxlen=size))
+    try:
+        yield _request_buffer.get()
+    finally:
+        _request_buffer.reset(token)
+
+@contextmanager
+def log_sink(sink):
+    """Calls sink(line) for each log line written inside it, as it is written. Used to stream the logs of a request"""
+    token = _log_sink.set(sink)
+    try:
+        yield
+    finally:
+        _log_sink.reset(token)
+
+def request_log_lines() -> list[str]:
+    """Log lines of the current request"""
+    buffer = _request_buffer.get()
+    return list(buffer) if buffer is not None else []
@@ -0,0 +1,219 @@
+import sys
+import json
+import time
+import random
+import hashlib
+import datetime
+import logging
+from utils.storage import encode_json, read_snapshot, is_conflict, is_not_found
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = 'quicksight_templates'
+# Folder of the content addressed blobs of the snapshots, see utils.blobs
+BLOB_FOLDER = '_blobs'
+DATE_FORMAT = '%d-%m-%Y %H:%M:%S'
+# Writes of a manifest tried before giving up when other writers keep changing it
+MANIFEST_MAX_ATTEMPTS = 8
+
+# Every snapshot uploaded by s3_upload_file is indexed in a small manifest per
+# stakeholder/analysis, so finding a version needs a single GET instead of a prefix
+# scan followed by downloads:
+#   quicksight_templates/<STAKEHOLDER>/_manifests/<template_id>.json
+#   {"template_id", "name", "versions": [{version, date, author, comment, key, size, sha256, definition_key, format}],
+#    "migrations": {<target region>: {date, analysis, datasets}}}
+# Lambda instances, jobs and the migrations to many regions change the same manifest concurrently, so
+# every change is written conditionally on the ETag it was read with, see change_manifest.
+
+def stakeholder_prefix(stakeholder: str) -> str:
+    return f"{SNAPSHOT_PREFIX}/{stakeholder.upper() if stakeholder else 'OMOTOR'}"
+
+def manifest_key(stakeholder: str, template_id: str) -> str:
+    return f'{stakeholder_prefix(stakeholder)}/_manifests/{template_id}.json'
+
+def definition_key(snapshot_key: str) -> str:
+    """Key of the object holding only the analysis definition of a snapshot"""
+    return snapshot_key.removesuffix('.json') + '.definition.json'
+
+def snapshot_version(data: dict):
+    """Version of a snapshot in its key and manifest: the template version, or migration_<target region>
+    for a migration, so the migrations of one analysis to many regions don't overwrite each other"""
+    if data['version'] != 0:
+        return data['version']
+    return f"migration_{data['target_region']}" if data.get('target_region') else 'migration'
+
+def is_migration(entry: dict) -> bool:
+    return str(entry['version']).startswith('migration')
+
+def manifest_entry(data: dict, stored: dict) -> dict:
+    """Manifest line of a snapshot uploaded with put_snapshot"""
+    return {
+        'version': snapshot_version(data),
+        'date': data['date'],
+        'author': data['author'],
+        'comment': data['comment'],
+        'key': stored['key'],
+        'size': stored['size'],
+        'sha256': stored.get('sha256'),
+        'definition_key': stored.get('definition_key'),
+        'format': stored.get('format'),
+    }
+
+def read_manifest_version(s3_client, bucket_name: str, stakeholder: str, template_id: str) -> tuple[dict, str]:
+    """Returns the manifest of an analysis and its ETag. An empty one and None if it was never written"""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=manifest_key(stakeholder, template_id))
+        return json.loads(response['Body'].read()), response.get('ETag')
+    except Exception as e:
+        if not is_not_found(e):
+            raise
+        return {'template_id': template_id, 'name': None, 'versions': []}, None
+
+def read_manifest(s3_client, bucket_name: str, stakeholder: str, template_id: str) -> dict:
+    """Returns the manifest of an analysis, an empty one if it was never written"""
+    return read_manifest_version(s3_client, bucket_name, stakeholder, template_id)[0]
+
+def write_manifest(s3_client, bucket_name: str, stakeholder: str, manifest: dict, **condition):
+    manifest['versions'].sort(key=lambda entry: (is_migration(entry), str(entry['version']) if is_migration(entry) else '', _version_number(entry)))
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=manifest_key(stakeholder, manifest['template_id']),
+        Body=encode_json(manifest),
+        ContentType='application/json',
+        **condition
+    )
+
+def change_manifest(s3_client, bucket_name: str, stakeholder: str, template_id: str, change, current: tuple = None) -> dict:
+    """Applies change(manifest) and writes the manifest only if nobody wrote it since it was read (IfMatch on
+    its ETag, or IfNoneMatch when it did not exist). When another writer got there first the manifest is read
+    again and the change applied over it, so concurrent changes are never lost.
+
+    Args:
+        change (callable): changes the manifest in place, may run more than once
+        current (tuple): manifest and ETag the caller already read, skips the first read
+
+    Returns:
+        dict: the manifest written
+    """
+    for attempt in range(MANIFEST_MAX_ATTEMPTS):
+        manifest, etag = current if current and attempt == 0 else read_manifest_version(s3_client, bucket_name, stakeholder, template_id)
+        change(manifest)
+        try:
+            write_manifest(s3_client, bucket_name, stakeholder, manifest, **({'IfMatch': etag} if etag else {'IfNoneMatch': '*'}))
+            return manifest
+        except Exception as e:
+            # A manifest deleted since it was read fails the IfMatch as not found
+            if not (is_conflict(e) or is_not_found(e)):
+                raise
+        logger.info(f'The manifest of {template_id} was changed by another writer, applying the change again')
+        time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    raise RuntimeError(f'The manifest of {template_id} kept changing, the change was not saved after {MANIFEST_MAX_ATTEMPTS} attempts')
+
+def update_manifest(s3_client, bucket_name: str, stakeholder: str, data: dict, stored: dict, current: tuple = None) -> dict:
+    """Adds (or replaces) the entry of an uploaded snapshot in its manifest. current, the manifest and ETag
+    returned by read_manifest_version, skips the read when the caller already has it"""
+    entry = manifest_entry(data, stored)
+
+    def change(manifest):
+        manifest['name'] = data['name']
+        manifest['versions'] = [version for version in manifest['versions'] if version['version'] != entry['version']] + [entry]
+        record_migration(manifest, data)
+
+    return change_manifest(s3_client, bucket_name, stakeholder, data['template_id'], change, current)
+
+def update_migration_fingerprints(s3_client, bucket_name: str, stakeholder: str, template_id: str, fingerprints: dict):
+    """Saves new migration hashes when only the datasets changed and no snapshot was uploaded"""
+    try:
+        date = datetime.datetime.now().strftime(DATE_FORMAT)
+        change_manifest(s3_client, bucket_name, stakeholder, template_id, lambda manifest: record_migration(manifest, {'date': date, 'fingerprints': fingerprints}))
+    except Exception as e:
+        logger.error(f'The migration fingerprints of {template_id} could not be saved.\nError: {e}')
+
+def record_migration(manifest: dict, data: dict):
+    """Keeps the content hashes of the last migration to each region, used to skip unchanged resources"""
+    fingerprints = data.get('fingerprints')
+    if fingerprints:
+        manifest.setdefault('migrations', {})[fingerprints['target_region']] = {
+            'date': data['date'],
+            'analysis': fingerprints['analysis'],
+            'datasets': fingerprints['datasets'],
+        }
+
+def _version_number(entry: dict) -> int:
+    try:
+        return int(entry['version'])
+    except (TypeError, ValueError):
+        return -1
+
+def find_version(manifest: dict, version=None, as_of: str = None) -> dict:
+    """Finds a snapshot entry in the manifest
+
+    Args:
+        manifest (dict): manifest returned by read_manifest
+        version (str | int): version number or migration_<target region>. None returns the latest template version
+        as_of (str): date in the dd-mm-YYYY HH:MM:SS format, returns the latest version saved until then
+
+    Returns:
+        dict: manifest entry, None if nothing matches
+    """
+    entries = manifest.get('versions', [])
+    if version is not None and str(version) != '':
+        return next((entry for entry in entries if str(entry['version']) == str(version)), None)
+
+    entries = [entry for entry in entries if not is_migration(entry)]
+    if as_of:
+        limit = datetime.datetime.strptime(as_of, DATE_FORMAT)
+        entries = [entry for entry in entries if datetime.datetime.strptime(entry['date'], DATE_FORMAT) <= limit]
+    return max(entries, key=_version_number, default=None)
+
+def rebuild_manifests(s3_client, bucket_name: str, stakeholder: str = None) -> int:
+    """Regenerates the manifests from the snapshots already stored in the bucket
+
+    Args:
+        s3_client (class): s3 client
+        bucket_name (str): bucket of the snapshots
+        stakeholder (str): only rebuild this stakeholder. None rebuilds all of them
+
+    Returns:
+        int: number of manifests written, None if it failed
+    """
+    try:
+        prefix = f'{stakeholder_prefix(stakeholder)}/' if stakeholder else f'{SNAPSHOT_PREFIX}/'
+        manifests = {}
+        items = [item for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix) for item in page.get('Contents', [])]
+        keys = {item['Key'] for item in items}
+        for item in items:
+            parts = item['Key'].split('/')
+            # quicksight_templates/<STAKEHOLDER>/<name>/<file>.json
+            if len(parts) != 4 or parts[1] == BLOB_FOLDER or parts[2] in ('_manifests', '_checkpoints') or not parts[3].endswith('.json') or parts[3].endswith('.definition.json'):
+                continue
+            try:
+                data = read_snapshot(s3_client, bucket_name, item['Key'])
+                entry = manifest_entry(data, {
+                    'key': item['Key'],
+                    'size': item['Size'],
+                    'sha256': hashlib.sha256(encode_json(data)).hexdigest(),
+                    'definition_key': definition_key(item['Key']) if definition_key(item['Key']) in keys else None,
+                    'format': data.get('format'),
+                })
+            except Exception as e:
+                logger.warning(f'Skipping {item["Key"]} while rebuilding the manifests: {e}')
+                continue
+            manifest = manifests.setdefault((parts[1], data['template_id']), {'template_id': data['template_id'], 'name': data['name'], 'versions': []})
+            manifest['versions'] = [version for version in manifest['versions'] if version['version'] != entry['version']] + [entry]
+            record_migration(manifest, data)
+
+        for (folder, _), manifest in manifests.items():
+            write_manifest(s3_client, bucket_name, folder, manifest)
+        logger.info(f'{len(manifests)} manifests rebuilt in {bucket_name}/{prefix}')
+        return len(manifests)
+    except Exception as e:
+        logger.error(f'An error occurred in rebuild_manifests function.\nError: {e}')
+        return None
+
+if __name__ == '__main__':
+    # python -m utils.manifest <bucket> [stakeholder]
+    import boto3
+    if len(sys.argv) < 2:
+        sys.exit('usage: python -m utils.manifest <bucket> [stakeholder]')
+    print(rebuild_manifests(boto3.client('s3'), sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from utils.ratelimit import THROTTLING_CODES
+
+logger = logging.getLogger(__name__)
+
+# CloudWatch Embedded Metric Format lines are written at the end of each request. They are on
+# by default inside Lambda, where CloudWatch Logs turns them into metrics.
+METRICS_EMF = os.environ.get('METRICS_EMF', 'true' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'false').lower() in ('1', 'true', 'yes')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'QuickSightVersioning')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram():
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """(le, count) pairs of the prometheus buckets, +Inf included"""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((str(bound), total))
+        return pairs + [('+Inf', self.count)]
+
+class MetricsRegistry():
+    def __init__(self) -> None:
+        """Process wide counters and latency histograms, labelled by a tuple of label pairs"""
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, labels: dict, value: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict, value: float):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.histograms.setdefault(key, Histogram()).observe(value)
+
+    def render_prometheus(self) -> str:
+        """Text exposition format of every metric"""
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}' if pairs else ''
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {name} counter')
+                lines += [f'{name}{format_labels(labels)} {value}' for (key, labels), value in sorted(self.counters.items()) if key == name]
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (key, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if key != name:
+                        continue
+                    lines += [f'{name}_bucket{format_labels(labels, [("le", le)])} {count}' for le, count in histogram.cumulative()]
+                    lines.append(f'{name}_sum{format_labels(labels)} {round(histogram.sum, 6)}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+class RequestMetrics():
+    def __init__(self) -> None:
+        """Calls and step timings of a single request, shared by the threads of parallel_map"""
+        self.calls = {}
+        self.steps = {}
+        self._lock = threading.Lock()
+
+    def record_call(self, service: str, region: str, operation: str, seconds: float, status: str, retries: int):
+        key = f'{service}:{region}:{operation}'
+        with self._lock:
+            call = self.calls.setdefault(key, {'count': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'seconds': 0.0, 'max': 0.0, 'latencies': []})
+            call['count'] += 1
+            call['errors'] += status != 'ok'
+            call['retries'] += retries
+            call['seconds'] += seconds
+            call['max'] = max(call['max'], seconds)
+            call['latencies'].append(seconds)
+
+    def record_throttle(self, service: str, region: str, operation: str):
+        key = f'{service}:{region}:{operation}'
+        with self._lock:
+            self.calls.setdefault(key, {'count': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'seconds': 0.0, 'max': 0.0, 'latencies': []})['throttles'] += 1
+
+    def record_step(self, name: str, seconds: float):
+        with self._lock:
+            step = self.steps.setdefault(name, {'count': 0, 'seconds': 0.0})
+            step['count'] += 1
+            step['seconds'] += seconds
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                'api_calls': sum(call['count'] for call in self.calls.values()),
+                'api_seconds': round(sum(call['seconds'] for call in self.calls.values()), 3),
+                'calls': {
+                    key: {
+                        'count': call['count'], 'errors': call['errors'], 'retries': call['retries'], 'throttles': call['throttles'],
+                        'seconds': round(call['seconds'], 3), 'max': round(call['max'], 3)
+                    }
+                    for key, call in sorted(self.calls.items())
+                },
+                'steps': {name: {'count': step['count'], 'seconds': round(step['seconds'], 3)} for name, step in self.steps.items()},
+            }
+
+registry = MetricsRegistry()
+_request_metrics: ContextVar[RequestMetrics] = ContextVar('request_metrics', default=None)
+
+_emf_logger = logging.getLogger('metrics.emf')
+_emf_logger.propagate = False # EMF lines must be plain json, without the log format prefix
+
+def _emf_handler():
+    if not _emf_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _emf_logger.addHandler(handler)
+        _emf_logger.setLevel(logging.INFO)
+
+def emit_emf(metrics: RequestMetrics, dimensions: dict = None):
+    """Writes one EMF line per (service, region, operation) called by the request and one with its step timings"""
+    _emf_handler()
+    timestamp = int(time.time() * 1000)
+    dimensions = dimensions or {}
+    with metrics._lock:
+        calls = {key: dict(call, latencies=list(call['latencies'])) for key, call in metrics.calls.items()}
+        steps = {name: dict(step) for name, step in metrics.steps.items()}
+
+    for key, call in calls.items():
+        service, region, operation = key.split(':', 2)
+        _emf_logger.info(json.dumps({
+            '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Service', 'Region', 'Operation']],
+                'Metrics': [
+                    {'Name': 'Latency', 'Unit': 'Milliseconds'},
+                    {'Name': 'Calls', 'Unit': 'Count'},
+                    {'Name': 'Errors', 'Unit': 'Count'},
+                    {'Name': 'Retries', 'Unit': 'Count'},
+                    {'Name': 'Throttles', 'Unit': 'Count'},
+                ]
+            }]},
+            **dimensions,
+            'Service': service, 'Region': region, 'Operation': operation,
+            # EMF accepts at most 100 values per metric
+            'Latency': [round(seconds * 1000, 3) for seconds in call['latencies'][:100]],
+            'Calls': call['count'], 'Errors': call['errors'], 'Retries': call['retries'], 'Throttles': call['throttles'],
+        }))
+    for name, step in steps.items():
+        _emf_logger.info(json.dumps({
+            '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Step']],
+                'Metrics': [{'Name': 'StepDuration', 'Unit': 'Milliseconds'}]
+            }]},
+            **dimensions,
+            'Step': name,
+            'StepDuration': round(step['seconds'] * 1000, 3),
+        }))
+
+@contextmanager
+def request_metrics(dimensions: dict = None):
+    """Collects the api calls and steps of everything called inside it. On exit the EMF lines are
+    written, when METRICS_EMF is on
+
+    Args:
+        dimensions (dict): extra properties of the EMF lines, e.g. the action
+    """
+    token = _request_metrics.set(RequestMetrics())
+    try:
+        yield _request_metrics.get()
+    finally:
+        if METRICS_EMF:
+            try:
+                emit_emf(_request_metrics.get(), dimensions)
+            except Exception as e:
+                logger.warning(f'Could not write the EMF metrics: {e}')
+        _request_metrics.reset(token)
+
+def metrics_summary() -> dict:
+    """Api calls and step timings of the current request"""
+    metrics = _request_metrics.get()
+    return metrics.summary() if metrics is not None else {}
+
+@contextmanager
+def step(name: str):
+    """Times a step of a handler, e.g. with step('migration.datasets'):"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        registry.observe('handler_step_seconds', {'step': name}, seconds)
+        metrics = _request_metrics.get()
+        if metrics is not None:
+            metrics.record_step(name, seconds)
+
+def attach_metrics(client):
+    """Times every call of the client through its botocore events. The start time is kept in the
+    request context of the call, which botocore passes to before-call, after-call and after-call-error"""
+    region = client.meta.region_name
+    service = client.meta.service_model.service_id.hyphenize()
+
+    def finish(context, operation: str, status: str, retries: int = 0):
+        started = context.pop('metrics_started_at', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        labels = {'service': service, 'region': region, 'operation': operation}
+        registry.increment('aws_api_calls_total', {**labels, 'status': status})
+        registry.observe('aws_api_latency_seconds', labels, seconds)
+        if retries:
+            registry.increment('aws_api_retries_total', labels, retries)
+        metrics = _request_metrics.get()
+        if metrics is not None:
+            metrics.record_call(service, region, operation, seconds, status, retries)
+
+    def before_call(model, context, **kwargs):
+        context['metrics_started_at'] = time.perf_counter()
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        finish(context, model.name, 'ok' if http_response.status_code < 300 else parsed.get('Error', {}).get('Code', str(http_response.status_code)), retries)
+
+    def after_call_error(exception, context, event_name, **kwargs):
+        finish(context, event_name.rsplit('.', 1)[-1], type(exception).__name__)
+
+    def needs_retry(response, operation, **kwargs):
+        if response and response[1].get('Error', {}).get('Code') in THROTTLING_CODES:
+            registry.increment('aws_api_throttles_total', {'service': service, 'region': region, 'operation': operation.name})
+            metrics = _request_metrics.get()
+            if metrics is not None:
+                metrics.record_throttle(service, region, operation.name)
+
+    client.meta.events.register(f'before-call.{service}', before_call, unique_id=f'metrics-before-call-{service}-{region}')
+    client.meta.events.register(f'after-call.{service}', after_call, unique_id=f'metrics-after-call-{service}-{region}')
+    client.meta.events.register(f'after-call-error.{service}', after_call_error, unique_id=f'metrics-after-call-error-{service}-{region}')
+    client.meta.events.register(f'needs-retry.{service}', needs_retry, unique_id=f'metrics-needs-retry-{service}-{region}')
+    return client
@@ -0,0 +1,116 @@
+import os
+import logging
+from utils.utils import ANALYSIS_OWNER_ACTIONS, DATASET_OWNER_ACTIONS, parallel_map
+
+logger = logging.getLogger(__name__)
+
+PERMISSION_MAX_WORKERS = int(os.environ.get('PERMISSION_MAX_WORKERS', 8))
+# UpdateAnalysisPermissions and UpdateDataSetPermissions take at most 100 grants and 100 revokes per call
+PERMISSION_CHUNK_SIZE = 100
+
+# Actions of each permission level. none revokes everything the principal has on the resource
+PERMISSION_LEVELS = {
+    'analysis': {
+        'owner': ANALYSIS_OWNER_ACTIONS,
+        'viewer': ['quicksight:DescribeAnalysis', 'quicksight:QueryAnalysis'],
+        'none': [],
+    },
+    'dataset': {
+        'owner': DATASET_OWNER_ACTIONS,
+        'viewer': ['quicksight:DescribeDataSet', 'quicksight:DescribeDataSetPermissions', 'quicksight:PassDataSet', 'quicksight:DescribeIngestion', 'quicksight:ListIngestions'],
+        'none': [],
+    },
+}
+
+def level_actions(kind: str, level: str) -> set:
+    if level not in PERMISSION_LEVELS[kind]:
+        raise ValueError(f"Invalid permission level {level}, use one of: {', '.join(PERMISSION_LEVELS[kind])}")
+    return set(PERMISSION_LEVELS[kind][level])
+
+def describe_permissions(client, acc_id: str, kind: str, resource_id: str) -> dict[str, set]:
+    """Current permissions of an analysis or dataset as principal -> actions"""
+    if kind == 'analysis':
+        response = client.describe_analysis_permissions(AwsAccountId=acc_id, AnalysisId=resource_id)
+    else:
+        response = client.describe_data_set_permissions(AwsAccountId=acc_id, DataSetId=resource_id)
+    return {permission['Principal']: set(permission['Actions']) for permission in response.get('Permissions') or []}
+
+def permission_diff(current: dict[str, set], desired: dict[str, set]) -> tuple[list, list]:
+    """Smallest change that gives each principal of desired exactly its actions. Principals that
+    are not in desired are left as they are
+
+    Returns:
+        tuple[list, list]: grant and revoke permissions, as the Update*Permissions APIs take them
+    """
+    grant, revoke = [], []
+    for principal, actions in desired.items():
+        has = current.get(principal, set())
+        if actions - has:
+            grant.append({'Principal': principal, 'Actions': sorted(actions - has)})
+        if has - actions:
+            revoke.append({'Principal': principal, 'Actions': sorted(has - actions)})
+    return grant, revoke
+
+def permission_calls(grant: list, revoke: list) -> list[tuple[list, list]]:
+    """Splits the grants and revokes in (grant, revoke) pairs that fit in a single call"""
+    size = PERMISSION_CHUNK_SIZE
+    return [
+        (grant[start:start + size], revoke[start:start + size])
+        for start in range(0, max(len(grant), len(revoke)), size)
+    ]
+
+def update_permissions(client, acc_id: str, kind: str, resource_id: str, grant: list, revoke: list):
+    arguments = {
+        **({'GrantPermissions': grant} if grant else {}),
+        **({'RevokePermissions': revoke} if revoke else {}),
+    }
+    if kind == 'analysis':
+        client.update_analysis_permissions(AwsAccountId=acc_id, AnalysisId=resource_id, **arguments)
+    else:
+        client.update_data_set_permissions(AwsAccountId=acc_id, DataSetId=resource_id, **arguments)
+
+def sync_permissions(client, acc_id: str, resources: list[tuple[str, str]], principals: dict[str, str], dry_run: bool = False, grant_only: bool = False, max_workers: int = PERMISSION_MAX_WORKERS) -> list[dict]:
+    """Gives each principal exactly the actions of its level on every resource, touching only what differs.
+
+    The current permissions of every resource are read concurrently, the grant/revoke diff is computed
+    locally and only the resources that changed get update calls, also run concurrently. The shared
+    rate limiter of the client keeps the calls within the QuickSight limits.
+
+    Args:
+        resources (list[tuple[str, str]]): (kind, id) pairs, kind being analysis or dataset
+        principals (dict[str, str]): principal ARN -> level (owner, viewer or none)
+        dry_run (bool): only compute the diff, nothing is changed
+        grant_only (bool): add the missing actions but never revoke any
+
+    Returns:
+        list[dict]: report of each resource, in the order of resources: kind, id, status (UNCHANGED,
+        UPDATED, PLANNED or FAIL), grant and revoke
+    """
+    desired = {kind: {principal: level_actions(kind, level) for principal, level in principals.items()} for kind in PERMISSION_LEVELS}
+    currents = parallel_map(lambda resource: describe_permissions(client, acc_id, *resource), resources, max_workers)
+
+    reports = []
+    calls = []
+    for (kind, resource_id), current in zip(resources, currents):
+        report = {'kind': kind, 'id': resource_id, 'status': 'UNCHANGED', 'grant': [], 'revoke': []}
+        reports.append(report)
+        if isinstance(current, Exception):
+            logger.error(f'Could not read the permissions of the {kind} {resource_id}.\nError: {current}')
+            report.update(status='FAIL', error=str(current))
+            continue
+        report['grant'], report['revoke'] = permission_diff(current, desired[kind])
+        if grant_only:
+            report['revoke'] = []
+        if report['grant'] or report['revoke']:
+            report['status'] = 'PLANNED' if dry_run else 'UPDATED'
+            calls.extend((report, grant, revoke) for grant, revoke in permission_calls(report['grant'], report['revoke']))
+
+    if not dry_run:
+        results = parallel_map(lambda call: update_permissions(client, acc_id, call[0]['kind'], call[0]['id'], call[1], call[2]), calls, max_workers)
+        for (report, _, _), result in zip(calls, results):
+            if isinstance(result, Exception):
+                logger.error(f"Could not update the permissions of the {report['kind']} {report['id']}.\nError: {result}")
+                report.update(status='FAIL', error=str(result))
+
+    logger.info(f"Permissions of {len(resources)} resources synced: {sum(report['status'] in ('UPDATED', 'PLANNED') for report in reports)} changed with {len(calls)} calls")
+    return reports
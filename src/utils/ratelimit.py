@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Calls per second allowed for each QuickSight operation in each region. RATE_LIMITS
+# overrides them with a json like {"default": 10, "CreateDataSet": 2}.
+DEFAULT_RATE_LIMITS = {
+    'default': 10,
+    'CreateDataSet': 2,
+    'UpdateDataSet': 2,
+    'CreateAnalysis': 2,
+    'UpdateAnalysis': 2,
+    'UpdateAnalysisPermissions': 4,
+    'UpdateDataSetPermissions': 4,
+    'CreateTemplate': 2,
+    'UpdateTemplate': 2,
+    'ListUsers': 2,
+}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.environ.get('RATE_LIMITS') or '{}')}
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Fraction of the configured rate kept after a throttle, and regained after each successful call
+RATE_LIMIT_DECREASE = float(os.environ.get('RATE_LIMIT_DECREASE', 0.5))
+RATE_LIMIT_INCREASE = float(os.environ.get('RATE_LIMIT_INCREASE', 0.02))
+# Consecutive server or connection errors that open the circuit of a region, and seconds it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+
+THROTTLING_CODES = {'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded', 'LimitExceededException'}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a region whose circuit is open"""
+
+class TokenBucket():
+    def __init__(self, rate: float) -> None:
+        """Thread safe token bucket whose rate adapts to the throttles (AIMD)
+        Args:
+            rate (float): maximum calls per second, also the burst size
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = rate
+        self.throttles = 0
+        self.waited = 0.0
+        self._updated_at = time.monotonic()
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.rate, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self) -> float:
+        """Takes a token, sleeping until it is available. Returns the seconds waited"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # The token is reserved now, so concurrent callers queue up instead of racing
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def on_throttle(self):
+        """Multiplicative decrease, at most once per second so a burst of throttles counts once"""
+        with self._lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self._decreased_at >= 1:
+                self._refill(now)
+                self.rate = max(self.max_rate * 0.05, self.rate * RATE_LIMIT_DECREASE)
+                self.tokens = min(self.tokens, 0)
+                self._decreased_at = now
+                logger.warning(f'Throttled, lowering the rate to {self.rate:.2f} calls/s')
+
+    def on_success(self):
+        """Additive increase back to the configured rate"""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_LIMIT_INCREASE)
+
+class CircuitBreaker():
+    def __init__(self, threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT) -> None:
+        """Stops calling a region after threshold consecutive failures, for reset_timeout seconds.
+        Then a single call is let through: its success closes the circuit, its failure opens it again."""
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'CLOSED'
+        return 'HALF_OPEN' if time.monotonic() - self.opened_at >= self.reset_timeout else 'OPEN'
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == 'CLOSED':
+                return True
+            if state == 'HALF_OPEN' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+class RateLimiter():
+    def __init__(self, limits: dict = None) -> None:
+        """Token buckets per (region, operation) and circuit breakers per region, shared by every client"""
+        self.limits = limits or RATE_LIMITS
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, region: str, operation: str) -> TokenBucket:
+        key = (region, operation)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(key, TokenBucket(self.limits.get(operation, self.limits['default'])))
+        return bucket
+
+    def breaker(self, region: str) -> CircuitBreaker:
+        breaker = self._breakers.get(region)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(region, CircuitBreaker())
+        return breaker
+
+    def attach(self, client):
+        """Registers the limiter on the botocore events of a client: before-call checks the circuit,
+        before-send waits for a token before each attempt (retries included), needs-retry sees the
+        throttles and failures of each attempt and after-call the successful calls"""
+        region = client.meta.region_name
+        service = client.meta.service_model.service_id.hyphenize()
+        breaker = self.breaker(region)
+
+        def before_call(model, **kwargs):
+            if not breaker.allow():
+                raise CircuitOpenError(f'The circuit of {service} in {region} is open after {breaker.failures} consecutive failures')
+
+        def before_send(event_name, **kwargs):
+            # before-send.<service>.<operation>
+            self.bucket(region, event_name.rsplit('.', 1)[-1]).acquire()
+
+        def needs_retry(response, operation, caught_exception=None, **kwargs):
+            if caught_exception is not None:
+                breaker.on_failure()
+                return
+            http_response, parsed = response
+            if parsed.get('Error', {}).get('Code') in THROTTLING_CODES:
+                self.bucket(region, operation.name).on_throttle()
+            elif http_response.status_code >= 500:
+                breaker.on_failure()
+
+        def after_call(http_response, model, **kwargs):
+            if http_response.status_code < 500:
+                breaker.on_success()
+            if http_response.status_code < 400:
+                self.bucket(region, model.name).on_success()
+
+        client.meta.events.register(f'before-call.{service}', before_call, unique_id=f'rate-limit-before-call-{region}')
+        client.meta.events.register(f'before-send.{service}', before_send, unique_id=f'rate-limit-before-send-{region}')
+        client.meta.events.register(f'needs-retry.{service}', needs_retry, unique_id=f'rate-limit-needs-retry-{region}')
+        client.meta.events.register(f'after-call.{service}', after_call, unique_id=f'rate-limit-after-call-{region}')
+        return client
+
+    def stats(self) -> dict:
+        """Current rate, throttles and seconds waited of each bucket, and the state of each circuit"""
+        return {
+            'buckets': {
+                f'{region}:{operation}': {'rate': round(bucket.rate, 2), 'throttles': bucket.throttles, 'waited': round(bucket.waited, 3)}
+                for (region, operation), bucket in list(self._buckets.items())
+            },
+            'circuits': {region: breaker.state for region, breaker in list(self._breakers.items())},
+        }
+
+_limiter = RateLimiter()
+
+def get_rate_limiter() -> RateLimiter:
+    return _limiter
+
+def attach_rate_limiter(client):
+    """Throttles the calls of the client with the shared limiter, unless RATE_LIMIT_ENABLED is false"""
+    return _limiter.attach(client) if RATE_LIMIT_ENABLED else client
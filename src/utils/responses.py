@@ -0,0 +1,87 @@
+import os
+import json
+import uuid
+import queue
+import logging
+import datetime
+import threading
+from contextvars import copy_context
+from utils.logs import log_sink
+from utils.storage import put_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Responses bigger than this are saved in the bucket and replaced by a presigned url. Lambda
+# refuses synchronous responses above 6 MB, so the default keeps some margin
+RESPONSE_MAX_BYTES = int(os.environ.get('RESPONSE_MAX_BYTES', 5_000_000))
+RESPONSE_PREFIX = os.environ.get('RESPONSE_PREFIX', 'responses')
+RESPONSE_URL_TTL = int(os.environ.get('RESPONSE_URL_TTL', 3600))
+# Lines kept waiting for a slow stream reader before the producer blocks
+STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', 1000))
+
+def offload_response(response, s3_client, bucket_name: str, max_bytes: int = RESPONSE_MAX_BYTES):
+    """Returns the response itself, or, when its json is bigger than max_bytes, saves it in the bucket
+    and returns a pointer with a presigned url to download it. If the upload fails the response goes inline."""
+    size = len(json.dumps(response, default=str, ensure_ascii=False).encode('UTF-8'))
+    if size <= max_bytes or not bucket_name:
+        return response
+    try:
+        key = f"{RESPONSE_PREFIX}/{datetime.datetime.now().strftime('%Y/%m/%d')}/{uuid.uuid4().hex}.json"
+        stored = put_snapshot(s3_client, bucket_name, key, response)
+        url = s3_client.generate_presigned_url('get_object', Params={'Bucket': bucket_name, 'Key': key}, ExpiresIn=RESPONSE_URL_TTL)
+        logger.info(f'The response has {size} bytes, saved in {bucket_name}/{key}')
+        pointer = {
+            "date": datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S'),
+            "offloaded": True,
+            "size": size,
+            "stored_size": stored['size'],
+            "key": key,
+            "result_url": url,
+            "expires_in": RESPONSE_URL_TTL,
+        }
+        if isinstance(response, dict):
+            pointer.update({field: response[field] for field in ('statusCode', 'user', 'action') if field in response})
+        return pointer
+    except Exception as e:
+        logger.error(f'The response of {size} bytes could not be saved in the S3, returning it inline.\nError: {e}')
+        return response
+
+def ndjson_line(record: dict) -> bytes:
+    return json.dumps(record, default=str, ensure_ascii=False).encode('UTF-8') + b'\n'
+
+def stream_ndjson(function, *args):
+    """Runs function(emit, *args) in a background thread and yields its output as NDJSON lines, while it runs:
+    {"type": "item", "data": ...} for each emit(item), {"type": "log", "line": ...} for each log line,
+    then {"type": "result", "data": <return value>} or {"type": "error", ...} if it raised.
+
+    The function runs in a copy of the current context and the queue is bounded, so a slow reader slows the producer down.
+    """
+    lines = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    closed = threading.Event()
+    finished = object()
+
+    def put(record):
+        # Once the reader went away the rest of the output is dropped instead of blocking the producer
+        while not closed.is_set():
+            try:
+                lines.put(record, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def run():
+        try:
+            with log_sink(lambda line: put({'type': 'log', 'line': line})):
+                result = function(lambda item: put({'type': 'item', 'data': item}), *args)
+            put({'type': 'result', 'data': result})
+        except Exception as e:
+            put({'type': 'error', 'error': type(e).__name__, 'message': str(getattr(e, 'detail', e))})
+        finally:
+            put(finished)
+
+    threading.Thread(target=copy_context().run, args=(run,), daemon=True, name='ndjson-stream').start()
+    try:
+        while (record := lines.get()) is not finished:
+            yield ndjson_line(record)
+    finally:
+        closed.set()
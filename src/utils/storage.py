@@ -0,0 +1,85 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# none | gzip | zstd. zstd needs the optional zstandard package and falls back to gzip
+SNAPSHOT_COMPRESSION = os.environ.get('SNAPSHOT_COMPRESSION', 'gzip')
+GZIP_LEVEL = int(os.environ.get('SNAPSHOT_GZIP_LEVEL', 6))
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def encode_json(data) -> bytes:
+    """Compact json used for the snapshots and their content hashes"""
+    return json.dumps(data, default=str, ensure_ascii=False, separators=(',', ':')).encode('UTF-8')
+
+def serialize_snapshot(data: dict, compression: str = SNAPSHOT_COMPRESSION) -> tuple[bytes, str]:
+    """Serializes the snapshot straight into memory
+
+    Args:
+        data (dict): snapshot
+        compression (str): none, gzip or zstd
+
+    Returns:
+        tuple[bytes, str]: body and its Content-Encoding (None when not compressed)
+    """
+    return compress(encode_json(data), compression)
+
+def compress(body: bytes, compression: str = SNAPSHOT_COMPRESSION) -> tuple[bytes, str]:
+    """Compresses the body, returning it with its Content-Encoding"""
+    if compression == 'zstd' and zstandard is None:
+        logger.warning('zstandard is not installed, using gzip')
+        compression = 'gzip'
+    if compression == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), 'gzip'
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(body), 'zstd'
+    return body, None
+
+def deserialize_snapshot(body: bytes, encoding: str = None) -> dict:
+    """Inverse of serialize_snapshot"""
+    if encoding == 'gzip':
+        body = gzip.decompress(body)
+    elif encoding == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is needed to read zstd snapshots')
+        body = zstandard.ZstdDecompressor().decompress(body)
+    return json.loads(body)
+
+def put_snapshot(s3_client, bucket_name: str, key: str, data: dict, compression: str = SNAPSHOT_COMPRESSION, metadata: dict = None) -> dict:
+    """Uploads the snapshot with put_object, without touching the disk
+
+    Returns:
+        dict: key, size (stored bytes), encoding and sha256 of the uncompressed json
+    """
+    raw = encode_json(data)
+    body, encoding = compress(raw, compression)
+    extra = {'ContentEncoding': encoding} if encoding else {}
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=key,
+        Body=body,
+        ContentType='application/json',
+        Metadata={name: str(value) for name, value in (metadata or {}).items()},
+        **extra
+    )
+    return {'key': key, 'size': len(body), 'encoding': encoding, 'sha256': hashlib.sha256(raw).hexdigest()}
+
+def read_snapshot(s3_client, bucket_name: str, key: str) -> dict:
+    """Downloads and decodes a snapshot saved by put_snapshot (or an old uncompressed one)"""
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    return deserialize_snapshot(response['Body'].read(), response.get('ContentEncoding'))
+
+def is_not_found(error: Exception) -> bool:
+    """True for the S3 errors of a missing key"""
+    return getattr(error, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404', 'NotFound')
+
+def is_conflict(error: Exception) -> bool:
+    """True for the S3 errors of a conditional write (IfMatch / IfNoneMatch) that lost the race"""
+    return getattr(error, 'response', {}).get('Error', {}).get('Code') in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409')
@@ -1,10 +1,38 @@
+import os
 import re
+import json
+import base64
+import time
+import hashlib
 import logging
-import requests
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', filename='logs/logs.log')
+import threading
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
+from utils.cache import Uncached, cached_describe, invalidate
+from utils.logs import setup_logging
+setup_logging()
 logger = logging.getLogger(__name__)
+
+# Permissions given to the owner of a migrated analysis or dataset
+ANALYSIS_OWNER_ACTIONS = [
+    'quicksight:UpdateAnalysis',
+    'quicksight:RestoreAnalysis',
+    'quicksight:UpdateAnalysisPermissions',
+    'quicksight:DeleteAnalysis',
+    'quicksight:QueryAnalysis',
+    'quicksight:DescribeAnalysisPermissions',
+    'quicksight:DescribeAnalysis'
+]
+DATASET_OWNER_ACTIONS = ['quicksight:DescribeDataSet','quicksight:DescribeDataSetPermissions','quicksight:PassDataSet','quicksight:DescribeIngestion','quicksight:ListIngestions','quicksight:UpdateDataSet','quicksight:DeleteDataSet','quicksight:CreateIngestion','quicksight:CancelIngestion','quicksight:UpdateDataSetPermissions']
+
 # ANALYSIS
 
+def invalidate_analysis(client, analysis_id:str):
+    ''' Descarta as descrições em cache de uma análise alterada '''
+    invalidate('describe_analysis', client.meta.region_name, analysis_id)
+    invalidate('describe_analysis_definition', client.meta.region_name, analysis_id)
+
+@cached_describe
 def describe_analysis(client, acc_id:str, analysis_id: str) -> dict :
     """Describes the analysis details
 
@@ -39,6 +67,8 @@ def describe_analysis(client, acc_id:str, analysis_id: str) -> dict :
         return analysisInfo
     except Exception as e:
         logger.error(f'An error ocurred in describe_analysis function.\n Error: {e}')
+        # Only a missing analysis may be cached, other failures are asked again by the next call
+        return None if str(type(e)) == "<class 'botocore.errorfactory.ResourceNotFoundException'>" else Uncached(None)
 
 def update_analysis(client, acc_id:str, analysis_info:dict, template_info:dict, dataset_references:dict) -> int :
     """ Update the Analysis ID based in a template
@@ -65,6 +95,7 @@ def update_analysis(client, acc_id:str, analysis_info:dict, template_info:dict,
                 }
             }
         )
+        invalidate_analysis(client, analysis_info['Id'])
     except Exception as e:
         if str(type(e)) == "<class 'botocore.errorfactory.ResourceNotFoundException'>":
             logger.error('Analysis is Not Found')
@@ -100,6 +131,7 @@ def create_analysis(client, acc_id:str, analysis_info:dict, template_info:dict,
                 }
             }
         )
+        invalidate_analysis(client, analysis_info['Id'])
     except Exception as e:
         if str(type(e)) == "<class 'botocore.errorfactory.ResourceExistsException'>":
             logger.error('Analysis already exists')
@@ -114,30 +146,113 @@ def create_analysis(client, acc_id:str, analysis_info:dict, template_info:dict,
         logger.info('Analysis Created With Success')
         return 1
 
-def list_analysis(client, acc_id: str, next_token=None, analyses=[]):
+def iter_analyses(client, acc_id: str, status: str = None):
+    """Streams the analysis summaries of a region page by page
+
+    Args:
+        client (class): quicksight client
+        acc_id (str): account Id
+        status (str): when given, only the analyses with this Status are yielded
+
+    Yields:
+        dict: Id, Name, Arn, Status, CreatedTime
+    """
+    for page in client.get_paginator('list_analyses').paginate(AwsAccountId=acc_id):
+        for analysis in page['AnalysisSummaryList']:
+            if status and analysis['Status'] != status:
+                continue
+            yield analysis_summary(analysis)
+
+def analysis_summary(analysis: dict) -> dict:
+    return {
+        'Id': analysis['AnalysisId'],
+        'Name': analysis['Name'],
+        'Arn': analysis['Arn'],
+        'Status': analysis['Status'],
+        'CreatedTime': analysis['CreatedTime']
+    }
+
+def encode_cursor(state: dict) -> str:
+    """Opaque pagination cursor handed to the callers"""
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode('UTF-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> dict:
+    """Inverse of encode_cursor. An empty cursor is the first page
+
+    Raises:
+        ValueError: when the cursor was not made by encode_cursor
+    """
+    if not cursor:
+        return {}
     try:
-        if next_token:
-            response = client.list_analyses(AwsAccountId=acc_id, NextToken=next_token)
-        else:
-            response = client.list_analyses(AwsAccountId=acc_id)
-
-        for analysis in response['AnalysisSummaryList']:
-            analyses.append({
-                'Id': analysis['AnalysisId'],
-                'Name': analysis['Name'],
-                'Arn': analysis['Arn'],
-                'Status': analysis['Status'],
-                'CreatedTime': analysis['CreatedTime']
-            })
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+def page_analyses(clients: list, acc_id: str, status: str = None, page_size: int = 100, cursor: str = None) -> dict:
+    """Reads one page of the analyses of one or more regions, without listing everything first.
+    The cursor keeps the region, the QuickSight NextToken and how many analyses of that api page were already returned.
 
-        next_token = response.get('NextToken')
-        if next_token:
-            return list_analysis(client, acc_id, next_token, analyses)
+    Args:
+        clients (list): quicksight clients, read one region after the other
+        acc_id (str): account Id
+        status (str): when given, only the analyses with this Status are returned
+        page_size (int): maximum analyses of the page
+        cursor (str): next_cursor of the previous page, None for the first one
 
+    Returns:
+        dict: items (Id, Name, Arn, Status, CreatedTime, Region) and next_cursor, None on the last page
+    """
+    state = decode_cursor(cursor)
+    regions = [client.meta.region_name for client in clients]
+    index = regions.index(state['region']) if state.get('region') in regions else 0
+    token = state.get('token')
+    skip = state.get('skip', 0)
+    items = []
+    while index < len(clients) and len(items) < page_size:
+        response = clients[index].list_analyses(AwsAccountId=acc_id, MaxResults=100, **({'NextToken': token} if token else {}))
+        matches = [
+            {**analysis_summary(analysis), 'Region': regions[index]}
+            for analysis in response['AnalysisSummaryList']
+            if not status or analysis['Status'] == status
+        ][skip:]
+        room = page_size - len(items)
+        if len(matches) > room:
+            # The page ends in the middle of this api page, the next one starts again from it
+            items += matches[:room]
+            return {'items': items, 'next_cursor': encode_cursor({'region': regions[index], 'token': token, 'skip': skip + room})}
+        items += matches
+        skip = 0
+        token = response.get('NextToken')
+        if not token:
+            index += 1
+    next_cursor = encode_cursor({'region': regions[index], 'token': token, 'skip': 0}) if index < len(clients) else None
+    return {'items': items, 'next_cursor': next_cursor}
+
+def list_analysis(client, acc_id: str, status: str = None) -> list[dict[str]]:
+    """Lists all the analysis in a region"""
+    try:
+        return list(iter_analyses(client, acc_id, status))
     except Exception as e:
         logger.error(f"An error occurred in the list_analysis function.\nError: {e}")
-        
-    return analyses
+        return []
+
+def iter_folder_members(client, acc_id: str, folder_id: str, member_type: str = 'analysis'):
+    """Streams the ids of the members of a QuickSight folder
+
+    Args:
+        client (class): quicksight client
+        acc_id (str): account Id
+        folder_id (str): folder Id
+        member_type (str): analysis, dashboard or dataset, read from the member ARN
+
+    Yields:
+        str: member id
+    """
+    for page in client.get_paginator('list_folder_members').paginate(AwsAccountId=acc_id, FolderId=folder_id):
+        for member in page['FolderMemberList']:
+            if f':{member_type}/' in member.get('MemberArn', ''):
+                yield member['MemberId']
 
 def list_deleted_analysis(client, acc_id) -> list[dict[str]]:
     """Filter the Analysis whose status is equal to DELETED
@@ -150,12 +265,27 @@ def list_deleted_analysis(client, acc_id) -> list[dict[str]]:
         list[dict[str]]: Id, Name, Arn, Status 
     """
     try:    
-        analysis_list = list_analysis(client, acc_id)
-        data = [analysis for analysis in analysis_list if analysis['Status'] == 'DELETED']
-        return data
+        return list(iter_analyses(client, acc_id, 'DELETED'))
     except Exception as e:
         logger.error(f"An error ocurred in list_deleted_analysis function.\n Error: {e}")
 
+def list_deleted_analysis_regions(clients: list, acc_id: str) -> list[dict[str]]:
+    """Scans the deleted analysis of several regions in parallel and merges the results
+
+    Args:
+        clients (list): quicksight clients, one per region
+        acc_id (str): account Id
+
+    Returns:
+        list[dict[str]]: Id, Name, Arn, Status, Region
+    """
+    def scan(client):
+        region = client.meta.region_name
+        return [{**analysis, 'Region': region} for analysis in list_deleted_analysis(client, acc_id) or []]
+
+    results = parallel_map(scan, clients, max(len(clients), 1))
+    return [analysis for result in results if not isinstance(result, Exception) for analysis in result]
+
 def restore_analysis(client, acc_id:str, analysis_id:str) -> int:
     """Restore a Deleted Analysis
 
@@ -172,12 +302,14 @@ def restore_analysis(client, acc_id:str, analysis_id:str) -> int:
             AwsAccountId=acc_id,
             AnalysisId=analysis_id
         ))
+        invalidate_analysis(client, analysis_id)
         logger.info("Analysis Restoured")
         return 1
     except Exception as e:
         logger.error(f"An error ocurred in restore_analysis function.\nError: {e}")
         return 0
 
+@cached_describe
 def describe_analysis_definition(client, acc_id:str, analysis_id:str) -> dict:
     """Retorna um Dicionário Descrevendo a Análise em Detalhes
 
@@ -206,7 +338,7 @@ def describe_analysis_definition(client, acc_id:str, analysis_id:str) -> dict:
         return data
     except Exception as e:
         logger.error(f"An error ocurred in describe_analysis_definition function.\nError: {e}")
-        return 0
+        return 0 if str(type(e)) == "<class 'botocore.errorfactory.ResourceNotFoundException'>" else Uncached(0)
     
 def grant_auth(client, acc_id:str, analysis_id:str, user_arn:str):
     ''' Atualiza as Permissões de Um Usuário Sobre uma Análise: Update, Restore, Delete, Query e Describe'''
@@ -217,15 +349,7 @@ def grant_auth(client, acc_id:str, analysis_id:str, user_arn:str):
         GrantPermissions=[
                 {
                     'Principal': user_arn,
-                    'Actions': [
-                            'quicksight:UpdateAnalysis',
-                            'quicksight:RestoreAnalysis', 
-                            'quicksight:UpdateAnalysisPermissions', 
-                            'quicksight:DeleteAnalysis', 
-                            'quicksight:QueryAnalysis',
-                            'quicksight:DescribeAnalysisPermissions', 
-                            'quicksight:DescribeAnalysis'
-                        ]
+                    'Actions': ANALYSIS_OWNER_ACTIONS
                 }
             ]
         )
@@ -247,12 +371,15 @@ def create_analysis_by_definition(client, acc_id:str, analysis_definition:dict)
         int: 1 if Success, 2 If already Exists, 1 if Fail
     """
     try:
+        extra = {'ThemeArn': analysis_definition['ThemeArn']} if analysis_definition.get('ThemeArn') else {}
         client.create_analysis(
             AwsAccountId = acc_id,
             AnalysisId = analysis_definition['Id'],
             Name = analysis_definition['Name'],
-            Definition = analysis_definition['Definition']
+            Definition = analysis_definition['Definition'],
+            **extra
         )
+        invalidate_analysis(client, analysis_definition['Id'])
     except Exception as e:
         if str(type(e)) == "<class 'botocore.errorfactory.ResourceExistsException'>":
             logger.warning('Analysis Already Exists in this Region')
@@ -267,8 +394,40 @@ def create_analysis_by_definition(client, acc_id:str, analysis_definition:dict)
         logger.info('Analysis Created With Success')
         return 1
 
+def update_analysis_by_definition(client, acc_id:str, analysis_definition:dict) -> int:
+    """Update an Analysis straight from its definition, without a template
+
+    Args:
+        client (class): quicksight client
+        acc_id (str): account ID
+        analysis_definition (dict): analysis definition, can be obtained by Describe Analysis Definition Function or from a S3 snapshot
+
+    Returns:
+        int: 1 if Success, 2 If the analysis does not exist, 0 if Fail
+    """
+    try:
+        extra = {'ThemeArn': analysis_definition['ThemeArn']} if analysis_definition.get('ThemeArn') else {}
+        client.update_analysis(
+            AwsAccountId = acc_id,
+            AnalysisId = analysis_definition['Id'],
+            Name = analysis_definition['Name'],
+            Definition = analysis_definition['Definition'],
+            **extra
+        )
+        invalidate_analysis(client, analysis_definition['Id'])
+    except Exception as e:
+        if str(type(e)) == "<class 'botocore.errorfactory.ResourceNotFoundException'>":
+            logger.warning('Analysis is Not Found')
+            return 2
+        logger.error(f'An error ocurred in update_analysis_by_definition function.\n Error: {e}')
+        return 0
+    else:
+        logger.info('Analysis Updated Successfully')
+        return 1
+
 # DATASETS
 
+@cached_describe
 def describe_dataset(client, acc_id:str, database_id:str) -> dict[str]:
     '''Função Responsável por descrever as características de um dataset.
     Retorna um dicionário com os campos
@@ -287,15 +446,16 @@ def describe_dataset(client, acc_id:str, database_id:str) -> dict[str]:
             'Arn': response.get('Arn')
         }
 
-        if len(dataset_info['PhysicalTableMap']):
-            PhysicalTableMap_id = next(iter(dataset_info['PhysicalTableMap']))
-            dataset_info['DataSourceId'] = extract_id_from_arn(dataset_info['PhysicalTableMap'][PhysicalTableMap_id]['CustomSql']['DataSourceArn'])
+        if dataset_info['PhysicalTableMap']:
+            physical_table = next(iter(dataset_info['PhysicalTableMap'].values()))
+            table = physical_table.get('CustomSql') or physical_table.get('RelationalTable') or physical_table.get('S3Source') or {}
+            dataset_info['DataSourceId'] = extract_id_from_arn(table.get('DataSourceArn', ''))
 
         return dataset_info
 
     except Exception as e:
         logger.error(f'An error ocurred in describe_dataset function: {e}')
-        return None
+        return None if str(type(e)) == "<class 'botocore.errorfactory.ResourceNotFoundException'>" else Uncached(None)
     
 def create_dataset(client, acc_id:str, dataset_info:dict[str], user_arn:str) -> int:
     ''' Função Responsável pela Criação de Datasets ea alteração de suas permissões na nova região'''
@@ -310,11 +470,12 @@ def create_dataset(client, acc_id:str, dataset_info:dict[str], user_arn:str) ->
             Permissions=[
                 {
                     'Principal': user_arn,
-                    'Actions': ['quicksight:DescribeDataSet','quicksight:DescribeDataSetPermissions','quicksight:PassDataSet','quicksight:DescribeIngestion','quicksight:ListIngestions','quicksight:UpdateDataSet','quicksight:DeleteDataSet','quicksight:CreateIngestion','quicksight:CancelIngestion','quicksight:UpdateDataSetPermissions']
+                    'Actions': DATASET_OWNER_ACTIONS
 
                 }
             ]
         )
+        invalidate('describe_dataset', client.meta.region_name, dataset_info['DataSetId'])
         logger.info("Dataset Created Sucefully")
         return response
     except Exception as e:
@@ -326,6 +487,7 @@ def create_dataset(client, acc_id:str, dataset_info:dict[str], user_arn:str) ->
         return 0
 
 def update_dataset(client, acc_id,dataset_info, user_arn):
+    ''' Atualiza um dataset existente. UpdateDataSet não recebe permissões, então o usuário recebe as de dono à parte, sem remover as de outros '''
     try:
         response = client.update_data_set(
                 AwsAccountId=acc_id,
@@ -333,19 +495,18 @@ def update_dataset(client, acc_id,dataset_info, user_arn):
                 Name=f'{dataset_info['Name']}_copy',
                 PhysicalTableMap = dataset_info['PhysicalTableMap'],
                 LogicalTableMap = dataset_info['LogicalTableMap'],
-                ImportMode=dataset_info['ImportMode'],
-                Permissions=[
-                    {
-                        'Principal': user_arn,
-                        'Actions': ['quicksight:DescribeDataSet','quicksight:DescribeDataSetPermissions','quicksight:PassDataSet','quicksight:DescribeIngestion','quicksight:ListIngestions','quicksight:UpdateDataSet','quicksight:DeleteDataSet','quicksight:CreateIngestion','quicksight:CancelIngestion','quicksight:UpdateDataSetPermissions']
-
-                    }
-                ]
+                ImportMode=dataset_info['ImportMode']
         )
-        logger.info("Dataset Created Sucefully")
+        invalidate('describe_dataset', client.meta.region_name, dataset_info['DataSetId'])
+        client.update_data_set_permissions(
+            AwsAccountId=acc_id,
+            DataSetId=dataset_info['DataSetId'],
+            GrantPermissions=[{'Principal': user_arn, 'Actions': DATASET_OWNER_ACTIONS}]
+        )
+        logger.info("Dataset Updated Sucefully")
         return response
     except Exception as e:
-        logger.error(f'An error ocurred in create_dataset function.\n Error: {e}')
+        logger.error(f'An error ocurred in update_dataset function.\n Error: {e}')
         return 0
     
 
@@ -369,6 +530,7 @@ def create_template(client, acc_id: str, analysis_info: dict[str,dict], comment:
             SourceEntity=SourceEntity,
             VersionDescription = comment
         )
+        invalidate('describe_template', client.meta.region_name, analysis_info['Id'])
 
     except Exception as e:
         if str(type(e)) == "<class 'botocore.errorfactory.ResourceExistsException'>":
@@ -380,6 +542,7 @@ def create_template(client, acc_id: str, analysis_info: dict[str,dict], comment:
         logger.error(f'Template creation for {analysis_info['Name']} was SUCESSFULL \n Template ID: {analysis_info['Id']}')
         return 1
 
+@cached_describe
 def describe_template(client, acc_id:str, template_id:str, version:str = None):
     ''' Função Responsável por descrever um template. Retorna um Dicionário de Strings de campos: Arn, Id, Name, Version, Description'''
     try:
@@ -403,6 +566,7 @@ def describe_template(client, acc_id:str, template_id:str, version:str = None):
         }
     except Exception as e:
         logger.error(f'An error ocurred in describe_template function.\n Error: {e}')
+        return None if str(type(e)) == "<class 'botocore.errorfactory.ResourceNotFoundException'>" else Uncached(None)
 
 def delete_template(client, acc_id:str, template_info:dict):
     ''' Função responsável por exluir um template '''
@@ -411,6 +575,7 @@ def delete_template(client, acc_id:str, template_info:dict):
             TemplateId=template_info['Id'],
             VersionNumber=template_info['Version']
         )
+        invalidate('describe_template', client.meta.region_name, template_info['Id'])
     except Exception as e:
         logger.error(f'An error ocurred in delete_template function \n Error: {e}')
 
@@ -431,6 +596,7 @@ def update_template(client, acc_id:str, analysis_info:dict, comment:str, dataset
             VersionDescription=comment,
             Name=f'{analysis_info['Name']}_template'
         )
+        invalidate('describe_template', client.meta.region_name, analysis_info['Id'])
 
     except Exception as e:
         logger.error(f'\nAn error ocurred in update_template function \n Error: {e}')
@@ -441,18 +607,82 @@ def update_template(client, acc_id:str, analysis_info:dict, comment:str, dataset
 
 # USERS
 
-def search_user(client, acc_id:str, email:str) -> dict:
-    ''' Lista os Usuários e Retorna os Dados do Email Fornecido '''
+# Email -> user ARN index shared by warm invocations, keyed by (account, namespace)
+USER_INDEX_TTL = int(os.environ.get('USER_INDEX_TTL', 900))
+USER_INDEX_PATH = os.environ.get('USER_INDEX_PATH') # e.g. /tmp/quicksight_users.json
+USER_INDEX_MIN_REFRESH = 60
+_user_index = {}
+_user_index_lock = threading.Lock()
+
+def _read_user_index_file(key: str) -> dict:
     try:
-        response = client.list_users(
-        AwsAccountId=acc_id,
-        Namespace = 'default'
-        )['UserList']
-        user = ''
-        for user in response:
-            if email == user['Email']:
-                return user['Arn']
-        raise ValueError ('Email does not exist in the database')
+        with open(USER_INDEX_PATH, 'r', encoding='UTF-8') as file:
+            return json.load(file).get(key)
+    except Exception:
+        return None
+
+def _write_user_index_file(key: str, index: dict):
+    try:
+        try:
+            with open(USER_INDEX_PATH, 'r', encoding='UTF-8') as file:
+                data = json.load(file)
+        except Exception:
+            data = {}
+        data[key] = index
+        tmp_path = f'{USER_INDEX_PATH}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, USER_INDEX_PATH)
+    except Exception as e:
+        logger.warning(f'Could not persist the user index: {e}')
+
+def load_user_index(client, acc_id:str, namespace:str = 'default', refresh:bool = False) -> dict[str,str]:
+    """Returns the lowercased email -> user ARN index of a namespace, refreshing it after USER_INDEX_TTL
+
+    Args:
+        client (class): quicksight client
+        acc_id (str): account id
+        namespace (str): quicksight namespace
+        refresh (bool): forces a new listing of the users
+
+    Returns:
+        dict[str,str]: email, Arn
+    """
+    key = f'{acc_id}/{namespace}'
+    with _user_index_lock:
+        index = _user_index.get(key)
+        if index is None and USER_INDEX_PATH:
+            index = _read_user_index_file(key)
+        if not refresh and index and time.time() - index['loaded_at'] < USER_INDEX_TTL:
+            _user_index[key] = index
+            return index['users']
+
+        users = {}
+        for page in client.get_paginator('list_users').paginate(AwsAccountId=acc_id, Namespace=namespace):
+            for user in page['UserList']:
+                if user.get('Email'):
+                    users[user['Email'].lower()] = user['Arn']
+
+        index = {'loaded_at': time.time(), 'users': users}
+        _user_index[key] = index
+        if USER_INDEX_PATH:
+            _write_user_index_file(key, index)
+        logger.debug(f'User index loaded with {len(users)} users')
+        return users
+
+def search_user(client, acc_id:str, email:str) -> str:
+    ''' Retorna o ARN do usuário dono do Email fornecido usando o índice de usuários em cache '''
+    try:
+        users = load_user_index(client, acc_id)
+        arn = users.get(email.lower())
+        if not arn:
+            # The user may have been created after the index was loaded
+            index = _user_index.get(f'{acc_id}/default')
+            if time.time() - index['loaded_at'] >= USER_INDEX_MIN_REFRESH:
+                arn = load_user_index(client, acc_id, refresh=True).get(email.lower())
+        if not arn:
+            raise ValueError ('Email does not exist in the database')
+        return arn
     except ValueError as e:
         logger.error(e)
     except Exception as e: 
@@ -460,6 +690,43 @@ def search_user(client, acc_id:str, email:str) -> dict:
 
 # OTHERS
 
+def parallel_map(function, items, max_workers:int = 8) -> list:
+    """Runs the function for every item on a bounded worker pool
+
+    Args:
+        function (callable): function applied to each item
+        items (iterable): function arguments
+        max_workers (int): pool size
+
+    Returns:
+        list: results in the same order as items. An item that raised gets its exception in place of the result
+    """
+    def call(item):
+        try:
+            return function(item)
+        except Exception as e:
+            return e
+
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [call(item) for item in items]
+    # Each task runs in a copy of the caller context, so request scoped state (like the describe cache) is shared
+    contexts = [copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(lambda context, item: context.run(call, item), contexts, items))
+
+def fingerprint(data) -> str:
+    """Canonical content hash: the same content always gives the same hash, whatever the key order"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str, separators=(',', ':')).encode('UTF-8')).hexdigest()
+
+def dataset_fingerprint(dataset_info: dict) -> str:
+    """Hash of what create_dataset sends for a dataset, taken after the ARNs were switched to the target region"""
+    return fingerprint({key: dataset_info.get(key) for key in ('PhysicalTableMap', 'LogicalTableMap', 'ImportMode')})
+
+def analysis_fingerprint(analysis_definition: dict) -> str:
+    """Hash of what create_analysis_by_definition sends for an analysis"""
+    return fingerprint({key: analysis_definition.get(key) for key in ('Name', 'Definition', 'ThemeArn')})
+
 def extract_id_from_arn(arn:str) -> str:
     ''' Função responsável por retorar de um ARN o ID do objeto '''
     pattern = r'(?<=/).*'
@@ -471,6 +738,7 @@ def extract_id_from_arn(arn:str) -> str:
 def get_file(url, filename):
     ''' Faz uma requisição a uma URL e coleta o seu conteúdo em arquivo .qs '''
     try:
+        import requests # only this helper needs it, kept out of the cold start
         response = requests.get(url)
 
         with open(f'{filename}.qs', 'wb') as file:
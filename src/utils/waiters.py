@@ -0,0 +1,113 @@
+import os
+import time
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a resource before giving up and the bounds of the jittered backoff
+WAITER_TIMEOUT = float(os.environ.get('WAITER_TIMEOUT', 300))
+WAITER_BASE_DELAY = float(os.environ.get('WAITER_BASE_DELAY', 1))
+WAITER_MAX_DELAY = float(os.environ.get('WAITER_MAX_DELAY', 20))
+
+SUCCESS_STATES = {'CREATION_SUCCESSFUL', 'UPDATE_SUCCESSFUL'}
+FAILURE_STATES = {'CREATION_FAILED', 'UPDATE_FAILED', 'DELETED'}
+TIMEOUT = 'TIMEOUT'
+NOT_FOUND = 'NOT_FOUND'
+
+def _error_name(e: Exception) -> str:
+    return getattr(e, 'response', {}).get('Error', {}).get('Code') or type(e).__name__
+
+def template_status(client, acc_id: str, template_id: str) -> tuple[str, list]:
+    """Status and errors of the latest template version. Always calls the API, never the describe cache"""
+    version = client.describe_template(AwsAccountId=acc_id, TemplateId=template_id)['Template']['Version']
+    return version['Status'], version.get('Errors', [])
+
+def analysis_status(client, acc_id: str, analysis_id: str) -> tuple[str, list]:
+    analysis = client.describe_analysis(AwsAccountId=acc_id, AnalysisId=analysis_id)['Analysis']
+    return analysis['Status'], analysis.get('Errors', [])
+
+def dataset_status(client, acc_id: str, dataset_id: str) -> tuple[str, list]:
+    """Datasets have no status: they are ready once they can be described.
+    SPICE datasets are also ready only after their last ingestion finished."""
+    dataset = client.describe_data_set(AwsAccountId=acc_id, DataSetId=dataset_id)['DataSet']
+    if dataset.get('ImportMode') != 'SPICE':
+        return 'CREATION_SUCCESSFUL', []
+    ingestions = client.list_ingestions(AwsAccountId=acc_id, DataSetId=dataset_id, MaxResults=1).get('Ingestions', [])
+    if not ingestions:
+        return 'CREATION_SUCCESSFUL', []
+    ingestion = ingestions[0]
+    status = {
+        'COMPLETED': 'CREATION_SUCCESSFUL',
+        'FAILED': 'CREATION_FAILED',
+        'CANCELLED': 'CREATION_FAILED',
+    }.get(ingestion['IngestionStatus'], 'CREATION_IN_PROGRESS')
+    return status, [ingestion['ErrorInfo']] if ingestion.get('ErrorInfo') else []
+
+STATUS_FUNCTIONS = {
+    'template': template_status,
+    'analysis': analysis_status,
+    'dataset': dataset_status,
+}
+
+def backoff(attempt: int) -> float:
+    """Jittered exponential backoff, so the polls of resources created together do not line up"""
+    return random.uniform(WAITER_BASE_DELAY / 2, min(WAITER_MAX_DELAY, WAITER_BASE_DELAY * 2 ** attempt))
+
+def wait_for(resources: list[dict], timeout: float = WAITER_TIMEOUT) -> list[dict]:
+    """Polls many resources from a single loop until each one reaches a terminal state or the deadline
+
+    Args:
+        resources (list[dict]): client, acc_id, kind (template, analysis or dataset) and id of each resource
+        timeout (float): seconds until the resources still in progress are reported as TIMEOUT
+
+    Returns:
+        list[dict]: kind, id, status (terminal state, TIMEOUT or NOT_FOUND), ready, seconds waited, polls and errors, in the order of the resources
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    pending = []
+    results = []
+    for resource in resources:
+        result = {'kind': resource['kind'], 'id': resource['id'], 'status': None, 'ready': False, 'seconds': 0, 'polls': 0, 'errors': []}
+        results.append(result)
+        pending.append({'resource': resource, 'result': result, 'next_poll': started})
+
+    while pending:
+        now = time.monotonic()
+        for item in [item for item in pending if item['next_poll'] <= now]:
+            resource, result = item['resource'], item['result']
+            result['polls'] += 1
+            try:
+                status, errors = STATUS_FUNCTIONS[resource['kind']](resource['client'], resource['acc_id'], resource['id'])
+            except Exception as e:
+                # Just created resources may not be visible yet, so not found is retried until the deadline
+                if _error_name(e) != 'ResourceNotFoundException':
+                    logger.warning(f"Could not read the status of the {resource['kind']} {resource['id']}: {e}")
+                status, errors = NOT_FOUND if _error_name(e) == 'ResourceNotFoundException' else None, []
+
+            result['status'] = status
+            result['errors'] = errors
+            if status in SUCCESS_STATES or status in FAILURE_STATES:
+                result['ready'] = status in SUCCESS_STATES
+                result['seconds'] = round(time.monotonic() - started, 3)
+                pending.remove(item)
+                logger.info(f"{resource['kind'].capitalize()} {resource['id']} reached {status} after {result['seconds']}s and {result['polls']} polls")
+            else:
+                item['next_poll'] = time.monotonic() + backoff(result['polls'] - 1)
+
+        now = time.monotonic()
+        if now >= deadline:
+            for item in pending:
+                last_status = item['result']['status']
+                item['result'].update(status=NOT_FOUND if last_status == NOT_FOUND else TIMEOUT, seconds=round(now - started, 3))
+                logger.error(f"{item['resource']['kind'].capitalize()} {item['resource']['id']} was still {last_status} after {timeout}s")
+            break
+        if pending:
+            time.sleep(max(0, min(min(item['next_poll'] for item in pending), deadline) - now))
+
+    return results
+
+def wait_for_resource(client, acc_id: str, kind: str, resource_id: str, timeout: float = WAITER_TIMEOUT) -> dict:
+    """Waits for a single resource, see wait_for"""
+    return wait_for([{'client': client, 'acc_id': acc_id, 'kind': kind, 'id': resource_id}], timeout)[0]
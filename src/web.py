@@ -0,0 +1,109 @@
+import json
+from typing import Optional
+from mangum import Mangum
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi import FastAPI, Body, Form, HTTPException, Request
+from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.templating import Jinja2Templates
+from lambda_function import lambda_handler, stream_event, ACTIONS
+from utils.jobs import submit_job, get_job, is_job_invocation
+from utils.responses import stream_ndjson
+from utils.metrics import registry
+
+app = FastAPI()
+app.mount("/static", StaticFiles(directory="static"), name="static")
+_mangum = Mangum(app)
+templates = Jinja2Templates(directory="templates")
+
+def handler(event, context):
+    """Lambda entry point of the web app. The asynchronous invocations started by submit_job go straight to lambda_handler"""
+    if is_job_invocation(event):
+        return lambda_handler(event, context)
+    return _mangum(event, context)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"], 
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.get("/", response_class=HTMLResponse)
+async def show_form(request:Request):
+    try:
+        return templates.TemplateResponse(
+            'form.html', 
+            {"request":request, "ACTIONS": ACTIONS}
+        )
+    except Exception as e:
+        return templates.TemplateResponse('error.html', {"request":request,"error":e,"error_type":type(e).__name__})
+
+@app.post("/submit", response_class=HTMLResponse)
+async def submit_form(
+    request: Request,
+    email: str = Form(...), 
+    analysis_id: Optional[str] = Form(None),
+    stakeholder: Optional[str] = Form(None),
+    action: str = Form(...), 
+    source_region: str = Form(...),
+    target_region: str = Form(...),
+    version: Optional[str] = Form(None),
+    comment: Optional[str] = Form(None),
+    async_job: Optional[bool] = Form(False),
+    from_snapshot: Optional[bool] = Form(False),
+    as_of: Optional[str] = Form(None),
+    folder_id: Optional[str] = Form(None),
+    name_prefix: Optional[str] = Form(None),
+):
+    try:
+        event = {
+            "email": email,
+            "analysis_id": analysis_id,
+            "stakeholder": stakeholder,
+            "action": action,
+            "target_region": target_region,
+            "source_region": source_region,
+            "version": version,
+            "comment": comment,
+            "from_snapshot": from_snapshot,
+            "as_of": as_of,
+            "folder_id": folder_id,
+            "name_prefix": name_prefix,
+        }
+        if async_job:
+            # Long actions run in background, the status is followed on /jobs/{job_id}
+            job_id = submit_job(lambda_handler, event, None, description=action, event=event)
+            response = {"job_id": job_id, "status_url": str(request.url_for('job_status', job_id=job_id))}
+        else:
+            response = lambda_handler(event, None)
+        return templates.TemplateResponse(
+            'response.html', 
+            {"request": request, "response": json.dumps(response, indent=4, ensure_ascii=False, default=str)}
+        )
+    except Exception as e:
+        return templates.TemplateResponse('error.html', {"request":request,"error":e,"error_type":type(e).__name__})
+
+@app.post("/api")
+def api(request: Request, event: dict = Body(...), stream: bool = False):
+    """JSON api of the actions, the body is the lambda event. With ?stream=true (or Accept: application/x-ndjson)
+    the response is NDJSON written while the action runs: its items and log lines, then its result"""
+    if stream or 'application/x-ndjson' in request.headers.get('accept', ''):
+        return StreamingResponse(stream_ndjson(stream_event, event), media_type="application/x-ndjson")
+    response = lambda_handler(event, None)
+    if isinstance(response, dict) and response.get('statusCode') == 'IN_PROGRESS':
+        return JSONResponse(response, status_code=409)
+    return response
+
+@app.get("/jobs/{job_id}", name="job_status")
+async def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail={'Error': 'JobNotFound', "Error Message": f"Job {job_id} does not exist"})
+    return job
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Latency, calls, retries and throttles of the aws calls and handler step timings, in the prometheus format"""
+    return PlainTextResponse(registry.render_prometheus(), media_type="text/plain; version=0.0.4")